@@ -1,64 +1,240 @@
+"""
+app.py
+
+Gradio UI of the tutor. Importing this module is cheap: the model client, the background
+services and the UI are only created by create_app(), and main() launches the server, warming
+up connections and the exercise pool first so the server only reports ready once it is fast.
+"""
+
 from app_integration import *
-import gradio as gr
-from enum import Enum
+from exercise_pool import ExercisePool
+import asyncio
+import logging
+import metrics
+import model_client
+import os
+import threading
+import time
+from scheduler import INTERACTIVE, Overloaded, mark
+from session_store import SessionRecord, State, new_session_id, session_store_from_env
+from topic_index import TopicIndex
+
+logger = logging.getLogger(__name__)
+
+
+# Maps the dropdown choices to the task types used by app_integration.
+TASK_TYPES = {
+    "Fill in the Blank": "fill_in_the_blank",
+    "Q&A": "q_and_a",
+    "Conversation": "conversation",
+    "Vocabulary Matching": "vocabulary_matching",
+}
 
+TASK_TITLES = {
+    "Fill in the Blank": "--- Fill-in-the-Blank Task ---",
+    "Q&A": "--- Q&A Task ---",
+    "Conversation": "--- Conversation Task ---",
+    "Vocabulary Matching": "--- Vocabulary Matching Task ---",
+}
 
-class State(Enum):
-    SEND_INITIAL_MESSAGE = 0
-    SEND_RESPONSE_TO_USER = 1
-    IN_CONVERSATION = 2
-    STANDBY = 3
+# Secret the browser-held session ID is encrypted with; set it to the same value on every worker
+# that serves the app, otherwise each process generates its own and can't read the others' IDs.
+SESSION_SECRET = os.getenv("CHATTERBOT_SESSION_SECRET")
 
+# Whether main() warms up connections and the exercise pool before launching, and for how long at most.
+WARM_UP = os.getenv("CHATTERBOT_WARM_UP", "1") == "1"
+WARM_UP_TIMEOUT = float(os.getenv("CHATTERBOT_WARM_UP_TIMEOUT", "30"))
 
-def predict(message, history, session, type, state, task):
+# Background services, created by init_services().
+topic_index = None
+exercise_pool = None
+session_store = None
+_services_lock = threading.Lock()
+# Solutions being worked out in the background; referenced so the tasks aren't garbage collected.
+speculations = set()
+
+# Shown when the learner's model call was shed under overload, instead of making them wait.
+BUSY_MESSAGE = "The tutor is busy right now. Please try again in a moment."
+NO_TASK_MESSAGE = "No task could be created. Please start a new session."
+
+
+def init_services():
     """
-    Main prediction function, runs when user sends a new message.
+    Creates the topic index, the exercise pool and the session store, once per process.
+    """
+    global topic_index, exercise_pool, session_store
+    with _services_lock:
+        if exercise_pool is not None:
+            return
+        # Exercises are generated ahead of time so most sessions start without waiting on the model.
+        # Similar topics are mapped to one canonical topic, so they share the pre-generated exercises.
+        topic_index = TopicIndex()
+        exercise_pool = ExercisePool(topics=topic_index).start()
+        exercise_pool.prefill(TASK_TYPES.values(), [""])
+        # Sessions live server-side; the browser only keeps the session ID.
+        session_store = session_store_from_env()
+        metrics.registry.register_collector("exercise_pool", exercise_pool.stats)
+        metrics.registry.register_collector("topic_index", topic_index.stats)
+        metrics.registry.register_collector("response_cache", response_cache.stats)
+        metrics.registry.register_collector("sessions", session_store.stats)
+        metrics.registry.register_collector("coalescing", request_flights.stats)
+        metrics.registry.register_collector("coalescing_async", async_request_flights.stats)
+        metrics.registry.register_collector("model_router", model_router.stats)
+        metrics.registry.register_collector("scheduler", model_client.scheduler.stats)
+        if "local" in model_router.tiers:
+            metrics.registry.register_collector("local_backend", model_router.tiers["local"].backend.stats)
+
+
+def warm_up(timeout=WARM_UP_TIMEOUT):
+    """
+    Opens the first API connection, loads the local model if there is one and waits until the
+    exercise pool has an exercise of every type on the random topic, at most timeout seconds.
+    Returns the seconds spent.
+    """
+    started = time.perf_counter()
+    init_services()
+    model_client.warm_up(timeout)
+    if "local" in model_router.tiers:
+        try:
+            model_router.tiers["local"].backend.load()
+        except Exception:
+            logger.warning("Loading the local model failed, its tier will fail over", exc_info=True)
+    remaining = max(0.0, timeout - (time.perf_counter() - started))
+    if not exercise_pool.wait_ready(TASK_TYPES.values(), [""], timeout=remaining):
+        logger.warning("Exercise pool not filled after warming up for %.0fs, starting anyway", timeout)
+    return time.perf_counter() - started
+
+
+def speculate_solution(session_id, exercise):
+    """
+    Starts working out the reference solution of an exercise that has none while the learner is
+    still reading it, and stores it with the session's task. Answering it can then be graded
+    locally, or with a short feedback prompt; an answer sent before the solution is known shares
+    the request in flight, so it keeps the session's interactive priority.
     """
-    if state == State.SEND_RESPONSE_TO_USER:
-        if type == "Fill in the Blank":
-            return {"role": "assistant",
-                    "content": verify_answer("fill_in_the_blank", task, message)}, State.STANDBY, None
-        elif type == "Q&A":
-            return {"role": "assistant",
-                    "content": verify_answer("q_and_a", task, message)}, State.STANDBY, None
-        elif type == "Vocabulary Matching":
-            return {"role": "assistant",
-                    "content": verify_answer("vocabulary_matching", task, message)}, State.STANDBY, None
-    elif state == State.IN_CONVERSATION:
-        response, wants_to_continue = advance_conversation(message, history)
+    if exercise is None or exercise.has_reference() or exercise.task_type not in SOLUTION_FORMATS:
+        return
+    metrics.registry.increment("speculative_solutions", f"{exercise.task_type}.solve")
+    task = asyncio.ensure_future(solve_exercise_async(exercise))
+    speculations.add(task)
+
+    def store(task):
+        speculations.discard(task)
+        if task.cancelled() or not task.result().has_reference():
+            return
+        record = session_store.get(session_id)
+        if record is None or record.task is None or record.task.text != exercise.text or record.task.has_reference():
+            return
+        record.task = task.result()
+        session_store.put(record)
+
+    task.add_done_callback(store)
+
+
+async def answer(record, message, previous, type):
+    """
+    Yields the reply to the learner's message as it is streamed from the model, and moves the
+    session on to its next state.
+    """
+    if record.state == State.SEND_RESPONSE_TO_USER and record.task is not None and type in [
+            "Fill in the Blank", "Q&A", "Vocabulary Matching"]:
+        async for reply in stream_check_answer_async(record.task, message):
+            yield reply
+        record.state, record.task = State.STANDBY, None
+    elif record.state == State.IN_CONVERSATION:
+        wants_to_continue = True
+        async for reply, wants_to_continue in stream_advance_conversation_async(message, previous):
+            yield reply
         if not wants_to_continue:
-            return {"role": "assistant", "content": response}, State.STANDBY, None
-        else:
-            return {"role": "assistant", "content": response}, State.IN_CONVERSATION, None
-    elif state == State.STANDBY:
-        return {"role": "assistant",
-                "content": "To continue, click the 'start a new session' button."}, State.STANDBY, None
+            record.state = State.STANDBY
+    elif record.state == State.STANDBY:
+        yield "To continue, click the 'start a new session' button."
+    else:
+        yield "An internal error has occurred. Please try again later."
 
-    return {"role": "assistant", "content": "An internal error has occurred. Please try again later."}
+
+async def predict(message, history, session, type, session_id):
+    """
+    Main prediction function, runs when user sends a new message.
+    Yields the assistant's message as it is streamed from the model. The session's state, the
+    exercise being answered and the chat history are loaded from the session store; correct
+    answers to exercises with a known solution are graded locally. When the model call is shed
+    under overload, the learner is asked to try again and the session is left as it was.
+    """
+    mark(INTERACTIVE, session_id)
+    record = session_store.get(session_id) if session_id else None
+    if record is None:
+        yield {"role": "assistant",
+               "content": "Your session has expired. To continue, click the 'start a new session' button."}
+        return
+    previous = list(record.history)
+    reply = ""
+    try:
+        async for reply in answer(record, message, previous, type):
+            yield {"role": "assistant", "content": reply}
+    except Overloaded as e:
+        logger.warning("Shed the reply to session %s: %s", session_id, e)
+        yield {"role": "assistant", "content": BUSY_MESSAGE}
+        return
+    # The turn is only recorded once it succeeded; the store may hand out the live record.
+    record.append({"role": "user", "content": message}, {"role": "assistant", "content": reply})
+    session_store.put(record)
 
 
-def reset(session, type):
+async def reset(session, type, session_id):
     """
     Runs on start of new session to reset chat history.
+    Uses a pre-generated task when the pool has one, otherwise yields the chat history while
+    the new task is streamed in; the session only leaves standby once the task is complete. The
+    pool is looked up by the topic's canonical key, but a new task is generated from the
+    learner's own words.
     """
-    if type == "Fill in the Blank":
-        task_description = {"role": "assistant",
-                            "content": f"--- Fill-in-the-Blank Task ---\n{initiate_fill_in_blank(session)}"}
-        new_state = State.SEND_RESPONSE_TO_USER
-    elif type == "Q&A":
-        task_description = {"role": "assistant", "content": f"--- Q&A Task ---\n{initiate_q_and_a(session)}"}
-        new_state = State.SEND_RESPONSE_TO_USER
-    elif type == "Conversation":
-        task_description = {"role": "assistant",
-                            "content": f"--- Conversation Task ---\n{initiate_conversation(session)}"}
-        new_state = State.IN_CONVERSATION
-    elif type == "Vocabulary Matching":
-        task_description = {"role": "assistant",
-                            "content": f"--- Vocabulary Matching Task ---\n{initiate_vocabulary_matching(session)}"}
-        new_state = State.SEND_RESPONSE_TO_USER
-    history = [task_description]
-    return gr.update(value="Start a New Session"), history, history, gr.update(
-        visible=True), new_state, task_description
+    import gradio as gr
+    session_id = session_id or new_session_id()
+    mark(INTERACTIVE, session_id)
+    title = TASK_TITLES[type]
+    new_state = State.IN_CONVERSATION if type == "Conversation" else State.SEND_RESPONSE_TO_USER
+    exercise = exercise_pool.pop(TASK_TYPES[type], session)
+    if exercise is not None:
+        history = [{"role": "assistant", "content": f"{title}\n{exercise.text}"}]
+        session_store.put(SessionRecord(session_id, new_state, exercise, history))
+        speculate_solution(session_id, exercise)
+        yield gr.update(value="Start a New Session"), history, history, gr.update(visible=True), session_id
+        return
+    history = [{"role": "assistant", "content": title}]
+    session_store.put(SessionRecord(session_id, State.STANDBY, None, history))
+    yield gr.update(value="Start a New Session"), history, history, gr.update(visible=True), session_id
+    exercise = None
+    try:
+        async for exercise in stream_initiate_async(TASK_TYPES[type], session):
+            history = [{"role": "assistant", "content": f"{title}\n{exercise.text}"}]
+            yield gr.update(value="Start a New Session"), history, history, gr.update(visible=True), session_id
+    except Overloaded as e:
+        logger.warning("Shed the new task of session %s: %s", session_id, e)
+        history = [{"role": "assistant", "content": f"{title}\n{BUSY_MESSAGE}"}]
+        session_store.put(SessionRecord(session_id, State.STANDBY, None, history))
+        yield gr.update(value="Start a New Session"), history, history, gr.update(visible=True), session_id
+        return
+    if exercise is None or not exercise.text:
+        logger.warning("No task was generated for session %s", session_id)
+        history = [{"role": "assistant", "content": f"{title}\n{NO_TASK_MESSAGE}"}]
+        session_store.put(SessionRecord(session_id, State.STANDBY, None, history))
+        yield gr.update(value="Start a New Session"), history, history, gr.update(visible=True), session_id
+        return
+    session_store.put(SessionRecord(session_id, new_state, exercise, history))
+    speculate_solution(session_id, exercise)
+    yield gr.update(value="Start a New Session"), history, history, gr.update(visible=True), session_id
+
+
+def restore(session_id):
+    """
+    Runs on page load: shows the chat of the learner's stored session, if it is still alive.
+    """
+    import gradio as gr
+    record = session_store.get(session_id) if session_id else None
+    if record is None or not record.history:
+        return [], [], gr.update(visible=False)
+    return record.history, record.history, gr.update(visible=True)
 
 
 CSS = """
@@ -68,36 +244,57 @@ CSS = """
     #start_btn:hover { background-color: #124BDB; color: #FFFFFF }
     """
 
-with gr.Blocks(css=CSS) as demo:
-    with gr.Row():
-        gr.Image("logo-sized.jpeg",
-                 container=False,
-                 height="175px",
-                 show_label=False,
-                 show_fullscreen_button=False,
-                 show_download_button=False,
-                 show_share_button=False,
-                 scale=0)
-        with gr.Column():
-            input_session = gr.Textbox(label="What do you want to learn about today?",
-                                       placeholder="Type here or leave blank to chose a random topic")
-            input_type = gr.Dropdown(["Fill in the Blank", "Q&A", "Conversation", "Vocabulary Matching"],
-                                     label="How do you want to practice?")
-        start_btn = gr.Button("Start Session", scale=0, elem_id="start_btn")
-
-    current_state = gr.State()
-    current_task_description = gr.State()
-    bot = gr.Chatbot(type="messages", render=False, show_label=False)
-    with gr.Row(visible=False) as row:
-        chat = gr.ChatInterface(fn=predict,
-                                type="messages",
-                                chatbot=bot,
-                                additional_inputs=[input_session, input_type, current_state, current_task_description],
-                                additional_outputs=[current_state, current_task_description],
-                                autofocus=True
-                                )
-        reset_inputs = [input_session, input_type]
-        reset_outputs = [start_btn, bot, chat.chatbot_state, row, current_state, current_task_description]
-        input_session.submit(fn=reset, inputs=reset_inputs, outputs=reset_outputs)
-        start_btn.click(fn=reset, inputs=reset_inputs, outputs=reset_outputs)
-demo.launch()
+
+def create_app():
+    """
+    Starts the background services and builds the Gradio UI. Call launch() on the result.
+    """
+    import gradio as gr
+    init_services()
+    with gr.Blocks(css=CSS) as demo:
+        with gr.Row():
+            gr.Image(os.path.join(os.path.dirname(os.path.abspath(__file__)), "logo-sized.jpeg"),
+                     container=False,
+                     height="175px",
+                     show_label=False,
+                     show_fullscreen_button=False,
+                     show_download_button=False,
+                     show_share_button=False,
+                     scale=0)
+            with gr.Column():
+                input_session = gr.Textbox(label="What do you want to learn about today?",
+                                           placeholder="Type here or leave blank to chose a random topic")
+                input_type = gr.Dropdown(["Fill in the Blank", "Q&A", "Conversation", "Vocabulary Matching"],
+                                         label="How do you want to practice?")
+            start_btn = gr.Button("Start Session", scale=0, elem_id="start_btn")
+
+        session_id = gr.BrowserState(storage_key="chatterbot_session", secret=SESSION_SECRET)
+        bot = gr.Chatbot(type="messages", render=False, show_label=False)
+        with gr.Row(visible=False) as row:
+            chat = gr.ChatInterface(fn=predict,
+                                    type="messages",
+                                    chatbot=bot,
+                                    additional_inputs=[input_session, input_type, session_id],
+                                    autofocus=True
+                                    )
+            reset_inputs = [input_session, input_type, session_id]
+            reset_outputs = [start_btn, bot, chat.chatbot_state, row, session_id]
+            input_session.submit(fn=reset, inputs=reset_inputs, outputs=reset_outputs)
+            start_btn.click(fn=reset, inputs=reset_inputs, outputs=reset_outputs)
+        demo.load(fn=restore, inputs=[session_id], outputs=[bot, chat.chatbot_state, row])
+    return demo
+
+
+def main():
+    demo = create_app()
+    if WARM_UP:
+        print(f"Warmed up in {warm_up():.1f}s.")
+    # Handlers are async, so one process can serve as many sessions at once as the client allows.
+    demo.queue(default_concurrency_limit=MAX_CONCURRENT_REQUESTS)
+    if metrics.METRICS_PORT:
+        metrics.start_http_server(metrics.METRICS_PORT)
+    demo.launch()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,26 +4,211 @@ app_integration.py
 Example snippet showing how to integrate usage.py with an existing UI framework.
 """
 
-from openai import OpenAI
+from coalesce import AsyncSingleFlight, SingleFlight
+from conversation_memory import ConversationMemory
+from exercises import SOLUTION_INSTRUCTIONS, SOLUTION_MARKER, parse_exercise
+from grading import grade
+from model_router import ModelRouter
+from response_cache import ResponseCache, cache_key
+import logging
+import metrics
 import os
+import scheduler
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+logger = logging.getLogger(__name__)
+
+# Maximum number of handlers the app runs at once, shared by all sessions. Their model calls are
+# admitted by the scheduler in model_client, which bounds the calls in flight.
+MAX_CONCURRENT_REQUESTS = int(os.getenv("CHATTERBOT_MAX_CONCURRENT_REQUESTS", "256"))
 
 # Replace with your actual fine-tuned chat model name.
 FINE_TUNED_MODEL = "ft:gpt-4o-mini-2024-07-18:personal::BFT1H34c"
 
+# Picks the model tier of every call and hedges slow ones; the fine-tuned model is the default tier.
+model_router = ModelRouter.from_env(FINE_TUNED_MODEL)
+
+# Cache for responses to deterministic prompts, such as answer verification.
+response_cache = ResponseCache.from_env()
+
+# Identical requests sent while one is in flight share its response. Calls sampled at a higher
+# temperature than this are sent on their own, as they are expected to return different samples.
+COALESCE_MAX_TEMPERATURE = float(os.getenv("CHATTERBOT_COALESCE_MAX_TEMPERATURE", "0.8"))
+request_flights = SingleFlight()
+async_request_flights = AsyncSingleFlight()
+
+# Keeps conversation prompts within a token budget however long the conversation gets.
+conversation_memory = ConversationMemory()
+
+# Output budget of the feedback on a wrong answer to an exercise whose solution is known.
+FEEDBACK_MAX_TOKENS = int(os.getenv("CHATTERBOT_FEEDBACK_MAX_TOKENS", "120"))
+
+CONVERSATION_SYSTEM_PROMPT = "You are a friendly French tutor. You will remind your student to use French if they try speaking in a different language."
 
-def generate_chat_response(messages, max_tokens=150, temperature=0.7):
+
+def response_cache_key(cache, messages, max_tokens, temperature):
+    """
+    Returns the cache key of a request, covering the messages and every sampling parameter.
+    """
+    return cache.key(messages, model=FINE_TUNED_MODEL, max_tokens=max_tokens, temperature=temperature, top_p=1.0)
+
+
+def flight_key(messages, max_tokens, temperature, **params):
+    """
+    Returns the key identical in-flight requests are coalesced under.
+    """
+    return cache_key(messages, model=FINE_TUNED_MODEL, max_tokens=max_tokens, temperature=temperature, top_p=1.0,
+                     **params)
+
+
+def should_coalesce(coalesce, temperature):
+    return temperature <= COALESCE_MAX_TEMPERATURE if coalesce is None else coalesce
+
+
+def lookup_cache(cache, task, messages, max_tokens, temperature):
+    """
+    Returns (key, cached_response) and records the hit or miss under task.
+    """
+    key = response_cache_key(cache, messages, max_tokens, temperature)
+    cached = cache.get(key)
+    metrics.registry.observe_cache(task, cached is not None)
+    return key, cached
+
+
+def generate_chat_response(messages, max_tokens=150, temperature=0.7, cache=None, response_format=None, task=None,
+                           coalesce=None):
     """
     Sends a list of chat messages to the ChatCompletion endpoint.
     Returns the assistant's message content.
+    If a cache is given, a cached response is returned when there is one and new responses are stored.
+    response_format is passed through to the endpoint, e.g. {"type": "json_object"} for JSON mode.
+    task labels the call in the metrics, e.g. "q_and_a.verify".
+    coalesce: whether to share the response of an identical request already in flight. Defaults to
+    coalescing up to COALESCE_MAX_TEMPERATURE; pass False when every call needs its own sample.
+    """
+    if cache is not None:
+        key, cached = lookup_cache(cache, task, messages, max_tokens, temperature)
+        if cached is not None:
+            return cached
+    extra = {"response_format": response_format} if response_format else {}
+
+    def call():
+        response = model_router.create_chat_completion(messages=messages,
+                                                       max_tokens=max_tokens,
+                                                       temperature=temperature,
+                                                       top_p=1.0,
+                                                       task=task,
+                                                       **extra)
+        content = response.choices[0].message.content.strip()
+        if cache is not None:
+            cache.set(key, content)
+        return content
+
+    if not should_coalesce(coalesce, temperature):
+        return call()
+    return request_flights.do(flight_key(messages, max_tokens, temperature, **extra), call, task)
+
+
+def stream_chat_response(messages, max_tokens=150, temperature=0.7, cache=None, task=None, coalesce=None):
+    """
+    Streaming variant of generate_chat_response.
+    Yields the assistant's message content accumulated so far every time a new chunk arrives,
+    so the caller can redraw the partial message as it grows. A cache hit is yielded in one piece.
+    A caller joining an identical stream already in flight may skip the chunks sent before it joined.
     """
-    response = client.chat.completions.create(model=FINE_TUNED_MODEL,
-                                              messages=messages,
-                                              max_tokens=max_tokens,
-                                              temperature=temperature,
-                                              top_p=1.0)
-    return response.choices[0].message.content.strip()
+    if cache is not None:
+        key, cached = lookup_cache(cache, task, messages, max_tokens, temperature)
+        if cached is not None:
+            yield cached
+            return
+
+    def open_stream():
+        stream = model_router.create_chat_completion(messages=messages,
+                                                     max_tokens=max_tokens,
+                                                     temperature=temperature,
+                                                     top_p=1.0,
+                                                     stream=True,
+                                                     stream_options={"include_usage": True},
+                                                     task=task)
+        text = ""
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                text += delta
+                yield text.strip()
+        if cache is not None and text.strip():
+            cache.set(key, text.strip())
+
+    if not should_coalesce(coalesce, temperature):
+        yield from open_stream()
+        return
+    yield from request_flights.stream(flight_key(messages, max_tokens, temperature, stream=True), open_stream, task)
+
+
+async def generate_chat_response_async(messages, max_tokens=150, temperature=0.7, cache=None, task=None,
+                                       coalesce=None):
+    """
+    Asyncio variant of generate_chat_response backed by the shared AsyncOpenAI client.
+    """
+    if cache is not None:
+        key, cached = lookup_cache(cache, task, messages, max_tokens, temperature)
+        if cached is not None:
+            return cached
+
+    async def call():
+        response = await model_router.create_chat_completion_async(messages=messages,
+                                                                   max_tokens=max_tokens,
+                                                                   temperature=temperature,
+                                                                   top_p=1.0,
+                                                                   task=task)
+        content = response.choices[0].message.content.strip()
+        if cache is not None:
+            cache.set(key, content)
+        return content
+
+    if not should_coalesce(coalesce, temperature):
+        return await call()
+    return await async_request_flights.do(flight_key(messages, max_tokens, temperature), call, task)
+
+
+async def stream_chat_response_async(messages, max_tokens=150, temperature=0.7, cache=None, task=None,
+                                     coalesce=None):
+    """
+    Asyncio variant of stream_chat_response.
+    """
+    if cache is not None:
+        key, cached = lookup_cache(cache, task, messages, max_tokens, temperature)
+        if cached is not None:
+            yield cached
+            return
+
+    async def open_stream():
+        stream = await model_router.create_chat_completion_async(messages=messages,
+                                                                 max_tokens=max_tokens,
+                                                                 temperature=temperature,
+                                                                 top_p=1.0,
+                                                                 stream=True,
+                                                                 stream_options={"include_usage": True},
+                                                                 task=task)
+        text = ""
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                text += delta
+                yield text.strip()
+        if cache is not None and text.strip():
+            cache.set(key, text.strip())
+
+    if not should_coalesce(coalesce, temperature):
+        partials = open_stream()
+    else:
+        partials = async_request_flights.stream(flight_key(messages, max_tokens, temperature, stream=True),
+                                                open_stream, task)
+    async for partial in partials:
+        yield partial
 
 
 def get_user_input():
@@ -68,10 +253,9 @@ def display_output(text):
     print("----------------------\n")
 
 
-def verify_answer(task_type, original_task, user_answer):
+def verification_messages(task_type, original_task, user_answer):
     """
-    Verifies the user's answer by sending both the original task and the user's answer
-    to the model, asking for feedback on correctness.
+    Builds the chat messages asking the model for feedback on the user's answer.
     """
     if task_type == "fill_in_the_blank":
         prompt = (
@@ -97,68 +281,243 @@ def verify_answer(task_type, original_task, user_answer):
     else:
         prompt = f"User input: {user_answer}\nProvide feedback."
 
-    messages = [
+    return [
         {"role": "system", "content": "You are a French language tutor who provides detailed feedback."},
         {"role": "user", "content": prompt}
     ]
-    feedback = generate_chat_response(messages, max_tokens=200)
+
+
+# What the model is asked to write after the solution marker when solving an exercise.
+SOLUTION_FORMATS = {
+    "fill_in_the_blank": "the word or words that fill the blank",
+    "q_and_a": "the one-word answer",
+    "vocabulary_matching": "the correct pairs in the form french=english, separated by semicolons",
+}
+
+
+TASK_NAMES = {"fill_in_the_blank": "Fill in the blank", "q_and_a": "Q&A", "vocabulary_matching": "Vocabulary Matching"}
+
+
+def solution_messages(exercise):
+    """
+    Builds the chat messages asking the model for the reference solution of an exercise.
+    """
+    return [
+        {"role": "system", "content": "You are a French language tutor who solves exercises exactly."},
+        {"role": "user",
+         "content": f"Solve this exercise:\n{exercise.text}\nReply with a single line: '{SOLUTION_MARKER}' followed by "
+                    f"{SOLUTION_FORMATS[exercise.task_type]}."}
+    ]
+
+
+def feedback_messages(exercise, user_answer, result):
+    """
+    Builds the chat messages asking for short feedback on an answer already graded wrong locally.
+    The reference solution and the learner's mistakes are given, so the model only has to explain them.
+    """
+    if exercise.task_type == "vocabulary_matching":
+        mistakes = "\n".join(f"- {french}: the learner answered {answered or 'nothing'}, correct answer: {english}"
+                              for french, english, answered in result.mistakes)
+        prompt = (f"Task: Vocabulary Matching (French).\nExercise: {exercise.text}\n"
+                  f"The learner's matches for these words differ from the reference:\n{mistakes}\n"
+                  "If one of the learner's answers is also acceptable, say so. Otherwise give the correct "
+                  "answer and briefly explain the mistake.")
+    else:
+        prompt = (f"Task: {TASK_NAMES[exercise.task_type]} (French).\nExercise: {exercise.text}\n"
+                  f"Correct answer: {exercise.answer}\nUser's answer: {user_answer}\n"
+                  "If the user's answer is also acceptable, say so. Otherwise explain the mistake briefly.")
+    return [
+        {"role": "system", "content": "You are a French language tutor who gives short, encouraging feedback."},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def with_solution(exercise, content):
+    """
+    Returns a copy of exercise carrying the solution parsed from the model's reply, if there is one.
+    """
+    solved = parse_exercise(exercise.task_type, f"{exercise.text}\n{content}", topic=exercise.topic)
+    solved.text = exercise.text
+    return solved
+
+
+def solve_exercise(exercise):
+    """
+    Returns the exercise with its reference solution, asking the model for it if it has none.
+    Solutions are deterministic and cached, so a solution computed ahead of time is reused here.
+    The exercise is returned unchanged if it can't be solved.
+    """
+    if exercise.has_reference() or exercise.task_type not in SOLUTION_FORMATS:
+        return exercise
+    try:
+        content = generate_chat_response(solution_messages(exercise), max_tokens=60, temperature=0.0,
+                                         cache=response_cache, task=f"{exercise.task_type}.solve")
+    except Exception:
+        logger.warning("Solving a %s exercise failed", exercise.task_type, exc_info=True)
+        return exercise
+    return with_solution(exercise, content)
+
+
+def verify_answer(task_type, original_task, user_answer):
+    """
+    Verifies the user's answer by sending both the original task and the user's answer
+    to the model, asking for feedback on correctness.
+    """
+    feedback = generate_chat_response(verification_messages(task_type, original_task, user_answer), max_tokens=200,
+                                      cache=response_cache, task=f"{task_type}.verify")
     return feedback
 
 
-def initiate_fill_in_blank(topic):
+def stream_verify_answer(task_type, original_task, user_answer):
     """
-    Generates a fill-in-the-blank exercise in French.
+    Streaming variant of verify_answer, yields the feedback as it is generated.
+    """
+    yield from stream_chat_response(verification_messages(task_type, original_task, user_answer), max_tokens=200,
+                                    cache=response_cache, task=f"{task_type}.verify")
+
+
+def check_answer(exercise, user_answer):
+    """
+    Grades the user's answer locally against the exercise's reference solution, which is worked
+    out first if the exercise has none. The model is only asked for short feedback when the answer
+    is wrong, and for a full verification when the answer can't be graded locally.
     """
-    messages = [
+    exercise = solve_exercise(exercise)
+    result = grade(exercise, user_answer)
+    if result.correct:
+        return result.feedback
+    if result.correct is False:
+        return generate_chat_response(feedback_messages(exercise, user_answer, result),
+                                      max_tokens=FEEDBACK_MAX_TOKENS, cache=response_cache,
+                                      task=f"{exercise.task_type}.verify")
+    return verify_answer(exercise.task_type, exercise.text, user_answer)
+
+
+def stream_check_answer(exercise, user_answer):
+    """
+    Streaming variant of check_answer.
+    """
+    exercise = solve_exercise(exercise)
+    result = grade(exercise, user_answer)
+    if result.correct:
+        yield result.feedback
+        return
+    if result.correct is False:
+        yield from stream_chat_response(feedback_messages(exercise, user_answer, result),
+                                        max_tokens=FEEDBACK_MAX_TOKENS, cache=response_cache,
+                                        task=f"{exercise.task_type}.verify")
+        return
+    yield from stream_verify_answer(exercise.task_type, exercise.text, user_answer)
+
+
+def fill_in_blank_messages(topic):
+    """
+    Builds the chat messages requesting a fill-in-the-blank exercise.
+    """
+    return [
         {"role": "system",
          "content": "You are a creative French language tutor who generates fill-in-the-blank exercises. Do not reveal the correct answer."},
         {"role": "user",
          "content": f"Generate a French fill-in-the-blank exercise on the topic of {topic} with one blank. Do not reveal the answer."}
     ]
-    task = generate_chat_response(messages)
-    return task
 
 
-def initiate_q_and_a(topic):
+def q_and_a_messages(topic):
     """
-    Generates an initial Q&A question in French.
+    Builds the chat messages requesting a Q&A question.
     """
-    messages = [
+    return [
         {"role": "system", "content": "You are a French language tutor who generates engaging Q&A questions."},
         {"role": "user",
-         "content": f"Ask a simple French question about {topic} to your student. The question should have a one-word answer. Do not reveal the answer."}
+         "content": f"Ask a simple French question about {topic} to your student. The question should have a one-word answer. Do not reveal the answer in the question. {SOLUTION_INSTRUCTIONS['q_and_a']}"}
     ]
-    task = generate_chat_response(messages)
-    return task
 
 
-def initiate_conversation(topic):
+def conversation_messages(topic):
     """
-    Generates a conversation starter or scene context in French.
+    Builds the chat messages requesting a conversation starter.
     """
-    messages = [
+    return [
         {"role": "system", "content": "You are a friendly French tutor that only speaks French."},
         {"role": "user",
          "content": f"Start a conversation in French on the topic of {topic} by providing a conversation starter or context. Always respond in French. In the event that the student responds in another language, remind them to speak in French only."}
     ]
-    starter = generate_chat_response(messages)
-    return starter
 
 
-def initiate_vocabulary_matching(topic):
+def vocabulary_matching_messages(topic):
     """
-    Generates a vocabulary matching exercise in French.
+    Builds the chat messages requesting a vocabulary matching exercise.
     """
-    messages = [
+    return [
         {"role": "system",
          "content": "You are a creative French language tutor who generates vocabulary matching exercises."},
         {"role": "user",
-         "content": f"Generate a vocabulary matching exercise in French on the topic of {topic}. Provide a list of 5 French words and an out-of-order list of English translations. Do not reveal the correct matches."}
+         "content": f"Generate a vocabulary matching exercise in French on the topic of {topic}. Provide a list of 5 French words and an out-of-order list of English translations. Do not reveal the correct matches in the exercise. {SOLUTION_INSTRUCTIONS['vocabulary_matching']}"}
     ]
-    task = generate_chat_response(messages)
+
+
+# Message builders for every task type, used by the streaming and batch entry points.
+EXERCISE_MESSAGES = {
+    "fill_in_the_blank": fill_in_blank_messages,
+    "q_and_a": q_and_a_messages,
+    "conversation": conversation_messages,
+    "vocabulary_matching": vocabulary_matching_messages,
+}
+
+
+def generate_exercise(task_type, topic, coalesce=None):
+    """
+    Generates an exercise of the given task type and returns it as an Exercise, with the
+    reference solution split off the text shown to the learner.
+    Learners asking for the same exercise at the same time share one unless coalesce is False.
+    """
+    return parse_exercise(task_type,
+                          generate_chat_response(EXERCISE_MESSAGES[task_type](topic), task=f"{task_type}.generate",
+                                                 coalesce=coalesce),
+                          topic=topic)
+
+
+def initiate_fill_in_blank(topic):
+    """
+    Generates a fill-in-the-blank exercise in French.
+    """
+    task = generate_chat_response(fill_in_blank_messages(topic), task="fill_in_the_blank.generate")
+    return task
+
+
+def initiate_q_and_a(topic):
+    """
+    Generates an initial Q&A question in French.
+    """
+    task = generate_exercise("q_and_a", topic).text
     return task
 
 
+def initiate_conversation(topic):
+    """
+    Generates a conversation starter or scene context in French.
+    """
+    starter = generate_chat_response(conversation_messages(topic), task="conversation.generate")
+    return starter
+
+
+def initiate_vocabulary_matching(topic):
+    """
+    Generates a vocabulary matching exercise in French.
+    """
+    task = generate_exercise("vocabulary_matching", topic).text
+    return task
+
+
+def stream_initiate(task_type, topic):
+    """
+    Streams a new exercise (or conversation starter) of the given task type as it is generated.
+    Yields an Exercise for every chunk; the last one carries the reference solution, if any.
+    """
+    for partial in stream_chat_response(EXERCISE_MESSAGES[task_type](topic), task=f"{task_type}.generate"):
+        yield parse_exercise(task_type, partial, topic=topic)
+
+
 def conversation_loop(initial_context=None):
     """
     Maintains a conversation until the user chooses to quit.
@@ -176,22 +535,181 @@ def conversation_loop(initial_context=None):
             print("Ending conversation.")
             break
         conversation_history.append({"role": "user", "content": user_input})
-        response = generate_chat_response(conversation_history)
+        messages, report = conversation_memory.build_messages(None, conversation_history)
+        response = generate_chat_response(messages, task="conversation.turn")
         conversation_history.append({"role": "assistant", "content": response})
         print("Bot:", response)
+        print(f"(prompt: {report['prompt_tokens']} tokens, {report['summarized_messages']} earlier messages summarized)")
+
+
+def conversation_turn_messages(message, history):
+    """
+    Builds the chat messages for the next conversation turn from the Gradio history.
+    Older turns are summarized so the prompt stays within the conversation memory's token budget.
+    """
+    messages, report = conversation_memory.build_messages(CONVERSATION_SYSTEM_PROMPT,
+                                                          list(history) + [{"role": "user", "content": message}])
+    logger.info("Conversation turn prompt: %d tokens (%d verbatim, %d summarized, full history %d tokens)",
+                report["prompt_tokens"], report["verbatim_messages"], report["summarized_messages"],
+                report["history_tokens"])
+    return messages
 
 
 def advance_conversation(message, history):
     if message.lower() in ["quit", "exit"]:
         return "Ending conversation", False
-    chat_history = [{"role": "system",
-                     "content": "You are a friendly French tutor. You will remind your student to use French if they try speaking in a different language."}]
-    chat_history.extend(history)
-    chat_history.append({"role": "user", "content": message})
-    return generate_chat_response(chat_history), True
+    return generate_chat_response(conversation_turn_messages(message, history), task="conversation.turn"), True
+
+
+def stream_advance_conversation(message, history):
+    """
+    Streaming variant of advance_conversation, yields (partial_response, wants_to_continue) tuples.
+    """
+    if message.lower() in ["quit", "exit"]:
+        yield "Ending conversation", False
+        return
+    for partial in stream_chat_response(conversation_turn_messages(message, history), task="conversation.turn"):
+        yield partial, True
+
+
+async def verify_answer_async(task_type, original_task, user_answer):
+    """
+    Asyncio variant of verify_answer.
+    """
+    return await generate_chat_response_async(verification_messages(task_type, original_task, user_answer),
+                                              max_tokens=200, cache=response_cache, task=f"{task_type}.verify")
+
+
+async def stream_verify_answer_async(task_type, original_task, user_answer):
+    """
+    Asyncio variant of stream_verify_answer.
+    """
+    async for partial in stream_chat_response_async(verification_messages(task_type, original_task, user_answer),
+                                                    max_tokens=200, cache=response_cache,
+                                                    task=f"{task_type}.verify"):
+        yield partial
+
+
+async def solve_exercise_async(exercise):
+    """
+    Asyncio variant of solve_exercise. A call made while the same exercise is being solved, e.g.
+    speculatively after it was shown, shares that request.
+    """
+    if exercise.has_reference() or exercise.task_type not in SOLUTION_FORMATS:
+        return exercise
+    try:
+        content = await generate_chat_response_async(solution_messages(exercise), max_tokens=60, temperature=0.0,
+                                                     cache=response_cache, task=f"{exercise.task_type}.solve")
+    except Exception:
+        logger.warning("Solving a %s exercise failed", exercise.task_type, exc_info=True)
+        return exercise
+    return with_solution(exercise, content)
+
+
+async def check_answer_async(exercise, user_answer):
+    """
+    Asyncio variant of check_answer.
+    """
+    exercise = await solve_exercise_async(exercise)
+    result = grade(exercise, user_answer)
+    if result.correct:
+        return result.feedback
+    if result.correct is False:
+        return await generate_chat_response_async(feedback_messages(exercise, user_answer, result),
+                                                  max_tokens=FEEDBACK_MAX_TOKENS, cache=response_cache,
+                                                  task=f"{exercise.task_type}.verify")
+    return await verify_answer_async(exercise.task_type, exercise.text, user_answer)
+
+
+async def stream_check_answer_async(exercise, user_answer):
+    """
+    Asyncio variant of stream_check_answer.
+    """
+    exercise = await solve_exercise_async(exercise)
+    result = grade(exercise, user_answer)
+    if result.correct:
+        yield result.feedback
+        return
+    if result.correct is False:
+        partials = stream_chat_response_async(feedback_messages(exercise, user_answer, result),
+                                              max_tokens=FEEDBACK_MAX_TOKENS, cache=response_cache,
+                                              task=f"{exercise.task_type}.verify")
+    else:
+        partials = stream_verify_answer_async(exercise.task_type, exercise.text, user_answer)
+    async for partial in partials:
+        yield partial
+
+
+async def generate_exercise_async(task_type, topic):
+    """
+    Asyncio variant of generate_exercise.
+    """
+    return parse_exercise(task_type, await generate_chat_response_async(EXERCISE_MESSAGES[task_type](topic),
+                                                                        task=f"{task_type}.generate"),
+                          topic=topic)
+
+
+async def initiate_fill_in_blank_async(topic):
+    """
+    Asyncio variant of initiate_fill_in_blank.
+    """
+    return await generate_chat_response_async(fill_in_blank_messages(topic), task="fill_in_the_blank.generate")
+
+
+async def initiate_q_and_a_async(topic):
+    """
+    Asyncio variant of initiate_q_and_a.
+    """
+    return (await generate_exercise_async("q_and_a", topic)).text
+
+
+async def initiate_conversation_async(topic):
+    """
+    Asyncio variant of initiate_conversation.
+    """
+    return await generate_chat_response_async(conversation_messages(topic), task="conversation.generate")
+
+
+async def initiate_vocabulary_matching_async(topic):
+    """
+    Asyncio variant of initiate_vocabulary_matching.
+    """
+    return (await generate_exercise_async("vocabulary_matching", topic)).text
+
+
+async def stream_initiate_async(task_type, topic):
+    """
+    Asyncio variant of stream_initiate.
+    """
+    async for partial in stream_chat_response_async(EXERCISE_MESSAGES[task_type](topic), task=f"{task_type}.generate"):
+        yield parse_exercise(task_type, partial, topic=topic)
+
+
+async def advance_conversation_async(message, history):
+    """
+    Asyncio variant of advance_conversation.
+    """
+    if message.lower() in ["quit", "exit"]:
+        return "Ending conversation", False
+    return await generate_chat_response_async(conversation_turn_messages(message, history),
+                                              task="conversation.turn"), True
+
+
+async def stream_advance_conversation_async(message, history):
+    """
+    Asyncio variant of stream_advance_conversation.
+    """
+    if message.lower() in ["quit", "exit"]:
+        yield "Ending conversation", False
+        return
+    async for partial in stream_chat_response_async(conversation_turn_messages(message, history),
+                                                    task="conversation.turn"):
+        yield partial, True
 
 
 def main():
+    # The learner at the terminal waits on every call.
+    scheduler.mark(scheduler.INTERACTIVE)
     print("Welcome to the ChatterBot language learning interface!")
     while True:
         print("\nSelect an option:")
@@ -201,9 +719,11 @@ def main():
         print("4. Start a new Vocabulary Matching task")
         print("5. Exit")
         choice = input("Enter your choice (1-5): ").strip()
+        if choice in ["1", "2", "3", "4"]:
+            topic = input("Enter a topic (or leave blank for a random topic): ").strip()
 
         if choice == "1":
-            task = initiate_fill_in_blank()
+            task = initiate_fill_in_blank(topic)
             print("\n--- Fill-in-the-Blank Task ---")
             print(task)
             user_answer = input("Enter your answer: ").strip()
@@ -212,32 +732,33 @@ def main():
             print("-------------------------------")
 
         elif choice == "2":
-            task = initiate_q_and_a()
+            exercise = generate_exercise("q_and_a", topic)
             print("\n--- Q&A Task ---")
-            print("Question:", task)
+            print("Question:", exercise.text)
             user_answer = input("Your answer: ").strip()
-            feedback = verify_answer("q_and_a", task, user_answer)
+            feedback = check_answer(exercise, user_answer)
             print("Feedback:", feedback)
             print("----------------")
 
         elif choice == "3":
-            starter = initiate_conversation()
+            starter = initiate_conversation(topic)
             print("\n--- Conversation Starter ---")
             print(starter)
             print("-----------------------------")
             conversation_loop(initial_context=starter)
 
         elif choice == "4":
-            task = initiate_vocabulary_matching()
+            exercise = generate_exercise("vocabulary_matching", topic)
             print("\n--- Vocabulary Matching Task ---")
-            print(task)
+            print(exercise.text)
             user_answer = input("Enter your matching (format: frenchword: englishword, ...): ").strip()
-            feedback = verify_answer("vocabulary_matching", task, user_answer)
+            feedback = check_answer(exercise, user_answer)
             print("Feedback:", feedback)
             print("-------------------------------")
 
         elif choice == "5":
             print("Exiting the interface.")
+            metrics.dump_on_exit()
             break
         else:
             print("Invalid choice. Please select a valid option.")
@@ -0,0 +1,285 @@
+"""
+backends.py
+
+Inference backends the model router's tiers are served by.
+
+HostedBackend is the OpenAI-compatible API, reached through model_client. LocalCPUBackend runs a
+small chat model in-process on the CPU: it is loaded once per process and shared by every session,
+its linear layers are quantized to int8, and concurrent requests are decoded together in micro-
+batches by one worker thread. It needs no network, so it stands in for the API while it is down;
+listed in CHATTERBOT_MODEL_TIERS with "backend": "local", it can also serve cheap tasks such as
+grading or one-word Q&A generation.
+
+Both have the interface of model_client.create_chat_completion(_async) and return the same
+response types, so app_integration doesn't know which one answered. The local backend is enabled
+by setting CHATTERBOT_LOCAL_MODEL to a Hugging Face chat model, e.g. Qwen/Qwen2.5-0.5B-Instruct,
+which adds it to the router as a fallback tier; it needs torch and transformers, which are only
+imported when the model is loaded.
+"""
+
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+import metrics
+import model_client
+
+logger = logging.getLogger(__name__)
+
+# Hugging Face model run by the local backend; unset disables it.
+LOCAL_MODEL = os.getenv("CHATTERBOT_LOCAL_MODEL")
+# Most requests decoded together, and how long the worker waits for a batch to fill up.
+LOCAL_BATCH_SIZE = int(os.getenv("CHATTERBOT_LOCAL_BATCH_SIZE", "8"))
+LOCAL_BATCH_WAIT = float(os.getenv("CHATTERBOT_LOCAL_BATCH_WAIT_MS", "10")) / 1000
+# Most requests waiting for the worker; more are refused, so the router fails over.
+LOCAL_MAX_QUEUE = int(os.getenv("CHATTERBOT_LOCAL_MAX_QUEUE", "64"))
+# Threads torch may use, 0 for its default; and whether linear layers are quantized to int8.
+LOCAL_THREADS = int(os.getenv("CHATTERBOT_LOCAL_THREADS", "0"))
+LOCAL_QUANTIZE = os.getenv("CHATTERBOT_LOCAL_QUANTIZE", "1") == "1"
+
+
+class HostedBackend:
+    """
+    The OpenAI-compatible API, with model_client's connection pool, retries, rate limiting and
+    scheduling.
+    """
+
+    def create_chat_completion(self, **kwargs):
+        return model_client.create_chat_completion(**kwargs)
+
+    async def create_chat_completion_async(self, **kwargs):
+        return await model_client.create_chat_completion_async(**kwargs)
+
+
+class Request:
+    """
+    One chat completion waiting for the local worker.
+    """
+
+    def __init__(self, messages, max_tokens, temperature, top_p):
+        self.messages = messages
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.future = Future()
+
+
+class LocalStream:
+    """
+    The chunks of a completion that was decoded in one go, as a sync or async stream.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    def close(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+
+class LocalCPUBackend:
+    """
+    A small chat model run on the CPU, with micro-batched decoding. Thread-safe; requests made
+    from asyncio wait on the worker without blocking the event loop.
+    """
+
+    def __init__(self, model=LOCAL_MODEL, batch_size=LOCAL_BATCH_SIZE, batch_wait=LOCAL_BATCH_WAIT,
+                 max_queue=LOCAL_MAX_QUEUE, threads=LOCAL_THREADS, quantize=LOCAL_QUANTIZE):
+        self.model_name = model
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.threads = threads
+        self.quantize = quantize
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._worker = None
+        self._torch = None
+        self._tokenizer = None
+        self._model = None
+        self.load_seconds = None
+        self.requests = 0
+        self.batches = 0
+
+    def load(self):
+        """
+        Loads the model once; the first request does it if it wasn't done ahead of time.
+        """
+        with self._load_lock:
+            if self._model is not None:
+                return
+            try:
+                import torch
+                from transformers import AutoModelForCausalLM, AutoTokenizer
+            except ImportError as e:
+                raise RuntimeError("The local backend needs torch and transformers installed") from e
+            started = time.perf_counter()
+            if self.threads:
+                torch.set_num_threads(self.threads)
+            # Prompts are padded on the left so every sequence of a batch ends where decoding starts.
+            tokenizer = AutoTokenizer.from_pretrained(self.model_name, padding_side="left")
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            model = AutoModelForCausalLM.from_pretrained(self.model_name, torch_dtype=torch.float32)
+            model.eval()
+            if self.quantize:
+                model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+            self._torch, self._tokenizer, self._model = torch, tokenizer, model
+            self.load_seconds = time.perf_counter() - started
+            logger.info("Loaded local model %s in %.1fs", self.model_name, self.load_seconds)
+
+    def _submit(self, messages, max_tokens, temperature, top_p):
+        request = Request(messages, max_tokens, temperature, top_p)
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="local-backend", daemon=True)
+                self._worker.start()
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            raise RuntimeError("Local backend queue is full") from None
+        return request.future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            # Requests sampled differently can't share a generate() call.
+            groups = {}
+            for request in batch:
+                groups.setdefault((request.temperature, request.top_p), []).append(request)
+            for requests in groups.values():
+                self._generate(requests)
+
+    def _generate(self, requests):
+        """
+        Decodes a batch up to its longest max_tokens; each output is cut to its own max_tokens.
+        Resolves every request's future with (text, prompt tokens, completion tokens); requests
+        whose caller gave up meanwhile are skipped.
+        """
+        requests = [r for r in requests if r.future.set_running_or_notify_cancel()]
+        if not requests:
+            return
+        try:
+            self.load()
+            tokenizer = self._tokenizer
+            prompts = [tokenizer.apply_chat_template(r.messages, tokenize=False, add_generation_prompt=True)
+                       for r in requests]
+            inputs = tokenizer(prompts, return_tensors="pt", padding=True)
+            sample = requests[0].temperature > 0
+            options = {"do_sample": True, "temperature": requests[0].temperature,
+                       "top_p": requests[0].top_p} if sample else {"do_sample": False}
+            with self._torch.inference_mode():
+                output = self._model.generate(**inputs, max_new_tokens=max(r.max_tokens for r in requests),
+                                              pad_token_id=tokenizer.pad_token_id, **options)
+            prompt_length = inputs["input_ids"].shape[1]
+            with self._lock:
+                self.requests += len(requests)
+                self.batches += 1
+            for row, request in enumerate(requests):
+                tokens = output[row, prompt_length:prompt_length + request.max_tokens]
+                tokens = tokens[tokens != tokenizer.pad_token_id]
+                text = tokenizer.decode(tokens, skip_special_tokens=True).strip()
+                request.future.set_result((text, int(inputs["attention_mask"][row].sum()), len(tokens)))
+        except Exception as e:
+            logger.warning("Local generation failed: %s", e)
+            for request in requests:
+                if not request.future.done():
+                    request.future.set_exception(e)
+
+    def _response(self, result, max_tokens, stream):
+        # Returns (response, usage) in the API's types.
+        from openai.types import CompletionUsage
+        from openai.types.chat import ChatCompletion, ChatCompletionChunk
+        text, prompt_tokens, completion_tokens = result
+        common = {"id": f"local-{uuid.uuid4().hex}", "created": int(time.time()), "model": self.model_name}
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        finish_reason = "length" if completion_tokens >= max_tokens else "stop"
+        if not stream:
+            return ChatCompletion.model_validate({
+                **common, "object": "chat.completion", "usage": usage,
+                "choices": [{"index": 0, "finish_reason": finish_reason,
+                             "message": {"role": "assistant", "content": text}}]}), CompletionUsage(**usage)
+        return LocalStream([
+            ChatCompletionChunk.model_validate({
+                **common, "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "finish_reason": finish_reason,
+                             "delta": {"role": "assistant", "content": text}}]}),
+            ChatCompletionChunk.model_validate({**common, "object": "chat.completion.chunk", "choices": [],
+                                                "usage": usage}),
+        ]), CompletionUsage(**usage)
+
+    def create_chat_completion(self, messages, max_tokens=150, temperature=0.7, top_p=1.0, stream=False,
+                               timeout=None, task=None, **kwargs):
+        """
+        Same interface as model_client.create_chat_completion; model and other API parameters are
+        ignored. A stream is only returned once the whole completion has been decoded.
+        """
+        timer = metrics.registry.start_call(task)
+        try:
+            future = self._submit(messages, max_tokens, temperature, top_p)
+            result = future.result(timeout or model_client.REQUEST_TIMEOUT)
+        except Exception as e:
+            timer.fail(e)
+            raise
+        response, usage = self._response(result, max_tokens, stream)
+        timer.finish(usage)
+        return response
+
+    async def create_chat_completion_async(self, messages, max_tokens=150, temperature=0.7, top_p=1.0,
+                                           stream=False, timeout=None, task=None, **kwargs):
+        """
+        Asyncio variant of create_chat_completion.
+        """
+        timer = metrics.registry.start_call(task)
+        try:
+            future = self._submit(messages, max_tokens, temperature, top_p)
+            result = await asyncio.wait_for(asyncio.wrap_future(future), timeout or model_client.REQUEST_TIMEOUT)
+        except Exception as e:
+            timer.fail(e)
+            raise
+        response, usage = self._response(result, max_tokens, stream)
+        timer.finish(usage)
+        return response
+
+    def stats(self):
+        with self._lock:
+            return {"loaded": int(self._model is not None), "queued": self._queue.qsize(),
+                    "requests": self.requests, "batches": self.batches,
+                    "mean_batch_size": self.requests / self.batches if self.batches else 0.0}
+
+
+hosted_backend = HostedBackend()
+_local_backend = None
+_local_lock = threading.Lock()
+
+
+def local_backend():
+    """
+    The process-wide LocalCPUBackend, created on first use, so the model is only loaded once.
+    """
+    global _local_backend
+    with _local_lock:
+        if _local_backend is None:
+            _local_backend = LocalCPUBackend()
+        return _local_backend
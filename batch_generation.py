@@ -0,0 +1,309 @@
+"""
+batch_generation.py
+
+Generates many exercises of one task type and topic per request.
+
+Online, K exercises are requested in a single JSON-mode completion. Offline, whole curricula are
+written as Batch API request files and collected once the batch completes; LocalBatchBackend
+stands in for the Batch API by processing the same files locally.
+
+Usage:
+    python batch_generation.py q_and_a food --count 10 --output bank.jsonl
+    python batch_generation.py q_and_a food cooking travel --count 20 --requests 5 --offline --output bank.jsonl
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+import uuid
+
+from app_integration import FINE_TUNED_MODEL, generate_chat_response
+from exercises import Exercise
+from model_client import create_chat_completion, get_client
+
+# Fields every generated item must have, per task type.
+BATCH_SCHEMAS = {
+    "fill_in_the_blank": {
+        "description": "a French sentence with exactly one blank written as ___, and the word that fills it",
+        "example": {"text": "Je ___ un croissant tous les matins.", "answer": "mange"},
+    },
+    "q_and_a": {
+        "description": "a simple question in French with a one-word answer",
+        "example": {"text": "Quel fruit est jaune et courbé ?", "answer": "banane"},
+    },
+    "vocabulary_matching": {
+        "description": "5 French words with their English translations",
+        "example": {"pairs": {"la pomme": "the apple", "le pain": "the bread", "le lait": "the milk",
+                              "le fromage": "the cheese", "l'eau": "the water"}},
+    },
+    "conversation": {
+        "description": "a conversation starter or scene context in French",
+        "example": {"text": "Tu es au marché et tu veux acheter des fruits. Qu'est-ce que tu demandes au vendeur ?"},
+    },
+}
+# Completion tokens budgeted per requested exercise.
+TOKENS_PER_EXERCISE = 150
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+
+def batch_messages(task_type, topic, count):
+    """
+    Builds the chat messages requesting count exercises as a single JSON object.
+    """
+    schema = BATCH_SCHEMAS[task_type]
+    example = json.dumps({"exercises": [schema["example"]]}, ensure_ascii=False)
+    return [
+        {"role": "system",
+         "content": "You are a creative French language tutor who generates exercises. You always answer with a JSON object."},
+        {"role": "user",
+         "content": f"Generate {count} different exercises on the topic of {topic or 'a random topic of your choice'}. "
+                    f"Each exercise is {schema['description']}. "
+                    f"Answer with a JSON object of the form {example} containing exactly {count} exercises."}
+    ]
+
+
+def render_vocabulary_matching(pairs):
+    """
+    Renders the exercise text for a pair mapping, with the English translations shuffled.
+    """
+    english = list(pairs.values())
+    random.shuffle(english)
+    lines = ["French words:"]
+    lines += [f"{i}. {french}" for i, french in enumerate(pairs, 1)]
+    lines += ["", "English translations:"]
+    lines += [f"{chr(ord('A') + i)}. {word}" for i, word in enumerate(english)]
+    return "\n".join(lines)
+
+
+def parse_batch(task_type, content, topic=""):
+    """
+    Parses and validates a JSON-mode completion into a list of Exercises, skipping invalid items.
+    """
+    try:
+        items = json.loads(content).get("exercises", [])
+    except (ValueError, AttributeError):
+        return []
+    exercises = []
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        if task_type == "vocabulary_matching":
+            pairs = item.get("pairs")
+            if not isinstance(pairs, dict) or len(pairs) < 2 or not all(
+                    isinstance(french, str) and isinstance(english, str) and french.strip() and english.strip()
+                    for french, english in pairs.items()):
+                continue
+            pairs = {french.strip(): english.strip() for french, english in pairs.items()}
+            exercises.append(Exercise(task_type, render_vocabulary_matching(pairs), pairs=pairs, topic=topic))
+            continue
+        text = item.get("text")
+        if not isinstance(text, str) or not text.strip():
+            continue
+        if task_type == "fill_in_the_blank" and "___" not in text:
+            continue
+        answer = item.get("answer") if task_type != "conversation" else None
+        if task_type != "conversation" and (not isinstance(answer, str) or not answer.strip()):
+            continue
+        exercises.append(Exercise(task_type, text.strip(), answer=answer.strip() if answer else None, topic=topic))
+    return exercises
+
+
+def batch_request_body(task_type, topic, count, model):
+    """
+    Returns the chat completion request body for count exercises.
+    """
+    return {
+        "model": model,
+        "messages": batch_messages(task_type, topic, count),
+        "max_tokens": TOKENS_PER_EXERCISE * count,
+        "temperature": 0.9,
+        "response_format": {"type": "json_object"},
+    }
+
+
+def generate_exercises_batch(task_type, topic, count):
+    """
+    Generates count exercises of one task type and topic through a single completion.
+    Returns the valid ones, which may be fewer than requested.
+    """
+    content = generate_chat_response(batch_messages(task_type, topic, count),
+                                     max_tokens=TOKENS_PER_EXERCISE * count,
+                                     temperature=0.9,
+                                     response_format={"type": "json_object"},
+                                     task=f"{task_type}.batch",
+                                     coalesce=False)
+    return parse_batch(task_type, content, topic=topic)
+
+
+def write_batch_requests(path, jobs, model, count):
+    """
+    Writes one Batch API request line per (task_type, topic) job, each asking for count exercises.
+    The custom_id encodes the job so results can be matched up when the batch completes.
+    """
+    with open(path, "w", encoding="utf8") as f:
+        for i, (task_type, topic) in enumerate(jobs):
+            line = {
+                "custom_id": json.dumps([i, task_type, topic], ensure_ascii=False),
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": batch_request_body(task_type, topic, count, model),
+            }
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+    return path
+
+
+def parse_batch_output(lines):
+    """
+    Turns Batch API output lines into Exercises, in job order. Failed requests are skipped.
+    """
+    results = []
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            continue
+        index, task_type, topic = json.loads(record["custom_id"])
+        content = response["body"]["choices"][0]["message"]["content"]
+        results.append((index, parse_batch(task_type, content, topic=topic)))
+    results.sort(key=lambda result: result[0])
+    return [exercise for _, exercises in results for exercise in exercises]
+
+
+class OpenAIBatchBackend:
+    """
+    Runs request files through the hosted Batch API.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, path):
+        with open(path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                           completion_window="24h")
+        return batch.id
+
+    def status(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status
+
+    def output_lines(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        if not batch.output_file_id:
+            return []
+        return self.client.files.content(batch.output_file_id).text.splitlines()
+
+
+class LocalBatchBackend:
+    """
+    File-based stand-in for the Batch API. Request files are processed synchronously on submit
+    by respond(body) -> content and the output is written next to them in the Batch API format.
+    """
+
+    def __init__(self, directory, respond):
+        self.directory = directory
+        self.respond = respond
+        os.makedirs(directory, exist_ok=True)
+
+    def submit(self, path):
+        batch_id = f"batch_local_{uuid.uuid4().hex}"
+        with open(path, encoding="utf8") as requests, \
+                open(os.path.join(self.directory, f"{batch_id}.output.jsonl"), "w", encoding="utf8") as output:
+            for line in requests:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                try:
+                    content = self.respond(request["body"])
+                    record = {"custom_id": request["custom_id"], "error": None,
+                              "response": {"status_code": 200, "body": {
+                                  "choices": [{"index": 0, "message": {"role": "assistant", "content": content}}]}}}
+                except Exception as e:
+                    record = {"custom_id": request["custom_id"], "response": None,
+                              "error": {"message": str(e)}}
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return batch_id
+
+    def status(self, batch_id):
+        if os.path.exists(os.path.join(self.directory, f"{batch_id}.output.jsonl")):
+            return "completed"
+        return "failed"
+
+    def output_lines(self, batch_id):
+        with open(os.path.join(self.directory, f"{batch_id}.output.jsonl"), encoding="utf8") as f:
+            return f.read().splitlines()
+
+
+def run_batch(backend, jobs, model, count, workdir, poll_interval=60):
+    """
+    Submits jobs as one batch, waits for it to finish and returns the generated Exercises.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    path = write_batch_requests(os.path.join(workdir, f"requests-{int(time.time())}.jsonl"), jobs, model, count)
+    batch_id = backend.submit(path)
+    print("Submitted batch:", batch_id)
+    while True:
+        status = backend.status(batch_id)
+        if status in ["completed", "failed", "expired", "cancelled"]:
+            break
+        print("Batch status:", status)
+        time.sleep(poll_interval)
+    if status != "completed":
+        print("Batch did not complete. Status:", status)
+    return parse_batch_output(backend.output_lines(batch_id))
+
+
+def save_exercises(path, exercises):
+    """
+    Appends Exercises to a JSONL exercise bank.
+    """
+    with open(path, "a", encoding="utf8") as f:
+        for exercise in exercises:
+            f.write(json.dumps(exercise.to_dict(), ensure_ascii=False) + "\n")
+
+
+def load_exercises(path):
+    """
+    Reads an exercise bank written by save_exercises.
+    """
+    with open(path, encoding="utf8") as f:
+        return [Exercise.from_dict(json.loads(line)) for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate exercise banks in bulk.")
+    parser.add_argument("task_type", choices=sorted(BATCH_SCHEMAS))
+    parser.add_argument("topics", nargs="+", help="Topics to generate exercises for, use '' for random topics.")
+    parser.add_argument("--count", type=int, default=10, help="Exercises requested per completion.")
+    parser.add_argument("--requests", type=int, default=1, help="Completions per topic.")
+    parser.add_argument("--output", default="exercise_bank.jsonl")
+    parser.add_argument("--offline", action="store_true", help="Use the Batch API instead of online requests.")
+    parser.add_argument("--local", action="store_true",
+                        help="With --offline, process the batch locally through the online endpoint.")
+    parser.add_argument("--workdir", default="batches")
+    args = parser.parse_args()
+
+    jobs = [(args.task_type, topic) for topic in args.topics for _ in range(args.requests)]
+    if args.offline:
+        if args.local:
+            def respond(body):
+                return create_chat_completion(task=f"{args.task_type}.batch", **body).choices[0].message.content
+
+            backend = LocalBatchBackend(args.workdir, respond)
+        else:
+            backend = OpenAIBatchBackend(get_client())
+        exercises = run_batch(backend, jobs, FINE_TUNED_MODEL, args.count, args.workdir)
+    else:
+        exercises = []
+        for task_type, topic in jobs:
+            exercises.extend(generate_exercises_batch(task_type, topic, args.count))
+    save_exercises(args.output, exercises)
+    print(f"Saved {len(exercises)} exercises to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+"""
+benchmark.py
+
+Offline load test of the Gradio handlers against a local mock of the OpenAI API.
+
+Starts mock_server.py in a separate process, imports app.py pointed at it and drives simulated
+learners through all four task flows by calling app.reset and app.predict the way Gradio does.
+Reports throughput, latency quantiles (first output and completion) per handler and task type,
+and memory per session, as a JSON report. Runs on a plain Linux box with no network.
+With --cold-start-runs, also measures in fresh processes how long importing app, create_app()
+and warming up take, to keep track of cold-start latency. With --backend-requests, also sends the
+same grading and Q&A generation prompts through the hosted path and the local CPU backend, and
+compares their latency and throughput.
+
+Usage:
+    python benchmark.py --learners 100 --sessions 4 --latency-ms 400 --output benchmark_report.json
+    python benchmark.py --learners 0 --cold-start-runs 10
+    python benchmark.py --learners 0 --backend-requests 200 --local-model Qwen/Qwen2.5-0.5B-Instruct
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from metrics import quantile
+from mock_server import add_config_arguments
+
+TASK_TYPES = ["Fill in the Blank", "Q&A", "Conversation", "Vocabulary Matching"]
+# Run in a fresh interpreter per cold-start measurement; prints the timings as JSON.
+COLD_START_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+created = time.perf_counter()
+warm_up = app.warm_up()
+print(json.dumps({"import_seconds": imported - started, "create_app_seconds": created - imported,
+                  "warm_up_seconds": warm_up}))
+"""
+TOPICS = ["", "food", "la cuisine", "cooking", "travel", "voyages", "school", "l'école", "music", "sport"]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mock_server(args):
+    """
+    Starts the mock API in a subprocess, so it doesn't compete with the handlers for the GIL.
+    """
+    port = free_port()
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_server.py"),
+               "--port", str(port), "--latency-ms", str(args.latency_ms), "--latency-sigma", str(args.latency_sigma),
+               "--tokens-per-second", str(args.tokens_per_second), "--output-tokens", str(args.output_tokens),
+               "--error-rate", str(args.error_rate)]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    process.stdout.readline()
+    return process, f"http://127.0.0.1:{port}/v1"
+
+
+def measure_backends(args):
+    """
+    Compares the hosted path with the local backend, if a local model is configured. The local
+    model is loaded first, so loading isn't counted as latency.
+    """
+    from backends import LocalCPUBackend, hosted_backend
+    compared = {"hosted": hosted_backend}
+    load_seconds = None
+    if args.local_model:
+        local = LocalCPUBackend(args.local_model)
+        try:
+            local.load()
+            load_seconds = local.load_seconds
+            compared["local"] = local
+        except Exception as e:
+            print(f"Local backend not compared: {e}")
+    results = asyncio.run(compare_backends(compared, args.backend_requests, args.backend_concurrency))
+    if "local" in compared:
+        results["local"].update(load_seconds=load_seconds, **compared["local"].stats())
+    return results
+
+
+def measure_cold_start(runs):
+    """
+    Starts runs fresh processes that import and start the app, returns the quantiles of each step.
+    """
+    results = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", COLD_START_SCRIPT], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        result["process_seconds"] = time.perf_counter() - started
+        results.append(result)
+    return {name: summarize([result[name] for result in results]) for name in results[0]}
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {"count": len(values), "mean": sum(values) / len(values), "p50": quantile(values, 0.5),
+            "p95": quantile(values, 0.95), "p99": quantile(values, 0.99), "max": values[-1]}
+
+
+def backend_prompts():
+    """
+    (task, messages, max_tokens) of the short tasks the local backend is meant for.
+    """
+    from app_integration import q_and_a_messages, verification_messages
+    question = "Quelle est la capitale de la France ?"
+    prompts = [("q_and_a.generate", q_and_a_messages(topic), 150) for topic in TOPICS]
+    prompts += [("q_and_a.verify", verification_messages("q_and_a", question, answer), 200)
+                for answer in ["Paris", "Lyon", "paris", "Je ne sais pas", "La capitale est Paris"]]
+    return prompts
+
+
+async def compare_backends(backends, requests, concurrency):
+    """
+    Sends the same requests through every backend, at most concurrency at a time, and returns
+    each backend's latency quantiles, throughput and errors.
+    """
+    prompts = backend_prompts()
+    results = {}
+    for name, backend in backends.items():
+        latencies = []
+        errors = collections.Counter()
+        slots = asyncio.Semaphore(concurrency)
+
+        async def send(number):
+            task, messages, max_tokens = prompts[number % len(prompts)]
+            async with slots:
+                started = time.perf_counter()
+                try:
+                    await backend.create_chat_completion_async(model="benchmark", messages=messages,
+                                                               max_tokens=max_tokens, temperature=0.0, task=task)
+                except Exception as e:
+                    errors[type(e).__name__] += 1
+                    return
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[send(number) for number in range(requests)])
+        elapsed = time.perf_counter() - started
+        results[name] = {"latency_seconds": summarize(latencies), "elapsed_seconds": elapsed,
+                         "requests_per_second": len(latencies) / elapsed if elapsed else 0.0,
+                         "errors": dict(errors)}
+    return results
+
+
+def max_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Recorder:
+    """
+    Collects handler timings keyed by (handler, task type).
+    """
+
+    def __init__(self):
+        self.first_output = collections.defaultdict(list)
+        self.total = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    async def timed(self, handler, task_type, generator, ready=lambda output: True):
+        """
+        Drains a handler's generator, recording when the first useful output and the last one arrived.
+        """
+        started = time.perf_counter()
+        first = None
+        last = None
+        try:
+            async for output in generator:
+                if first is None and ready(output):
+                    first = time.perf_counter() - started
+                last = output
+        except Exception as e:
+            self.errors[(handler, task_type, type(e).__name__)] += 1
+            return None
+        total = time.perf_counter() - started
+        self.first_output[(handler, task_type)].append(first if first is not None else total)
+        self.total[(handler, task_type)].append(total)
+        return last
+
+    def report(self):
+        return {
+            f"{handler}/{task_type}": {"first_output_seconds": summarize(self.first_output[(handler, task_type)]),
+                                       "total_seconds": summarize(self.total[(handler, task_type)])}
+            for handler, task_type in sorted(self.total)
+        }
+
+
+def learner_answer(task_type, exercise, rng, correct_rate):
+    """
+    An answer a learner might give: correct with probability correct_rate when the solution is known.
+    """
+    correct = rng.random() < correct_rate
+    if task_type in ("Q&A", "Fill in the Blank") and exercise is not None and exercise.answer and correct:
+        return exercise.answer
+    if task_type == "Vocabulary Matching" and exercise is not None and exercise.pairs:
+        english = list(exercise.pairs.values())
+        if not correct:
+            rng.shuffle(english)
+        return ", ".join(f"{french}: {translation}" for french, translation in zip(exercise.pairs, english))
+    return rng.choice(["pomme", "chat", "suis", "allons", "je ne sais pas"])
+
+
+async def run_learner(app, learner, args, recorder, rng):
+    """
+    One simulated learner going through args.sessions sessions, cycling through the task types.
+    """
+    await asyncio.sleep(rng.uniform(0, args.ramp_up))
+    session_id = None
+    for session in range(args.sessions):
+        task_type = TASK_TYPES[(learner + session) % len(TASK_TYPES)]
+        topic = rng.choice(TOPICS)
+        title = app.TASK_TITLES[task_type]
+        last = await recorder.timed("reset", task_type, app.reset(topic, task_type, session_id),
+                                    ready=lambda output: output[1][0]["content"] != title)
+        if last is None:
+            continue
+        _, history, _, _, session_id = last
+        history = list(history)
+        turns = args.conversation_turns if task_type == "Conversation" else 1
+        for turn in range(turns):
+            await asyncio.sleep(rng.expovariate(1 / args.think_time) if args.think_time else 0)
+            if task_type == "Conversation":
+                message = "quit" if turn == turns - 1 else f"Je voudrais parler de {topic or 'tout'}."
+            else:
+                record = app.session_store.get(session_id)
+                message = learner_answer(task_type, record.task if record else None, rng, args.correct_rate)
+            reply = await recorder.timed("predict", task_type, app.predict(message, history, topic, task_type, session_id))
+            if reply is None:
+                break
+            if reply["content"] == app.BUSY_MESSAGE:
+                recorder.errors[("predict", task_type, "Busy")] += 1
+                break
+            history += [{"role": "user", "content": message}, reply]
+
+
+async def run_benchmark(app, args):
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    await asyncio.gather(*[run_learner(app, learner, args, recorder, random.Random(rng.random()))
+                           for learner in range(args.learners)])
+    return recorder, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test app.reset/app.predict against a mock OpenAI API.")
+    parser.add_argument("--learners", type=int, default=50, help="Concurrent simulated learners.")
+    parser.add_argument("--sessions", type=int, default=4, help="Sessions per learner.")
+    parser.add_argument("--conversation-turns", type=int, default=3)
+    parser.add_argument("--think-time", type=float, default=1.0, help="Mean seconds a learner thinks per answer.")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="Seconds over which learners start.")
+    parser.add_argument("--correct-rate", type=float, default=0.6)
+    parser.add_argument("--pool-depth", type=int, default=None, help="Overrides CHATTERBOT_POOL_DEPTH.")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Measure allocations with tracemalloc (slower, more precise than RSS).")
+    parser.add_argument("--cold-start-runs", type=int, default=0,
+                        help="Fresh processes in which to time importing, creating and warming up the app.")
+    parser.add_argument("--backend-requests", type=int, default=0,
+                        help="Requests to send through each backend to compare them.")
+    parser.add_argument("--backend-concurrency", type=int, default=8)
+    parser.add_argument("--local-model", default=os.getenv("CHATTERBOT_LOCAL_MODEL"),
+                        help="Model of the local backend to compare; defaults to CHATTERBOT_LOCAL_MODEL.")
+    parser.add_argument("--output", default="benchmark_report.json")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    mock, base_url = start_mock_server(args)
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "mock")
+    os.environ["CHATTERBOT_METRICS_PORT"] = "0"
+    if args.pool_depth is not None:
+        os.environ["CHATTERBOT_POOL_DEPTH"] = str(args.pool_depth)
+    try:
+        cold_start = measure_cold_start(args.cold_start_runs) if args.cold_start_runs else None
+        import_started = time.perf_counter()
+        import app
+        import metrics
+        import_seconds = time.perf_counter() - import_started
+        app.init_services()
+
+        rss_before = max_rss_bytes()
+        if args.trace_memory:
+            tracemalloc.start()
+        recorder, elapsed = asyncio.run(run_benchmark(app, args))
+        traced_peak = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+        rss_after = max_rss_bytes()
+        backends = measure_backends(args) if args.backend_requests else None
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    sessions = args.learners * args.sessions
+    handler_calls = sum(len(values) for values in recorder.total.values())
+    report = {
+        "config": vars(args),
+        "import_seconds": import_seconds,
+        "cold_start": cold_start,
+        "elapsed_seconds": elapsed,
+        "throughput": {"sessions_per_second": sessions / elapsed if elapsed else 0.0,
+                       "handler_calls_per_second": handler_calls / elapsed if elapsed else 0.0},
+        "handlers": recorder.report(),
+        "errors": {"/".join(key): count for key, count in recorder.errors.items()},
+        "memory": {
+            "max_rss_bytes": rss_after,
+            "rss_growth_per_learner_bytes": (rss_after - rss_before) / max(args.learners, 1),
+            "traced_peak_per_learner_bytes": traced_peak / max(args.learners, 1) if traced_peak is not None else None,
+        },
+        "exercise_pool": app.exercise_pool.stats(),
+        "sessions": app.session_store.stats(),
+        "model_calls": metrics.registry.to_json()["tasks"],
+        "model_router": {**app.model_router.stats(), "tiers": app.model_router.report()},
+        "scheduler": app.model_client.scheduler.stats(),
+        "backends": backends,
+    }
+    with open(args.output, "w", encoding="utf8") as f:
+        json.dump(report, f, indent=2)
+
+    if cold_start:
+        print("Cold start (p50/p95): " + ", ".join(f"{name} {timings['p50']:.3f}s/{timings['p95']:.3f}s"
+                                                 for name, timings in cold_start.items()))
+    print(f"{sessions} sessions in {elapsed:.1f}s ({report['throughput']['sessions_per_second']:.2f} sessions/s)")
+    for name, timings in report["handlers"].items():
+        total = timings["total_seconds"]
+        first = timings["first_output_seconds"]
+        print(f"  {name:32} first output p50 {first['p50']:.3f}s p95 {first['p95']:.3f}s"
+              f" | total p50 {total['p50']:.3f}s p95 {total['p95']:.3f}s p99 {total['p99']:.3f}s")
+    if report["errors"]:
+        print("  errors:", report["errors"])
+    for name, result in (backends or {}).items():
+        latency = result["latency_seconds"]
+        print(f"  backend {name:8} {result['requests_per_second']:.2f} requests/s | latency p50 "
+              f"{latency.get('p50', 0):.3f}s p95 {latency.get('p95', 0):.3f}s"
+              + (f" | errors {result['errors']}" if result["errors"] else ""))
+    print(f"Report written to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
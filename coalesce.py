@@ -0,0 +1,201 @@
+"""
+coalesce.py
+
+Single-flight coalescing of identical model requests.
+
+When several callers send the same request while it is still in flight, only the first one calls
+the model and the others wait for its result instead of sending a copy. Streamed responses are
+shared too: a caller joining late first gets the text generated so far, then every new chunk.
+The shared stream is read by a background thread (or task), so a caller that stops reading early
+doesn't hold up the others. Flights are forgotten as soon as they finish; this merges requests
+that overlap in time and is no substitute for the response cache.
+"""
+
+import asyncio
+import contextvars
+import threading
+
+import metrics
+
+
+class Flight:
+    """
+    One request in flight: its result or error. For a stream, result is the latest snapshot
+    and version counts the snapshots published so far. task is the asyncio task doing the work.
+    """
+
+    def __init__(self, changed):
+        self.task = None
+        self.result = None
+        self.error = None
+        self.version = 0
+        self.done = False
+        self.changed = changed
+
+    def outcome(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _Flights:
+    """
+    Bookkeeping shared by the threaded and asyncio variants.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _join(self, key, task):
+        """
+        Returns (flight, leader): the flight in progress for key, or a new one led by the caller.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight(self._new_signal())
+                self.leaders += 1
+                return flight, True
+            self.coalesced += 1
+        metrics.registry.increment("coalesced_calls", task or "unknown")
+        return flight, False
+
+    def _land(self, key):
+        with self._lock:
+            self._flights.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._flights), "leaders": self.leaders, "coalesced": self.coalesced}
+
+
+class SingleFlight(_Flights):
+    """
+    Coalesces identical calls made from threads, e.g. Gradio's synchronous handlers.
+    """
+
+    @staticmethod
+    def _new_signal():
+        return threading.Condition()
+
+    def do(self, key, call, task=None):
+        """
+        Returns call(), sharing one call among every concurrent do() with the same key.
+        An error raised by the call is raised in every caller.
+        """
+        flight, leader = self._join(key, task)
+        if leader:
+            try:
+                flight.result = call()
+            except BaseException as error:
+                flight.error = error
+                raise
+            finally:
+                self._land(key)
+                with flight.changed:
+                    flight.done = True
+                    flight.changed.notify_all()
+            return flight.result
+        with flight.changed:
+            flight.changed.wait_for(lambda: flight.done)
+        return flight.outcome()
+
+    def stream(self, key, open_stream, task=None):
+        """
+        Yields the snapshots of the iterator open_stream() returns, sharing one stream among every
+        concurrent stream() with the same key. Each snapshot must contain the ones before it, like
+        the accumulated text of a streamed completion, as callers may skip intermediate snapshots.
+        """
+        flight, leader = self._join(key, task)
+        if leader:
+            # The stream is read in a copy of the leader's context, which carries its scheduling priority.
+            threading.Thread(target=contextvars.copy_context().run, args=(self._pump, key, flight, open_stream),
+                             daemon=True).start()
+        seen = 0
+        while True:
+            with flight.changed:
+                flight.changed.wait_for(lambda: flight.version > seen or flight.done)
+                version, snapshot, done = flight.version, flight.result, flight.done
+            if version > seen:
+                seen = version
+                yield snapshot
+            if done:
+                flight.outcome()
+                return
+
+    def _pump(self, key, flight, open_stream):
+        try:
+            for snapshot in open_stream():
+                with flight.changed:
+                    flight.result = snapshot
+                    flight.version += 1
+                    flight.changed.notify_all()
+        except BaseException as error:
+            flight.error = error
+        finally:
+            self._land(key)
+            with flight.changed:
+                flight.done = True
+                flight.changed.notify_all()
+
+
+class AsyncSingleFlight(_Flights):
+    """
+    Asyncio variant of SingleFlight. Every caller must run on the same event loop.
+    """
+
+    @staticmethod
+    def _new_signal():
+        return asyncio.Event()
+
+    async def do(self, key, call, task=None):
+        """
+        Returns await call(). The call runs in its own task, so cancelling the caller that
+        started it does not cancel it for the others.
+        """
+        flight, leader = self._join(key, task)
+        if leader:
+            flight.task = asyncio.ensure_future(call())
+            flight.task.add_done_callback(lambda _: self._land(key))
+        return await asyncio.shield(flight.task)
+
+    async def stream(self, key, open_stream, task=None):
+        """
+        Asyncio variant of SingleFlight.stream; open_stream() returns an async iterator.
+        """
+        flight, leader = self._join(key, task)
+        if leader:
+            flight.task = asyncio.ensure_future(self._pump(key, flight, open_stream))
+        seen = 0
+        while True:
+            if flight.version == seen and not flight.done:
+                await flight.changed.wait()
+            version, snapshot, done = flight.version, flight.result, flight.done
+            if version > seen:
+                seen = version
+                yield snapshot
+            if done:
+                flight.outcome()
+                return
+
+    async def _pump(self, key, flight, open_stream):
+        try:
+            async for snapshot in open_stream():
+                flight.result = snapshot
+                flight.version += 1
+                self._publish(flight)
+        except BaseException as error:
+            flight.error = error
+        finally:
+            self._land(key)
+            flight.done = True
+            self._publish(flight)
+
+    @staticmethod
+    def _publish(flight):
+        # Wakes up the waiting callers; later waits use a fresh event.
+        changed, flight.changed = flight.changed, asyncio.Event()
+        changed.set()
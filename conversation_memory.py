@@ -0,0 +1,126 @@
+"""
+conversation_memory.py
+
+Token-budgeted conversation memory.
+
+Instead of sending the whole history on every turn, the prompt is made of the system prompt, a
+rolling summary of the older turns and the most recent turns verbatim, all within a fixed token
+budget counted locally.
+"""
+
+import collections
+import hashlib
+import os
+import re
+import threading
+
+from tokens import count_message_tokens, count_tokens
+
+# Maximum number of prompt tokens sent for a conversation turn.
+DEFAULT_TOKEN_BUDGET = int(os.getenv("CHATTERBOT_CONVERSATION_TOKEN_BUDGET", "2000"))
+# Number of recent exchanges (a student message and the tutor's reply) kept verbatim.
+DEFAULT_KEEP_TURNS = int(os.getenv("CHATTERBOT_CONVERSATION_TURNS", "6"))
+# Maximum number of tokens used by the summary of older turns.
+DEFAULT_SUMMARY_TOKENS = int(os.getenv("CHATTERBOT_CONVERSATION_SUMMARY_TOKENS", "300"))
+
+SPEAKERS = {"user": "Student", "assistant": "Tutor"}
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+def extractive_summary(previous_summary, messages, max_tokens):
+    """
+    Default summarizer: keeps the first sentence of every older message, newest lines first
+    when the summary has to be trimmed to max_tokens. Runs locally, without a model call.
+    """
+    lines = previous_summary.split("\n") if previous_summary else []
+    for message in messages:
+        content = " ".join(str(message.get("content") or "").split())
+        if not content:
+            continue
+        first_sentence = _SENTENCE_END.split(content, maxsplit=1)[0]
+        lines.append(f"{SPEAKERS.get(message['role'], message['role'])}: {first_sentence}")
+    kept = []
+    used = 0
+    for line in reversed(lines):
+        used += count_tokens(line) + 1
+        if used > max_tokens:
+            break
+        kept.append(line)
+    return "\n".join(reversed(kept))
+
+
+class ConversationMemory:
+    """
+    Builds bounded prompts for a conversation from its full history.
+
+    summarize(previous_summary, messages, max_tokens) folds messages that fell out of the
+    verbatim window into the summary. Summaries are cached by history prefix, so each turn only
+    summarizes the messages that were dropped since the previous turn.
+    """
+
+    def __init__(self, token_budget=DEFAULT_TOKEN_BUDGET, keep_turns=DEFAULT_KEEP_TURNS,
+                 summary_tokens=DEFAULT_SUMMARY_TOKENS, summarize=extractive_summary, max_cached_summaries=1000):
+        self.token_budget = token_budget
+        self.keep_turns = keep_turns
+        self.summary_tokens = summary_tokens
+        self.summarize = summarize
+        self.max_cached_summaries = max_cached_summaries
+        self._summaries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def build_messages(self, system_prompt, history):
+        """
+        Returns (messages, report) for the next model call. history is the full list of chat
+        messages, ending with the student's latest message. report holds the prompt size.
+        """
+        history = [{"role": message["role"], "content": str(message.get("content") or "")}
+                   for message in history if message.get("role") in SPEAKERS]
+        system = [{"role": "system", "content": system_prompt}] if system_prompt else []
+        prefix_keys = []
+        digest = hashlib.sha256()
+        for message in history:
+            digest.update(message["role"].encode("utf8") + b"\0" + message["content"].encode("utf8") + b"\0")
+            prefix_keys.append(digest.hexdigest())
+
+        # The verbatim window starts with the last keep_turns exchanges and shrinks until it fits.
+        start = max(len(history) - 2 * self.keep_turns, 0)
+        while True:
+            summary = self._summary_for(history, prefix_keys, start)
+            messages = list(system)
+            if summary:
+                messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+            messages.extend(history[start:])
+            prompt_tokens = count_message_tokens(messages)
+            if prompt_tokens <= self.token_budget or start >= len(history) - 1:
+                break
+            start += 1
+
+        report = {
+            "prompt_tokens": prompt_tokens,
+            "verbatim_messages": len(history) - start,
+            "summarized_messages": start,
+            "history_tokens": count_message_tokens(system + history),
+        }
+        return messages, report
+
+    def _summary_for(self, history, prefix_keys, end):
+        # Summary of history[:end], reusing the longest cached summary of a shorter prefix.
+        # prefix_keys[i] identifies history[:i + 1].
+        if end == 0:
+            return ""
+        with self._lock:
+            known, summary = 0, ""
+            for i in range(end, 0, -1):
+                if prefix_keys[i - 1] in self._summaries:
+                    known, summary = i, self._summaries[prefix_keys[i - 1]]
+                    self._summaries.move_to_end(prefix_keys[i - 1])
+                    break
+        if known == end:
+            return summary
+
+        summary = self.summarize(summary, history[known:end], self.summary_tokens)
+        with self._lock:
+            self._summaries[prefix_keys[end - 1]] = summary
+            while len(self._summaries) > self.max_cached_summaries:
+                self._summaries.popitem(last=False)
+        return summary
@@ -8,103 +8,437 @@ Generates a JSONL file that includes examples of:
  - Other custom activities
 
 We focus on French in this example, but you can add other languages.
+
+Larger datasets are built by streaming source files (chat JSONL, legacy prompt/completion JSONL
+or exercise banks from batch_generation.py) through a process pool that converts, validates and
+tokenizes every record, writing sharded JSONL with bounded memory. A stats report with token
+counts per task type and the estimated fine-tuning cost is written next to the output.
+
+Usage:
+    python data_preparation.py
+    python data_preparation.py exercise_logs.jsonl bank.jsonl --output dataset.jsonl --shard-size 100000
 """
+import argparse
+import collections
+import itertools
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from dedup import PREVIEW_LENGTH, Deduplicator, example_text
+from tokens import count_message_tokens
+
+ROLES = ("system", "user", "assistant")
+SYSTEM_PROMPT = "You are a helpful French language tutor."
+# Upper bound on the tokens of one training example; longer examples are rejected.
+MAX_EXAMPLE_TOKENS = int(os.getenv("CHATTERBOT_MAX_EXAMPLE_TOKENS", "65536"))
+# Training price in dollars per million tokens, used to estimate the cost of a fine-tuning job.
+TRAINING_PRICE_PER_MILLION = float(os.getenv("CHATTERBOT_TRAINING_PRICE_PER_MILLION", "3.00"))
+# Records sent to a worker process at a time.
+CHUNK_SIZE = 1000
+# Rejected records listed in the stats report, the rest are only counted.
+MAX_REPORTED_ERRORS = 20
+
+SEED_EXAMPLES = [
+    # 1) Fill in the blank (original)
+    {
+        "messages": [
+            {"role": "system", "content": "You are a helpful French language tutor."},
+            {"role": "user", "content": "Fill in the blank: Je __ un chat. Possible words: [ai, suis, vas]. Which word correctly fills in the blank? Answer with explanation in French."},
+            {"role": "assistant", "content": "ai\nExplanation: In French, 'J'ai un chat' is correct."}
+        ]
+    },
+    # 2) Simple Q&A (original)
+    {
+        "messages": [
+            {"role": "system", "content": "You are a helpful French language tutor."},
+            {"role": "user", "content": "Q&A: Comment dit-on 'apple' en français? Answer in a single word."},
+            {"role": "assistant", "content": "pomme"}
+        ]
+    },
+    # 3) Short conversation (original)
+    {
+        "messages": [
+            {"role": "system", "content": "You are a friendly French tutor."},
+            {"role": "user", "content": "Bonjour, comment ça va?"},
+            {"role": "assistant", "content": "Ça va très bien, merci! Et toi?"}
+        ]
+    },
+    # 4) Vocabulary matching (original)
+    {
+        "messages": [
+            {"role": "system", "content": "You are a helpful French language tutor."},
+            {"role": "user", "content": "Vocabulary matching: Here are the pairs: 1) cat, 2) dog, 3) house, 4) city. French words: [maison, chien, chat, ville]. Match each English word with the correct French word."},
+            {"role": "assistant", "content": "1) cat - chat\n2) dog - chien\n3) house - maison\n4) city - ville"}
+        ]
+    },
+    # 5) Fill in the blank (variation, original)
+    {
+        "messages": [
+            {"role": "system", "content": "You are a helpful French language tutor."},
+            {"role": "user", "content": "Fill in the blank: Nous ____ au supermarché. Possible words: [allons, avez, suis]. Which word correctly fills in the blank? Answer with a brief explanation in English."},
+            {"role": "assistant", "content": "allons\nExplanation: 'Nous allons' means 'We are going.'" }
+        ]
+    },
+    # 6) Additional Fill in the blank
+    {
+        "messages": [
+            {"role": "system", "content": "You are a helpful French language tutor."},
+            {"role": "user", "content": "Fill in the blank: Il __ un livre intéressant. Possible words: [lit, lis, lire]. Which word is correct? Answer with explanation in French."},
+            {"role": "assistant", "content": "lit\nExplanation: 'Il lit un livre intéressant' is correct because 'lit' is the third person singular form of 'lire' in the present tense."}
+        ]
+    },
+    # 7) Additional Q&A
+    {
+        "messages": [
+            {"role": "system", "content": "You are a helpful French language tutor."},
+            {"role": "user", "content": "Q&A: Quelle est la capitale de la France? Answer in a single word."},
+            {"role": "assistant", "content": "Paris"}
+        ]
+    },
+    # 8) Additional Short Conversation
+    {
+        "messages": [
+            {"role": "system", "content": "You are a friendly French tutor."},
+            {"role": "user", "content": "Salut, que fais-tu ce weekend?"},
+            {"role": "assistant", "content": "Je vais visiter un musée et prendre un café avec des amis."}
+        ]
+    },
+    # 9) Additional Vocabulary Matching
+    {
+        "messages": [
+            {"role": "system", "content": "You are a helpful French language tutor."},
+            {"role": "user", "content": "Vocabulary matching: Match the English words with their French equivalents. English words: [water, bread, milk, cheese]. French words: [eau, pain, lait, fromage]."},
+            {"role": "assistant", "content": "water - eau\nbread - pain\nmilk - lait\ncheese - fromage"}
+        ]
+    },
+    # 10) Additional Fill in the blank (another variation)
+    {
+        "messages": [
+            {"role": "system", "content": "You are a helpful French language tutor."},
+            {"role": "user", "content": "Fill in the blank: Ils ___ au cinéma ce soir. Possible words: [vont, vonts, vontre]. Which word is correct? Answer with explanation in French."},
+            {"role": "assistant", "content": "vont\nExplanation: 'Ils vont au cinéma ce soir' is correct because 'vont' is the correct third person plural form of 'aller'."}
+        ]
+    }
+]
+
+
+def task_type_of(messages):
+    """
+    Infers the activity type of a chat example from its first user message.
+    """
+    user = next((m["content"] for m in messages if m.get("role") == "user"), "")
+    prefix = str(user).lower()
+    # Legacy prompts start with "Task: Fill in the blank (French)".
+    if prefix.startswith("task:"):
+        prefix = prefix[len("task:"):].lstrip()
+    if prefix.startswith("fill in the blank"):
+        return "fill_in_the_blank"
+    if prefix.startswith("q&a"):
+        return "q_and_a"
+    if prefix.startswith("vocabulary matching"):
+        return "vocabulary_matching"
+    return "conversation"
+
+
+def exercise_to_example(record):
+    """
+    Converts an exercise bank record (see exercises.Exercise.to_dict) to a chat example.
+    Returns None for exercises without a reference solution to train on.
+    """
+    task_type, text = record["task_type"], record["text"]
+    if task_type == "fill_in_the_blank" and record.get("answer"):
+        prompt, reply = f"Fill in the blank: {text}", record["answer"]
+    elif task_type == "q_and_a" and record.get("answer"):
+        prompt, reply = f"Q&A: {text} Answer in a single word.", record["answer"]
+    elif task_type == "vocabulary_matching" and record.get("pairs"):
+        prompt = f"Vocabulary matching: {text} Match each French word with its English translation."
+        reply = "\n".join(f"{french} - {english}" for french, english in record["pairs"].items())
+    else:
+        return None
+    return {"messages": [{"role": "system", "content": SYSTEM_PROMPT},
+                         {"role": "user", "content": prompt},
+                         {"role": "assistant", "content": reply}]}
+
+
+def to_chat_example(record):
+    """
+    Converts a source record to a chat example: chat records are kept, legacy prompt/completion
+    records and exercise bank records are converted. Returns None if the format is unknown.
+    """
+    if "messages" in record:
+        return {"messages": record["messages"]}
+    if "prompt" in record and "completion" in record:
+        return {"messages": [{"role": "system", "content": SYSTEM_PROMPT},
+                             {"role": "user", "content": record["prompt"]},
+                             {"role": "assistant", "content": record["completion"]}]}
+    if "task_type" in record and "text" in record:
+        return exercise_to_example(record)
+    return None
+
+
+def validate_example(example, max_tokens=MAX_EXAMPLE_TOKENS):
+    """
+    Checks a chat example against the fine-tuning schema. Returns (tokens, error), error is None
+    for a valid example.
+    """
+    messages = example.get("messages")
+    if not isinstance(messages, list) or not messages:
+        return 0, "no messages"
+    for message in messages:
+        if not isinstance(message, dict) or message.get("role") not in ROLES:
+            return 0, "invalid role"
+        content = message.get("content")
+        if not isinstance(content, str) or not content.strip():
+            return 0, "empty content"
+    if messages[-1]["role"] != "assistant":
+        return 0, "no assistant reply"
+    tokens = count_message_tokens(messages)
+    if tokens > max_tokens:
+        return tokens, "too many tokens"
+    return tokens, None
+
+
+def process_chunk(chunk, max_tokens=MAX_EXAMPLE_TOKENS, hasher=None):
+    """
+    Worker function: parses, converts, validates and tokenizes a chunk of (source, line number,
+    line) records. Returns (line, task type, tokens, location, signature, preview) for valid
+    examples and (None, error, 0, location, None, None) for rejected ones, in input order. The
+    MinHash signature used for deduplication, and the preview of the example's text shown in the
+    dedup report, are only computed when a hasher is given.
+    """
+    results = []
+    for source, number, line in chunk:
+        location = f"{source}:{number}"
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            results.append((None, "invalid JSON", 0, location, None, None))
+            continue
+        example = to_chat_example(record) if isinstance(record, dict) else None
+        if example is None:
+            results.append((None, "unknown record format", 0, location, None, None))
+            continue
+        tokens, error = validate_example(example, max_tokens)
+        if error is not None:
+            results.append((None, error, 0, location, None, None))
+            continue
+        signature, preview = None, None
+        if hasher is not None:
+            text = example_text(example)
+            signature, preview = hasher.signature(text), text[:PREVIEW_LENGTH]
+        results.append((json.dumps(example, ensure_ascii=False), task_type_of(example["messages"]), tokens,
+                        location, signature, preview))
+    return results
+
+
+def read_records(sources):
+    """
+    Lazily yields (source, line number, line) for every non-empty line of the source files.
+    """
+    for source in sources:
+        with open(source, encoding="utf8") as f:
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    yield source, number, line
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class DatasetStats:
+    """
+    Token counts and example counts per task type of a built dataset, plus the rejected records.
+    """
+
+    def __init__(self):
+        self.examples = 0
+        self.tokens = 0
+        self.max_example_tokens = 0
+        self.task_types = collections.defaultdict(lambda: {"examples": 0, "tokens": 0})
+        self.rejected = collections.Counter()
+        self.errors = []
+        self.shards = []
+        self.duplicates = 0
+        self.dedup = None
+
+    def add(self, task_type, tokens):
+        self.examples += 1
+        self.tokens += tokens
+        self.max_example_tokens = max(self.max_example_tokens, tokens)
+        self.task_types[task_type]["examples"] += 1
+        self.task_types[task_type]["tokens"] += tokens
+
+    def reject(self, error, location):
+        self.rejected[error] += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"location": location, "error": error})
+
+    def estimated_cost(self, n_epochs, price_per_million=TRAINING_PRICE_PER_MILLION):
+        """
+        Estimated price in dollars of fine-tuning on the dataset for n_epochs.
+        """
+        return self.tokens * n_epochs * price_per_million / 1_000_000
+
+    def report(self, n_epochs=3):
+        return {
+            "examples": self.examples,
+            "tokens": self.tokens,
+            "mean_example_tokens": self.tokens / self.examples if self.examples else 0,
+            "max_example_tokens": self.max_example_tokens,
+            "task_types": dict(self.task_types),
+            "rejected": dict(self.rejected),
+            "rejected_examples": self.errors,
+            "duplicates_dropped": self.duplicates,
+            "dedup": self.dedup,
+            "shards": self.shards,
+            "n_epochs": n_epochs,
+            "training_tokens": self.tokens * n_epochs,
+            "estimated_cost_usd": round(self.estimated_cost(n_epochs), 4),
+        }
+
+
+class ShardWriter:
+    """
+    Writes lines to output_file, or to numbered shards of shard_size lines when shard_size is set.
+    """
+
+    def __init__(self, output_file, shard_size=None):
+        self.output_file = output_file
+        self.shard_size = shard_size
+        self.paths = []
+        self._file = None
+        self._lines = 0
+
+    def _path(self, index):
+        if not self.shard_size:
+            return self.output_file
+        stem, extension = os.path.splitext(self.output_file)
+        return f"{stem}-{index:05d}{extension or '.jsonl'}"
+
+    def write(self, line):
+        if self._file is None or (self.shard_size and self._lines >= self.shard_size):
+            self.close()
+            self.paths.append(self._path(len(self.paths)))
+            os.makedirs(os.path.dirname(self.paths[-1]) or ".", exist_ok=True)
+            self._file = open(self.paths[-1], "w", encoding="utf8")
+        self._file.write(line + "\n")
+        self._lines += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._lines = 0
+
+
+def process_chunks(chunks, workers, max_tokens, hasher=None):
+    """
+    Yields process_chunk's results for every chunk, in order. With more than one worker the chunks
+    are processed in a process pool with at most two chunks per worker in flight.
+    """
+    if workers <= 1:
+        for chunk in chunks:
+            yield process_chunk(chunk, max_tokens, hasher)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(executor.submit(process_chunk, chunk, max_tokens, hasher))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def build_dataset(sources, output_file, shard_size=None, workers=None, chunk_size=CHUNK_SIZE,
+                  max_tokens=MAX_EXAMPLE_TOKENS, dedup_threshold=None):
+    """
+    Streams the source JSONL files into a validated chat dataset and returns its DatasetStats.
+    Records are read lazily and handled in chunks, so memory stays bounded whatever the input size.
+    With a dedup_threshold, near-duplicates of earlier examples are dropped (see dedup.py); their
+    signatures are computed in the workers.
+    """
+    workers = workers or os.cpu_count() or 1
+    stats = DatasetStats()
+    deduplicator = Deduplicator(dedup_threshold) if dedup_threshold else None
+    hasher = deduplicator.hasher if deduplicator is not None else None
+    writer = ShardWriter(output_file, shard_size)
+    try:
+        for results in process_chunks(chunked(read_records(sources), chunk_size), workers, max_tokens, hasher):
+            for line, task_type, tokens, location, signature, preview in results:
+                if line is None:
+                    stats.reject(task_type, location)
+                elif deduplicator is not None and deduplicator.add(signature, location, preview) is not None:
+                    stats.duplicates += 1
+                else:
+                    writer.write(line)
+                    stats.add(task_type, tokens)
+    finally:
+        writer.close()
+    stats.shards = writer.paths
+    if deduplicator is not None:
+        stats.dedup = deduplicator.report()
+    return stats
+
+
+def write_report(stats, path, n_epochs=3):
+    with open(path, "w", encoding="utf8") as f:
+        json.dump(stats.report(n_epochs), f, indent=2, ensure_ascii=False)
+
 
 def create_chat_dataset(output_file="lingua_activities_chat.jsonl"):
     """
     Creates a JSONL dataset with multiple language-learning activity types in chat format.
     Each line contains a 'messages' key with a list of chat messages.
     """
-    examples = [
-        # 1) Fill in the blank (original)
-        {
-            "messages": [
-                {"role": "system", "content": "You are a helpful French language tutor."},
-                {"role": "user", "content": "Fill in the blank: Je __ un chat. Possible words: [ai, suis, vas]. Which word correctly fills in the blank? Answer with explanation in French."},
-                {"role": "assistant", "content": "ai\nExplanation: In French, 'J'ai un chat' is correct."}
-            ]
-        },
-        # 2) Simple Q&A (original)
-        {
-            "messages": [
-                {"role": "system", "content": "You are a helpful French language tutor."},
-                {"role": "user", "content": "Q&A: Comment dit-on 'apple' en français? Answer in a single word."},
-                {"role": "assistant", "content": "pomme"}
-            ]
-        },
-        # 3) Short conversation (original)
-        {
-            "messages": [
-                {"role": "system", "content": "You are a friendly French tutor."},
-                {"role": "user", "content": "Bonjour, comment ça va?"},
-                {"role": "assistant", "content": "Ça va très bien, merci! Et toi?"}
-            ]
-        },
-        # 4) Vocabulary matching (original)
-        {
-            "messages": [
-                {"role": "system", "content": "You are a helpful French language tutor."},
-                {"role": "user", "content": "Vocabulary matching: Here are the pairs: 1) cat, 2) dog, 3) house, 4) city. French words: [maison, chien, chat, ville]. Match each English word with the correct French word."},
-                {"role": "assistant", "content": "1) cat - chat\n2) dog - chien\n3) house - maison\n4) city - ville"}
-            ]
-        },
-        # 5) Fill in the blank (variation, original)
-        {
-            "messages": [
-                {"role": "system", "content": "You are a helpful French language tutor."},
-                {"role": "user", "content": "Fill in the blank: Nous ____ au supermarché. Possible words: [allons, avez, suis]. Which word correctly fills in the blank? Answer with a brief explanation in English."},
-                {"role": "assistant", "content": "allons\nExplanation: 'Nous allons' means 'We are going.'" }
-            ]
-        },
-        # 6) Additional Fill in the blank
-        {
-            "messages": [
-                {"role": "system", "content": "You are a helpful French language tutor."},
-                {"role": "user", "content": "Fill in the blank: Il __ un livre intéressant. Possible words: [lit, lis, lire]. Which word is correct? Answer with explanation in French."},
-                {"role": "assistant", "content": "lit\nExplanation: 'Il lit un livre intéressant' is correct because 'lit' is the third person singular form of 'lire' in the present tense."}
-            ]
-        },
-        # 7) Additional Q&A
-        {
-            "messages": [
-                {"role": "system", "content": "You are a helpful French language tutor."},
-                {"role": "user", "content": "Q&A: Quelle est la capitale de la France? Answer in a single word."},
-                {"role": "assistant", "content": "Paris"}
-            ]
-        },
-        # 8) Additional Short Conversation
-        {
-            "messages": [
-                {"role": "system", "content": "You are a friendly French tutor."},
-                {"role": "user", "content": "Salut, que fais-tu ce weekend?"},
-                {"role": "assistant", "content": "Je vais visiter un musée et prendre un café avec des amis."}
-            ]
-        },
-        # 9) Additional Vocabulary Matching
-        {
-            "messages": [
-                {"role": "system", "content": "You are a helpful French language tutor."},
-                {"role": "user", "content": "Vocabulary matching: Match the English words with their French equivalents. English words: [water, bread, milk, cheese]. French words: [eau, pain, lait, fromage]."},
-                {"role": "assistant", "content": "water - eau\nbread - pain\nmilk - lait\ncheese - fromage"}
-            ]
-        },
-        # 10) Additional Fill in the blank (another variation)
-        {
-            "messages": [
-                {"role": "system", "content": "You are a helpful French language tutor."},
-                {"role": "user", "content": "Fill in the blank: Ils ___ au cinéma ce soir. Possible words: [vont, vonts, vontre]. Which word is correct? Answer with explanation in French."},
-                {"role": "assistant", "content": "vont\nExplanation: 'Ils vont au cinéma ce soir' is correct because 'vont' is the correct third person plural form of 'aller'."}
-            ]
-        }
-    ]
-
     with open(output_file, "w", encoding="utf8") as f:
-        for example in examples:
+        for example in SEED_EXAMPLES:
             json_line = json.dumps(example, ensure_ascii=False)
             f.write(json_line + "\n")
 
-    print(f"Chat dataset created: {output_file} with {len(examples)} examples.")
+    print(f"Chat dataset created: {output_file} with {len(SEED_EXAMPLES)} examples.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a chat fine-tuning dataset from JSONL sources.")
+    parser.add_argument("sources", nargs="*",
+                        help="Chat, prompt/completion or exercise bank JSONL files. Without sources, "
+                             "writes the built-in examples.")
+    parser.add_argument("--output", help="Output JSONL, required with sources so the checked-in "
+                                         "lingua_activities_chat.jsonl isn't overwritten by accident.")
+    parser.add_argument("--shard-size", type=int, default=0, help="Examples per output shard, 0 for one file.")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes, defaults to the CPU count.")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--max-tokens", type=int, default=MAX_EXAMPLE_TOKENS, help="Token limit per example.")
+    parser.add_argument("--epochs", type=int, default=3, help="Epochs the cost estimate is computed for.")
+    parser.add_argument("--dedup-threshold", type=float, default=None,
+                        help="Drop near-duplicates at this estimated similarity, e.g. 0.8.")
+    parser.add_argument("--stats", help="Path of the stats report, defaults to <output>.stats.json.")
+    args = parser.parse_args()
+
+    if not args.sources:
+        create_chat_dataset(args.output or "lingua_activities_chat.jsonl")
+        return
+    if not args.output:
+        parser.error("--output is required when sources are given")
+    stats = build_dataset(args.sources, args.output, shard_size=args.shard_size, workers=args.workers,
+                          chunk_size=args.chunk_size, max_tokens=args.max_tokens,
+                          dedup_threshold=args.dedup_threshold)
+    stats_path = args.stats or os.path.splitext(args.output)[0] + ".stats.json"
+    write_report(stats, stats_path, args.epochs)
+    report = stats.report(args.epochs)
+    print(f"Chat dataset created: {', '.join(stats.shards) or args.output} with {stats.examples} examples "
+          f"({stats.tokens} tokens), {sum(stats.rejected.values())} records rejected, "
+          f"{stats.duplicates} near-duplicates dropped.")
+    print(f"Estimated cost for {args.epochs} epochs: ${report['estimated_cost_usd']:.2f}. Stats written to {stats_path}.")
+
 
 if __name__ == "__main__":
-    create_chat_dataset()
\ No newline at end of file
+    main()
@@ -0,0 +1,212 @@
+"""
+dedup.py
+
+Near-duplicate removal for chat fine-tuning JSONL files.
+
+Every example's user and assistant messages are normalized and split into word shingles, whose
+MinHash signature estimates the Jaccard similarity between examples. Locality-sensitive hashing
+over bands of the signature finds candidate duplicates in a single streaming pass, so the work
+grows linearly with the number of lines instead of comparing every pair. Candidates whose
+estimated similarity reaches the threshold are dropped and reported as clusters around the
+first example kept. Uses NumPy to compute signatures when it is installed.
+
+Usage:
+    python dedup.py lingua_activities_chat.jsonl --output deduplicated.jsonl --threshold 0.8
+"""
+
+import argparse
+import json
+import re
+import zlib
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from response_cache import normalize_text
+
+# Signature length; more permutations estimate the similarity more precisely but cost more time.
+NUM_PERM = 128
+# Words per shingle.
+SHINGLE_SIZE = 3
+# Estimated Jaccard similarity from which two examples count as duplicates.
+THRESHOLD = 0.8
+# Prime just above 2**32 for the permutations a * h + b mod P.
+_PRIME = (1 << 32) + 15
+_MASK = 0xFFFFFFFF
+_PUNCTUATION = re.compile(r"[^\w\s]")
+# Characters of an example's text kept in the report.
+PREVIEW_LENGTH = 120
+
+
+def example_text(example):
+    """
+    The text compared between examples: every non-system message, normalized.
+    """
+    contents = [str(m.get("content") or "") for m in example.get("messages", []) if m.get("role") != "system"]
+    return _PUNCTUATION.sub(" ", normalize_text(" ".join(contents)))
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    words = text.split()
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def lsh_params(threshold, num_perm):
+    """
+    Returns (bands, rows) with bands * rows <= num_perm whose LSH curve (1/bands) ** (1/rows)
+    crosses closest to the threshold.
+    """
+    candidates = [(bands, num_perm // bands) for bands in range(1, num_perm + 1)]
+    return min(candidates, key=lambda p: (abs((1 / p[0]) ** (1 / p[1]) - threshold), -p[0] * p[1]))
+
+
+class MinHasher:
+    """
+    Computes MinHash signatures, as bytes of num_perm unsigned 32-bit values.
+    Deterministic for a given seed, so worker processes compute the same signatures.
+    """
+
+    def __init__(self, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        # a < 2**31 keeps a * h + b within 64 bits for the vectorized path.
+        state = seed
+        self.a, self.b = [], []
+        for _ in range(num_perm):
+            state = (state * 6364136223846793005 + 1442695040888963407) % (1 << 64)
+            self.a.append((state >> 33) | 1)
+            state = (state * 6364136223846793005 + 1442695040888963407) % (1 << 64)
+            self.b.append(state >> 32)
+        if np is not None:
+            self._a = np.array(self.a, dtype=np.uint64)[:, None]
+            self._b = np.array(self.b, dtype=np.uint64)[:, None]
+
+    def signature(self, text):
+        hashes = [zlib.crc32(shingle.encode("utf8")) for shingle in shingles(text, self.shingle_size)]
+        if np is not None:
+            values = (self._a * np.array(hashes, dtype=np.uint64)[None, :] + self._b) % _PRIME & _MASK
+            return values.min(axis=1).astype(np.uint32).tobytes()
+        return array("I", [min((a * h + b) % _PRIME & _MASK for h in hashes)
+                           for a, b in zip(self.a, self.b)]).tobytes()
+
+
+def similarity(signature, other):
+    """
+    Estimated Jaccard similarity: the share of signature positions that agree.
+    """
+    if np is not None:
+        first, second = np.frombuffer(signature, np.uint32), np.frombuffer(other, np.uint32)
+        return np.count_nonzero(first == second) / len(first)
+    first, second = array("I", signature), array("I", other)
+    return sum(x == y for x, y in zip(first, second)) / len(first)
+
+
+class Deduplicator:
+    """
+    Streaming near-duplicate filter. add() each example's signature in order; it returns the
+    reference of the kept example it duplicates, or None if the example is new and kept.
+    Only the signatures of kept examples are held in memory (4 * num_perm bytes each).
+    """
+
+    def __init__(self, threshold=THRESHOLD, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=1):
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, shingle_size, seed)
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        self._tables = [{} for _ in range(self.bands)]
+        self._kept = []
+        self._clusters = {}
+        self.seen = 0
+        self.dropped = 0
+
+    def _band_keys(self, signature):
+        width = 4 * self.rows
+        return [signature[i * width:(i + 1) * width] for i in range(self.bands)]
+
+    def add(self, signature, ref, preview=""):
+        self.seen += 1
+        keys = self._band_keys(signature)
+        checked = set()
+        for table, key in zip(self._tables, keys):
+            index = table.get(key)
+            if index is None or index in checked:
+                continue
+            checked.add(index)
+            kept_ref, kept_signature, kept_preview = self._kept[index]
+            if similarity(signature, kept_signature) >= self.threshold:
+                self.dropped += 1
+                cluster = self._clusters.setdefault(kept_ref, {"kept": kept_ref, "preview": kept_preview,
+                                                               "dropped": []})
+                cluster["dropped"].append(ref)
+                return kept_ref
+        index = len(self._kept)
+        self._kept.append((ref, signature, preview[:PREVIEW_LENGTH]))
+        for table, key in zip(self._tables, keys):
+            table.setdefault(key, index)
+        return None
+
+    def check(self, example, ref):
+        """
+        Computes the example's signature and adds it, see add.
+        """
+        text = example_text(example)
+        return self.add(self.hasher.signature(text), ref, text)
+
+    def report(self, max_clusters=100):
+        """
+        The dropped examples grouped by the kept example they duplicate, largest clusters first.
+        """
+        clusters = sorted(self._clusters.values(), key=lambda c: len(c["dropped"]), reverse=True)
+        return {
+            "threshold": self.threshold,
+            "num_perm": self.hasher.num_perm,
+            "bands": self.bands,
+            "rows": self.rows,
+            "seen": self.seen,
+            "kept": self.seen - self.dropped,
+            "dropped": self.dropped,
+            "clusters": len(clusters),
+            "largest_clusters": [{**c, "size": len(c["dropped"]) + 1} for c in clusters[:max_clusters]],
+        }
+
+
+def deduplicate_file(input_file, output_file, threshold=THRESHOLD, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE):
+    """
+    Copies the chat JSONL input_file to output_file without its near-duplicates, in one pass.
+    Returns the Deduplicator, whose report() lists the dropped clusters by line number.
+    """
+    deduplicator = Deduplicator(threshold, num_perm, shingle_size)
+    with open(input_file, encoding="utf8") as source, open(output_file, "w", encoding="utf8") as output:
+        for number, line in enumerate(source, 1):
+            if not line.strip():
+                continue
+            if deduplicator.check(json.loads(line), number) is None:
+                output.write(line if line.endswith("\n") else line + "\n")
+    return deduplicator
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Remove near-duplicate examples from a chat JSONL file.")
+    parser.add_argument("input")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="Estimated Jaccard similarity.")
+    parser.add_argument("--num-perm", type=int, default=NUM_PERM)
+    parser.add_argument("--shingle-size", type=int, default=SHINGLE_SIZE)
+    parser.add_argument("--report", help="Path of the JSON report of dropped clusters.")
+    args = parser.parse_args()
+
+    deduplicator = deduplicate_file(args.input, args.output, args.threshold, args.num_perm, args.shingle_size)
+    report = deduplicator.report()
+    if args.report:
+        with open(args.report, "w", encoding="utf8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Kept {report['kept']} of {report['seen']} examples, dropped {report['dropped']} near-duplicates "
+          f"in {report['clusters']} clusters.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+evaluate.py
+
+Offline evaluation of fine-tuned models on a held-out chat JSONL file.
+
+The dataset is streamed: each example's last assistant message is the reference and the
+messages before it are the prompt. Prompts are sent to every model under evaluation by a bounded
+pool of asyncio workers, and each answer is scored against the reference: exact match of the
+answer for Q&A and fill-in-the-blank, share of correct pairs for vocabulary matching.
+Conversation examples are only timed. Every result is appended to a JSONL results file as soon as
+it is known, which is also the checkpoint: running the same command again skips the examples
+already evaluated. The report puts quality next to latency and token usage, per model and task type.
+
+Usage:
+    python evaluate.py heldout.jsonl --model ft:gpt-4o-mini:...:new --model ft:gpt-4o-mini:...:current
+    python evaluate.py heldout.jsonl --mock
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import time
+
+from data_preparation import read_records, task_type_of, to_chat_example
+from exercises import parse_pairs
+from grading import normalize_answer, normalize_translation
+from metrics import quantile
+from model_client import create_chat_completion_async
+from scheduler import BULK, mark
+
+# Requests in flight at once, across all models.
+WORKERS = int(os.getenv("CHATTERBOT_EVAL_WORKERS", "16"))
+MAX_TOKENS = 200
+RESULTS_PATH = "evaluation_results.jsonl"
+
+
+def first_answer(text):
+    """
+    The answer part of a reply: its first line, without a trailing explanation.
+    """
+    lines = text.strip().splitlines()
+    return lines[0] if lines else ""
+
+
+def exact_match(reference, prediction):
+    return float(normalize_answer(first_answer(reference), strip_articles=False)
+                 == normalize_answer(first_answer(prediction), strip_articles=False))
+
+
+def pair_accuracy(reference, prediction):
+    """
+    Share of the reference pairs found in the prediction, in either direction. As either word may
+    be the English one, both are compared without French or English articles.
+    """
+    expected = {frozenset(map(normalize_translation, pair)) for pair in parse_pairs(reference).items()}
+    if not expected:
+        return None
+    given = {frozenset(map(normalize_translation, pair)) for pair in parse_pairs(prediction).items()}
+    return len(expected & given) / len(expected)
+
+
+def score(task_type, reference, prediction):
+    """
+    Score of a prediction between 0 and 1, or None for task types without a reference answer.
+    """
+    if task_type in ("q_and_a", "fill_in_the_blank"):
+        return exact_match(reference, prediction)
+    if task_type == "vocabulary_matching":
+        return pair_accuracy(reference, prediction)
+    return None
+
+
+def read_examples(sources):
+    """
+    Lazily yields (example ID, task type, prompt messages, reference) for every usable example.
+    """
+    for source, number, line in read_records(sources):
+        example = to_chat_example(json.loads(line))
+        messages = (example or {}).get("messages") or []
+        if len(messages) < 2 or messages[-1].get("role") != "assistant":
+            continue
+        yield f"{source}:{number}", task_type_of(messages), messages[:-1], messages[-1]["content"]
+
+
+def load_done(path):
+    """
+    Returns the (model, example ID) pairs already in the results file.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding="utf8") as f:
+        return {(result["model"], result["id"]) for result in map(json.loads, f) if result.get("error") is None}
+
+
+async def evaluate_one(model, example_id, task_type, messages, reference, max_tokens):
+    started = time.perf_counter()
+    result = {"model": model, "id": example_id, "task_type": task_type}
+    try:
+        response = await create_chat_completion_async(model=model, messages=messages, max_tokens=max_tokens,
+                                                      temperature=0.0, task=f"{task_type}.evaluate")
+    except Exception as e:
+        return {**result, "error": f"{type(e).__name__}: {e}"}
+    prediction = (response.choices[0].message.content or "").strip()
+    usage = response.usage
+    return {**result, "score": score(task_type, reference, prediction),
+            "latency": time.perf_counter() - started,
+            "prompt_tokens": getattr(usage, "prompt_tokens", None),
+            "completion_tokens": getattr(usage, "completion_tokens", None),
+            "prediction": prediction, "reference": reference, "error": None}
+
+
+async def run(sources, models, results_path, workers=WORKERS, max_tokens=MAX_TOKENS, limit=None):
+    """
+    Evaluates every model on the examples of sources not yet in results_path and appends the
+    results to it. Returns the number of requests made. The requests are scheduled as bulk work.
+    """
+    mark(BULK, "evaluate")
+    done = load_done(results_path)
+    jobs = asyncio.Queue(maxsize=2 * workers)
+    made = 0
+
+    async def work(output):
+        nonlocal made
+        while True:
+            job = await jobs.get()
+            if job is None:
+                return
+            result = await evaluate_one(*job, max_tokens)
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            made += 1
+
+    with open(results_path, "a", encoding="utf8") as output:
+        workers_done = [asyncio.ensure_future(work(output)) for _ in range(workers)]
+        for number, (example_id, task_type, messages, reference) in enumerate(read_examples(sources)):
+            if limit is not None and number >= limit:
+                break
+            for model in models:
+                if (model, example_id) not in done:
+                    await jobs.put((model, example_id, task_type, messages, reference))
+        for _ in workers_done:
+            await jobs.put(None)
+        await asyncio.gather(*workers_done)
+    return made
+
+
+def summarize(results_path):
+    """
+    Aggregates the results file per model and task type: mean score, latency quantiles, tokens
+    and errors. Only the latest result of each (model, example) counts.
+    """
+    latest = {}
+    with open(results_path, encoding="utf8") as f:
+        for result in map(json.loads, f):
+            key = (result["model"], result["id"])
+            if result.get("error") is None or key not in latest:
+                latest[key] = result
+    groups = collections.defaultdict(list)
+    for result in latest.values():
+        groups[(result["model"], result["task_type"])].append(result)
+        groups[(result["model"], "all")].append(result)
+    summary = collections.defaultdict(dict)
+    for (model, task_type), results in sorted(groups.items()):
+        succeeded = [r for r in results if r.get("error") is None]
+        scores = [r["score"] for r in succeeded if r["score"] is not None]
+        latencies = sorted(r["latency"] for r in succeeded)
+        summary[model][task_type] = {
+            "examples": len(results),
+            "errors": len(results) - len(succeeded),
+            "score": sum(scores) / len(scores) if scores else None,
+            "latency_p50": quantile(latencies, 0.5),
+            "latency_p95": quantile(latencies, 0.95),
+            "prompt_tokens": sum(r["prompt_tokens"] or 0 for r in succeeded),
+            "completion_tokens": sum(r["completion_tokens"] or 0 for r in succeeded),
+        }
+    return dict(summary)
+
+
+def print_summary(summary):
+    for model, task_types in summary.items():
+        print(model)
+        for task_type, s in task_types.items():
+            quality = f"{s['score']:.3f}" if s["score"] is not None else "  -  "
+            print(f"  {task_type:22} n={s['examples']:<6} score {quality}  latency p50 {s['latency_p50']:.2f}s "
+                  f"p95 {s['latency_p95']:.2f}s  tokens {s['prompt_tokens']}+{s['completion_tokens']}"
+                  f"  errors {s['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate models on a held-out chat JSONL dataset.")
+    parser.add_argument("sources", nargs="+", help="Held-out chat JSONL files.")
+    parser.add_argument("--model", action="append", dest="models",
+                        help="Model to evaluate; repeat to compare models. Defaults to FINE_TUNED_MODEL.")
+    parser.add_argument("--results", default=RESULTS_PATH,
+                        help="Results JSONL, appended to; examples already in it are skipped.")
+    parser.add_argument("--report", help="Path of the JSON summary.")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--max-tokens", type=int, default=MAX_TOKENS)
+    parser.add_argument("--limit", type=int, help="Evaluate at most this many examples.")
+    parser.add_argument("--mock", action="store_true", help="Run against an in-process mock_server.")
+    args = parser.parse_args()
+
+    if args.mock:
+        from mock_server import MockServer
+        server = MockServer()
+        server.start()
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        os.environ.setdefault("OPENAI_API_KEY", "mock")
+    if not args.models:
+        from app_integration import FINE_TUNED_MODEL
+        args.models = [FINE_TUNED_MODEL]
+
+    started = time.perf_counter()
+    made = asyncio.run(run(args.sources, args.models, args.results, args.workers, args.max_tokens, args.limit))
+    elapsed = time.perf_counter() - started
+    print(f"{made} requests in {elapsed:.1f}s ({made / elapsed if elapsed else 0:.1f}/s), results in {args.results}.")
+    summary = summarize(args.results)
+    print_summary(summary)
+    if args.report:
+        with open(args.report, "w", encoding="utf8") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+exercise_pool.py
+
+Pool of pre-generated exercises keyed by (task type, topic).
+
+Background workers keep every known key topped up to its configured depth, so starting a
+session only has to pop a ready exercise instead of waiting for a model round-trip. A key that is
+missing several exercises is refilled with one batched request. A key requested for the first
+time only gets one exercise generated ahead; it is topped up to its depth once it is requested
+again, so one-off topics don't spend a full depth of generations each.
+A blank topic is the "random topic" key and is pooled like any other. With a TopicIndex, similar
+topics ("food", "la cuisine", "cooking") are mapped to one canonical topic and share a key.
+"""
+
+import collections
+import logging
+import os
+import queue
+import threading
+import time
+
+from app_integration import generate_exercise
+from batch_generation import generate_exercises_batch, load_exercises
+
+logger = logging.getLogger(__name__)
+
+# Number of ready exercises kept per (task type, topic) unless overridden per topic.
+DEFAULT_POOL_DEPTH = int(os.getenv("CHATTERBOT_POOL_DEPTH", "3"))
+# Number of background threads generating exercises.
+DEFAULT_POOL_WORKERS = int(os.getenv("CHATTERBOT_POOL_WORKERS", "4"))
+# Upper bound on the number of (task type, topic) keys tracked; least recently requested keys are dropped.
+DEFAULT_MAX_KEYS = int(os.getenv("CHATTERBOT_POOL_MAX_KEYS", "1000"))
+
+
+def generate_sample(task_type, topic):
+    """
+    Generates an exercise on its own, so concurrent refills of one key return different exercises.
+    """
+    return generate_exercise(task_type, topic, coalesce=False)
+
+
+def normalize_topic(topic):
+    """
+    Normalizes a free-text topic into a pool key. A blank topic means "random topic".
+    """
+    return " ".join((topic or "").lower().split())
+
+
+class ExercisePool:
+    """
+    Thread-safe pool of ready exercises with background refill and hit/miss metrics.
+    """
+
+    def __init__(self, depth=DEFAULT_POOL_DEPTH, depths=None, workers=DEFAULT_POOL_WORKERS,
+                 max_keys=DEFAULT_MAX_KEYS, generate=generate_sample, generate_batch=generate_exercises_batch,
+                 topics=None):
+        """
+        depth: default number of ready exercises per key.
+        depths: optional {topic: depth} overrides, use "" for the random topic.
+        generate: callable(task_type, topic) returning an Exercise.
+        generate_batch: optional callable(task_type, topic, count) returning a list of Exercises.
+        topics: optional TopicIndex mapping topics to canonical topics, which are then generated.
+        """
+        self.topics = topics
+        self.depth = depth
+        self.depths = {self.topic_key(topic): value for topic, value in (depths or {}).items()}
+        self.workers = workers
+        self.max_keys = max_keys
+        self.generate = generate
+        self.generate_batch = generate_batch
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._ready = collections.OrderedDict()
+        self._in_flight = collections.Counter()
+        self._jobs = queue.Queue()
+        self._lock = threading.Lock()
+        self._refilled = threading.Condition(self._lock)
+        self._threads = []
+        self._stopping = threading.Event()
+
+    def topic_key(self, topic):
+        """
+        The topic exercises are pooled and generated under.
+        """
+        if self.topics is not None:
+            topic = self.topics.canonical(topic)
+        return normalize_topic(topic)
+
+    def depth_for(self, topic):
+        return self.depths.get(self.topic_key(topic), self.depth)
+
+    def start(self):
+        """
+        Starts the background refill workers.
+        """
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"exercise-pool-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """
+        Stops the workers once their current generation finishes.
+        """
+        self._stopping.set()
+        for _ in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def prefill(self, task_types, topics):
+        """
+        Registers every (task type, topic) combination and schedules it to be filled.
+        """
+        with self._lock:
+            for task_type in task_types:
+                for topic in topics:
+                    self._schedule_refill((task_type, self.topic_key(topic)))
+
+    def wait_ready(self, task_types, topics, timeout=None):
+        """
+        Blocks until every (task type, topic) combination has at least one ready exercise, or
+        until timeout seconds have passed. Returns whether all of them are ready.
+        """
+        keys = [(task_type, self.topic_key(topic)) for task_type in task_types for topic in topics]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._refilled:
+            while not all(self._ready.get(key) for key in keys):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._refilled.wait(remaining)
+            return True
+
+    def pop(self, task_type, topic):
+        """
+        Returns a ready exercise, or None on a miss. Either way the key is refilled in the background,
+        by a single exercise if it wasn't known yet.
+        """
+        key = (task_type, self.topic_key(topic))
+        with self._lock:
+            ready = self._ready.get(key)
+            exercise = ready.popleft() if ready else None
+            if exercise is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            self._schedule_refill(key, limit=None if ready is not None else 1)
+        return exercise
+
+    def put(self, task_type, topic, exercise):
+        """
+        Adds an exercise generated elsewhere to the pool, ignored if the key is already full.
+        """
+        key = (task_type, self.topic_key(topic))
+        with self._lock:
+            ready = self._track(key)
+            if len(ready) < self.depths.get(key[1], self.depth):
+                ready.append(exercise)
+
+    def load(self, path):
+        """
+        Adds the exercises of a bank written by batch_generation to the pool.
+        """
+        for exercise in load_exercises(path):
+            self.put(exercise.task_type, exercise.topic, exercise)
+
+    def stats(self):
+        """
+        Returns hit/miss counters and the number of ready exercises.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "errors": self.errors,
+                "keys": len(self._ready),
+                "ready": sum(len(ready) for ready in self._ready.values()),
+                "in_flight": sum(self._in_flight.values()),
+            }
+
+    def _track(self, key):
+        # Must be called with the lock held. Marks the key as recently used and bounds the key count.
+        ready = self._ready.get(key)
+        if ready is None:
+            ready = self._ready[key] = collections.deque()
+            while len(self._ready) > self.max_keys:
+                self._ready.popitem(last=False)
+        else:
+            self._ready.move_to_end(key)
+        return ready
+
+    def _schedule_refill(self, key, limit=None):
+        # Must be called with the lock held. limit caps the ready and in-flight exercises below the depth.
+        ready = self._track(key)
+        depth = self.depths.get(key[1], self.depth)
+        missing = min(depth, limit or depth) - len(ready) - self._in_flight[key]
+        if missing <= 0:
+            return
+        self._in_flight[key] += missing
+        if self.generate_batch is not None and missing > 1:
+            self._jobs.put((key, missing))
+        else:
+            for _ in range(missing):
+                self._jobs.put((key, 1))
+
+    def _work(self):
+        while not self._stopping.is_set():
+            job = self._jobs.get()
+            if job is None:
+                return
+            key, count = job
+            task_type, topic = key
+            try:
+                if count > 1:
+                    exercises = self.generate_batch(task_type, topic, count)
+                else:
+                    exercises = [self.generate(task_type, topic)]
+            except Exception:
+                logger.exception("Pre-generating %d %s exercise(s) on %r failed", count, task_type, topic)
+                exercises = []
+            with self._lock:
+                self._in_flight[key] -= count
+                if self._in_flight[key] <= 0:
+                    del self._in_flight[key]
+                if not exercises:
+                    self.errors += 1
+                for exercise in exercises:
+                    if key in self._ready and len(self._ready[key]) < self.depths.get(topic, self.depth):
+                        self._ready[key].append(exercise)
+                self._refilled.notify_all()
@@ -0,0 +1,99 @@
+"""
+exercises.py
+
+Structured exercise format.
+
+Generated exercises end with a hidden solution line ("SOLUTION: ...") holding the expected
+answer, or the French/English pairs for vocabulary matching. The solution is split off when the
+exercise is parsed, so learners only ever see the exercise text while the grader keeps the answer.
+"""
+
+import re
+
+SOLUTION_MARKER = "SOLUTION:"
+
+# Instructions appended to generation prompts so the model writes the hidden solution line.
+SOLUTION_INSTRUCTIONS = {
+    "q_and_a": f"After the question, on a new line, write '{SOLUTION_MARKER}' followed by the one-word answer.",
+    "vocabulary_matching": (f"After the exercise, on a new line, write '{SOLUTION_MARKER}' followed by the correct "
+                            "pairs in the form french=english, separated by semicolons."),
+}
+
+_PAIR_SEPARATOR = re.compile(r"\s*(?:->|=>|=|:|\s-\s)\s*")
+
+
+class Exercise:
+    """
+    An exercise shown to the learner together with its reference solution, if known.
+    answer is the expected answer, pairs maps each French word to its English translation.
+    """
+
+    def __init__(self, task_type, text, answer=None, pairs=None, topic=""):
+        self.task_type = task_type
+        self.text = text
+        self.answer = answer
+        self.pairs = pairs
+        self.topic = topic
+
+    def has_reference(self):
+        return bool(self.answer or self.pairs)
+
+    def to_dict(self):
+        return {"task_type": self.task_type, "text": self.text, "answer": self.answer, "pairs": self.pairs,
+                "topic": self.topic}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["task_type"], data["text"], answer=data.get("answer"), pairs=data.get("pairs"),
+                   topic=data.get("topic", ""))
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return f"Exercise({self.task_type!r}, {self.text!r}, answer={self.answer!r}, pairs={self.pairs!r})"
+
+
+def visible_text(raw):
+    """
+    Returns the part of a (possibly partial) generation the learner may see: everything before
+    the solution marker, also holding back a trailing fragment that could be the start of it.
+    """
+    index = raw.find(SOLUTION_MARKER)
+    if index != -1:
+        return raw[:index].strip()
+    last_line = raw[raw.rfind("\n") + 1:].lstrip()
+    if last_line and SOLUTION_MARKER.startswith(last_line):
+        return raw[:len(raw) - len(last_line)].strip()
+    return raw.strip()
+
+
+def parse_pairs(text):
+    """
+    Parses "french=english; french=english" (also ":", "-" or "->" separated, one pair per
+    line or comma separated) into a {french: english} dict.
+    """
+    pairs = {}
+    for entry in re.split(r"[;,\n]", text):
+        entry = entry.strip().strip(".").strip()
+        entry = re.sub(r"^\d+[.)]\s*", "", entry)
+        parts = _PAIR_SEPARATOR.split(entry, maxsplit=1)
+        if len(parts) == 2 and parts[0] and parts[1]:
+            pairs[parts[0].strip()] = parts[1].strip()
+    return pairs
+
+
+def parse_exercise(task_type, raw, topic=""):
+    """
+    Builds an Exercise from the raw model output, splitting off the hidden solution line.
+    """
+    index = raw.find(SOLUTION_MARKER)
+    if index == -1:
+        return Exercise(task_type, visible_text(raw), topic=topic)
+    text = raw[:index].strip()
+    solution = raw[index + len(SOLUTION_MARKER):].strip()
+    if task_type == "vocabulary_matching":
+        return Exercise(task_type, text, pairs=parse_pairs(solution) or None, topic=topic)
+    lines = solution.splitlines()
+    answer = lines[0].strip().strip(".,;:!?\"'«» ") if lines else None
+    return Exercise(task_type, text, answer=answer or None, topic=topic)
@@ -2,70 +2,300 @@
 fine_tune.py
 
 Script to fine-tune an OpenAI model using your prepared JSONL dataset.
+
+Datasets are uploaded in parts through the Uploads API, so a large file uploads in parallel and
+an interrupted upload resumes with the parts still missing. Jobs are tracked by a JobManager that
+follows many jobs at once, reads their event streams and polls with an adaptive backoff: often
+while a job reports progress, rarely while it sits in the queue. Uploads and jobs are persisted
+to a local state file, so a restarted process picks up where the previous one stopped.
+Set OPENAI_BASE_URL to run against the fake endpoints of mock_server.py.
+
+Usage:
+    python fine_tune.py create lingua_activities_chat.jsonl --epochs 3
+    python fine_tune.py watch
+    python fine_tune.py status
 """
 
+import argparse
+import heapq
+import json
 import os
+import threading
 import time
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+from model_client import get_client, with_retries
+
+# Local file holding the state of uploads and jobs between runs.
+STATE_PATH = os.getenv("CHATTERBOT_FINE_TUNE_STATE", "fine_tune_state.json")
+# Bytes per upload part; the Uploads API accepts parts of up to 64 MB.
+PART_SIZE = int(os.getenv("CHATTERBOT_UPLOAD_PART_SIZE", str(64 * 1024 * 1024)))
+# Parts uploaded in parallel.
+UPLOAD_WORKERS = int(os.getenv("CHATTERBOT_UPLOAD_WORKERS", "4"))
+# Polling interval bounds in seconds. The interval resets to the minimum whenever a job logs new
+# events and grows by POLL_BACKOFF after every poll without any.
+MIN_POLL_INTERVAL = float(os.getenv("CHATTERBOT_MIN_POLL_INTERVAL", "5"))
+MAX_POLL_INTERVAL = float(os.getenv("CHATTERBOT_MAX_POLL_INTERVAL", "300"))
+POLL_BACKOFF = 1.5
+BASE_MODEL = "gpt-4o-mini-2024-07-18"
+TERMINAL_STATUSES = ("succeeded", "failed", "cancelled")
+
+
+class JobStore:
+    """
+    Uploads and fine-tuning jobs persisted as JSON. Every change is written to disk atomically.
+    """
+
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.data = {"uploads": {}, "jobs": {}}
+        if os.path.exists(path):
+            with open(path, encoding="utf8") as f:
+                self.data.update(json.load(f))
+
+    def _save(self):
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf8") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(temporary, self.path)
+
+    def get_upload(self, key):
+        with self._lock:
+            return self.data["uploads"].get(key)
+
+    def set_upload(self, key, record):
+        with self._lock:
+            if record is None:
+                self.data["uploads"].pop(key, None)
+            else:
+                self.data["uploads"][key] = record
+            self._save()
+
+    def set_part(self, key, index, part_id):
+        with self._lock:
+            self.data["uploads"][key]["part_ids"][index] = part_id
+            self._save()
+
+    def get_job(self, job_id):
+        with self._lock:
+            return self.data["jobs"].get(job_id)
+
+    def update_job(self, job_id, **fields):
+        with self._lock:
+            self.data["jobs"].setdefault(job_id, {}).update(fields)
+            self._save()
+
+    def jobs(self):
+        with self._lock:
+            return dict(self.data["jobs"])
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    def unfinished_jobs(self):
+        return [job_id for job_id, job in self.jobs().items() if job.get("status") not in TERMINAL_STATUSES]
 
-def upload_training_file(file_path):
+
+def _new_upload(client, file_path, size, part_size):
+    upload = with_retries(client.uploads.create, bytes=size, filename=os.path.basename(file_path),
+                          mime_type="application/jsonl", purpose="fine-tune")
+    return {"upload_id": upload.id, "expires_at": upload.expires_at, "bytes": size,
+            "mtime": os.path.getmtime(file_path), "part_size": part_size,
+            "part_ids": [None] * max(1, -(-size // part_size)), "file_id": None}
+
+
+def upload_training_file(file_path, store=None, part_size=PART_SIZE, workers=UPLOAD_WORKERS, client=None):
     """
-    Uploads a JSONL dataset to OpenAI for fine-tuning using the new interface.
+    Uploads a JSONL dataset for fine-tuning in parts and returns its file ID.
+    Parts already uploaded by an earlier, interrupted call are skipped, and a file that was
+    already uploaded unchanged is not uploaded again.
     """
-    # Open the file in binary mode and upload using the File.create method.
-    with open(file_path, "rb") as file_data:
-        response = client.files.create(file=file_data, purpose="fine-tune")
-    return response.id
+    client = client or get_client()
+    store = store or JobStore()
+    key = os.path.abspath(file_path)
+    size = os.path.getsize(file_path)
+    record = store.get_upload(key)
+    unchanged = (record is not None and record["bytes"] == size and record["mtime"] == os.path.getmtime(file_path)
+                 and record["part_size"] == part_size)
+    if unchanged and record["file_id"]:
+        return record["file_id"]
+    if not unchanged or record["expires_at"] <= time.time():
+        record = _new_upload(client, file_path, size, part_size)
+        store.set_upload(key, record)
+    upload_id = record["upload_id"]
+
+    def send(index):
+        with open(file_path, "rb") as f:
+            f.seek(index * part_size)
+            data = f.read(part_size)
+        part = with_retries(client.uploads.parts.create, upload_id, data=data, timeout=600)
+        store.set_part(key, index, part.id)
+
+    missing = [i for i, part_id in enumerate(record["part_ids"]) if part_id is None]
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(send, missing))
+        upload = with_retries(client.uploads.complete, upload_id, part_ids=store.get_upload(key)["part_ids"])
+    except (openai.NotFoundError, openai.BadRequestError):
+        if not missing or len(missing) < len(record["part_ids"]):
+            # The resumed upload expired or was cancelled server-side; start over once.
+            store.set_upload(key, None)
+            return upload_training_file(file_path, store, part_size, workers, client)
+        raise
+    record = store.get_upload(key)
+    record["file_id"] = upload.file.id
+    store.set_upload(key, record)
+    return upload.file.id
 
 
-def create_fine_tune_job(training_file_id, model, n_epochs=3):
+def create_fine_tune_job(training_file_id, model=BASE_MODEL, n_epochs=3, suffix=None, store=None, client=None):
     """
-    Creates a fine-tuning job using the new FineTuningJob endpoint.
+    Creates a fine-tuning job and records it in the store so it can be tracked across restarts.
     """
-    response = client.fine_tuning.jobs.create(
-        training_file=training_file_id,
-        model="gpt-4o-mini-2024-07-18"
-    )
+    client = client or get_client()
+    store = store or JobStore()
+    options = {"suffix": suffix} if suffix else {}
+    job = with_retries(client.fine_tuning.jobs.create, training_file=training_file_id, model=model,
+                       hyperparameters={"n_epochs": n_epochs}, **options)
+    store.update_job(job.id, status=job.status, model=model, training_file=training_file_id, n_epochs=n_epochs,
+                     fine_tuned_model=None, last_event_id=None, created_at=job.created_at)
+    return job
 
-    return response
 
+class JobManager:
+    """
+    Tracks many fine-tuning jobs at once.
 
-def poll_fine_tune_job(fine_tune_job_id, interval=30):
+    Each job is polled on its own schedule: its new events are read first and the job itself is
+    only retrieved when there are new events or the poll interval has reached its maximum.
+    on_event(job_id, event) is called for every new event, in chronological order.
     """
-    Polls the fine-tuning job status every 'interval' seconds.
-    Returns the final job status.
+
+    def __init__(self, store=None, client=None, on_event=None, min_interval=MIN_POLL_INTERVAL,
+                 max_interval=MAX_POLL_INTERVAL):
+        self.store = store or JobStore()
+        self.client = client or get_client()
+        self.on_event = on_event or (lambda job_id, event: print(f"[{job_id}] {event.message}"))
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    def new_events(self, job_id):
+        """
+        Returns the job's events logged since the last one seen, oldest first.
+        Events are listed newest first, so pages are read until the last seen event.
+        """
+        last_seen = self.store.get_job(job_id).get("last_event_id")
+        events = []
+        page = with_retries(self.client.fine_tuning.jobs.list_events, job_id, limit=100)
+        while True:
+            for event in page.data:
+                if event.id == last_seen:
+                    return list(reversed(events))
+                events.append(event)
+            if not page.has_more or last_seen is None:
+                return list(reversed(events))
+            page = with_retries(self.client.fine_tuning.jobs.list_events, job_id, limit=100, after=page.data[-1].id)
+
+    def deliver_events(self, job_id):
+        """
+        Passes the job's new events to on_event and returns them.
+        """
+        events = self.new_events(job_id)
+        for event in events:
+            self.on_event(job_id, event)
+        if events:
+            self.store.update_job(job_id, last_event_id=events[-1].id)
+        return events
+
+    def poll(self, job_id, interval):
+        """
+        Polls one job and returns the interval until its next poll, or None once it has finished.
+        """
+        events = self.deliver_events(job_id)
+        if events or interval >= self.max_interval:
+            job = with_retries(self.client.fine_tuning.jobs.retrieve, job_id)
+            self.store.update_job(job_id, status=job.status, fine_tuned_model=job.fine_tuned_model,
+                                  error=job.error.message if job.error and job.error.message else None)
+            if job.status in TERMINAL_STATUSES:
+                # The job may have finished after its events were listed: its last events come now.
+                self.deliver_events(job_id)
+                return None
+        if events:
+            return self.min_interval
+        return min(self.max_interval, interval * POLL_BACKOFF)
+
+    def wait(self, job_ids=None):
+        """
+        Follows the given jobs, or every unfinished job in the store, until all have finished.
+        Returns the stored state of each job.
+        """
+        job_ids = list(job_ids or self.store.unfinished_jobs())
+        for job_id in job_ids:
+            if self.store.get_job(job_id) is None:
+                self.store.update_job(job_id, status=None, last_event_id=None)
+        schedule = [(time.monotonic(), job_id, self.min_interval) for job_id in job_ids]
+        heapq.heapify(schedule)
+        while schedule:
+            due, job_id, interval = heapq.heappop(schedule)
+            time.sleep(max(0.0, due - time.monotonic()))
+            next_interval = self.poll(job_id, interval)
+            if next_interval is not None:
+                heapq.heappush(schedule, (time.monotonic() + next_interval, job_id, next_interval))
+        return {job_id: self.store.get_job(job_id) for job_id in job_ids}
+
+
+def poll_fine_tune_job(fine_tune_job_id, interval=MIN_POLL_INTERVAL):
     """
-    while True:
-        job_status = client.fine_tuning.jobs.retrieve(fine_tune_job_id)
-        status = job_status.status
-        print("Fine-tuning job status:", status)
-        if status in ["succeeded", "failed", "cancelled"]:
-            return job_status
-        time.sleep(interval)
+    Follows one fine-tuning job until it finishes and returns its final state.
+    """
+    return JobManager(min_interval=interval).wait([fine_tune_job_id])[fine_tune_job_id]
+
+
+def print_status(store):
+    for job_id, job in sorted(store.jobs().items(), key=lambda item: item[1].get("created_at") or 0):
+        print(f"{job_id}: {job.get('status')} {job.get('fine_tuned_model') or ''}".rstrip())
 
 
 def main():
-    dataset_path = "/Users/michaelpignatelli/Documents/GitHub/ChatterBot/lingua_activities_chat.jsonl"  # Dataset from data_preparation.py
-
-    # 1) Upload the dataset
-    file_id = upload_training_file(dataset_path)
-    print("Uploaded training file. File ID:", file_id)
-
-    # 2) Create a fine-tuning job
-    # fine_tune_response = create_fine_tune_job(file_id, model="gpt-4o-mini-2024-07-18", n_epochs=3)
-    # fine_tune_job_id = fine_tune_response.id
-    fine_tune_job_id = "ftjob-cmmq68LLeaiqrhKmpJDcY10D"
-    print("Fine-tuning job created. ID:", fine_tune_job_id)
-
-    # 3) Poll the job status
-    final_status = poll_fine_tune_job(fine_tune_job_id, interval=30)
-    if final_status.status == "succeeded":
-        print("Fine-tuning succeeded.")
-        print("Your fine-tuned model is:", final_status.fine_tuned_model)
-    else:
-        print("Fine-tuning failed. Details:", final_status)
+    parser = argparse.ArgumentParser(description="Upload datasets and run fine-tuning jobs.")
+    parser.add_argument("--state", default=STATE_PATH, help="Local file the uploads and jobs are kept in.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    upload = commands.add_parser("upload", help="Upload (or resume uploading) a dataset.")
+    upload.add_argument("dataset")
+    create = commands.add_parser("create", help="Upload a dataset and start a fine-tuning job on it.")
+    create.add_argument("dataset", nargs="+", help="One job is started per dataset.")
+    create.add_argument("--model", default=BASE_MODEL)
+    create.add_argument("--epochs", type=int, default=3)
+    create.add_argument("--suffix")
+    create.add_argument("--no-watch", action="store_true", help="Return once the jobs are created.")
+    watch = commands.add_parser("watch", help="Follow jobs until they finish.")
+    watch.add_argument("job_ids", nargs="*", help="Defaults to every unfinished job in the state file.")
+    commands.add_parser("status", help="Show the stored state of every job.")
+    args = parser.parse_args()
+
+    store = JobStore(args.state)
+    if args.command == "upload":
+        print("Uploaded training file. File ID:", upload_training_file(args.dataset, store))
+        return
+    if args.command == "status":
+        print_status(store)
+        return
+    job_ids = args.job_ids if args.command == "watch" else []
+    if args.command == "create":
+        for dataset in args.dataset:
+            file_id = upload_training_file(dataset, store)
+            print("Uploaded training file. File ID:", file_id)
+            job = create_fine_tune_job(file_id, model=args.model, n_epochs=args.epochs, suffix=args.suffix,
+                                       store=store)
+            print("Fine-tuning job created. ID:", job.id)
+            job_ids.append(job.id)
+        if args.no_watch:
+            return
+    for job_id, job in JobManager(store).wait(job_ids).items():
+        if job["status"] == "succeeded":
+            print(f"Fine-tuning {job_id} succeeded. Your fine-tuned model is: {job['fine_tuned_model']}")
+        else:
+            print(f"Fine-tuning {job_id} {job['status']}. Details: {job.get('error')}")
 
 
 if __name__ == "__main__":
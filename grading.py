@@ -0,0 +1,178 @@
+"""
+grading.py
+
+Local, rule-based grading of exercises with a known reference solution.
+
+Answers are compared after case, accent and whitespace normalization. A Q&A answer only counts as
+correct when it is the expected answer, alone or in a short sentence of filler words; near misses
+are left to the model, since a typo may well be another word. Vocabulary pairs tolerate a small
+edit distance, and the English side of a pair may have its article or not ("the cat" is "cat").
+Correct answers are confirmed without a model call; wrong or ungradeable answers are left to the
+model for explanatory feedback.
+"""
+
+import re
+
+from exercises import parse_pairs
+from response_cache import normalize_text
+
+_PUNCTUATION = re.compile(r"[^\w\s'-]", re.UNICODE)
+# French articles a learner may or may not put in front of a one-word answer; only whole articles.
+_ARTICLES = re.compile(r"^(?:(?:les?|la|une?|des|du|de la)\s+|l'|de l')")
+# English articles, stripped from the English side of vocabulary pairs.
+_ENGLISH_ARTICLES = re.compile(r"^(?:the|an?)\s+")
+# Words, after normalization, a learner may put around a short answer without changing it, as in
+# "c'est la pomme" or "je pense que c'est Paris". Elided words keep their apostrophe.
+_FILLER_WORDS = {"c'", "ce", "est", "sont", "le", "la", "les", "l'", "un", "une", "des", "du", "de", "d'",
+                 "je", "j'", "pense", "crois", "que", "qu'", "ma", "reponse"}
+
+
+class GradeResult:
+    """
+    Outcome of grading an answer. correct is None when the exercise can't be graded locally.
+    """
+
+    def __init__(self, correct, feedback=None, mistakes=None):
+        self.correct = correct
+        self.feedback = feedback
+        self.mistakes = mistakes or []
+
+    def __repr__(self):
+        return f"GradeResult(correct={self.correct!r}, feedback={self.feedback!r}, mistakes={self.mistakes!r})"
+
+
+def normalize_answer(text, strip_articles=True):
+    """
+    Normalizes an answer for comparison: case, accents, punctuation, whitespace and leading articles.
+    """
+    text = normalize_text(_PUNCTUATION.sub(" ", text))
+    return _ARTICLES.sub("", text).strip() if strip_articles else text
+
+
+def normalize_translation(text):
+    """
+    Normalizes the English side of a vocabulary pair: as normalize_answer, plus a leading "the",
+    "a" or "an".
+    """
+    return _ENGLISH_ARTICLES.sub("", normalize_answer(text))
+
+
+def edit_distance(a, b):
+    """
+    Levenshtein distance between two strings.
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def allowed_typos(expected):
+    """
+    Number of edits tolerated for an expected answer: none for short words, up to two for long ones.
+    """
+    if len(expected) <= 3:
+        return 0
+    if len(expected) <= 7:
+        return 1
+    return 2
+
+
+def matches(expected, given, normalize=normalize_answer):
+    """
+    Returns (is_match, is_exact) for two answers after normalization.
+    """
+    expected, given = normalize(expected), normalize(given)
+    if not expected or not given:
+        return False, False
+    if expected == given:
+        return True, True
+    return edit_distance(expected, given) <= allowed_typos(expected), False
+
+
+def answer_words(text, strip_articles=True):
+    """
+    Normalized words of an answer; elided words ("l'eau", "c'est") are split off.
+    """
+    return normalize_answer(text, strip_articles).replace("'", "' ").split()
+
+
+def grade_q_and_a(expected, user_answer):
+    """
+    Grades a one-word answer. It is correct when it is the expected answer, possibly within filler
+    words ("c'est la ..."), and wrong when neither it nor any of its words comes close. Anything in
+    between, such as a typo or a sentence that may negate or hedge the answer, can't be graded here.
+    """
+    target, given = answer_words(expected), answer_words(user_answer)
+    if not target:
+        return GradeResult(None)
+    for start in range(len(given) - len(target) + 1):
+        others = given[:start] + given[start + len(target):]
+        if given[start:start + len(target)] == target and all(word in _FILLER_WORDS for word in others):
+            return GradeResult(True, f"Correct! « {expected} » is the right answer. Très bien !")
+    if matches(expected, user_answer)[0] or any(matches(expected, word)[0] for word in given):
+        return GradeResult(None)
+    return GradeResult(False, mistakes=[(expected, user_answer)])
+
+
+def grade_fill_in_the_blank(expected, user_answer):
+    """
+    Grades the word(s) filling a blank. No typos are tolerated, as a blank often tests spelling or
+    agreement; the learner may answer with the whole sentence.
+    """
+    words = " ".join(answer_words(expected, strip_articles=False))
+    if words and f" {words} " in f" {' '.join(answer_words(user_answer, strip_articles=False))} ":
+        return GradeResult(True, f"Correct! « {expected} » fills the blank. Très bien !")
+    return GradeResult(False, mistakes=[(expected, user_answer)])
+
+
+def grade_vocabulary_matching(pairs, user_answer):
+    """
+    Grades a vocabulary matching answer given as "french: english, ..." against the reference pairs.
+    An answer in which none of the French words can be found, e.g. "1-B, 2-A", is left to the model.
+    """
+    given = {normalize_answer(french): english for french, english in parse_pairs(user_answer).items()}
+    mistakes = []
+    typos = []
+    found = 0
+    for french, english in pairs.items():
+        answered = given.get(normalize_answer(french))
+        if answered is None:
+            # Fall back to a fuzzy lookup of the French word itself.
+            for given_french, given_english in given.items():
+                if matches(french, given_french)[0]:
+                    answered = given_english
+                    break
+        found += answered is not None
+        is_match, is_exact = matches(english, answered, normalize_translation) if answered else (False, False)
+        if not is_match:
+            mistakes.append((french, english, answered))
+        elif not is_exact:
+            typos.append((french, english))
+    if not found:
+        return GradeResult(None)
+    if mistakes:
+        return GradeResult(False, mistakes=mistakes)
+    feedback = f"Correct! All {len(pairs)} pairs are matched correctly. Très bien !"
+    if typos:
+        feedback += " Watch the spelling of: " + ", ".join(f"{french} = {english}" for french, english in typos) + "."
+    return GradeResult(True, feedback)
+
+
+def grade(exercise, user_answer):
+    """
+    Grades an answer to an exercise locally. Returns a GradeResult whose correct attribute is
+    None when the exercise has no reference solution that can be checked without the model.
+    """
+    if exercise.task_type == "q_and_a" and exercise.answer:
+        return grade_q_and_a(exercise.answer, user_answer)
+    if exercise.task_type == "fill_in_the_blank" and exercise.answer:
+        return grade_fill_in_the_blank(exercise.answer, user_answer)
+    if exercise.task_type == "vocabulary_matching" and exercise.pairs:
+        return grade_vocabulary_matching(exercise.pairs, user_answer)
+    return GradeResult(None)
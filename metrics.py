@@ -0,0 +1,317 @@
+"""
+metrics.py
+
+Latency and token instrumentation for model calls.
+
+Every call made through model_client is recorded per task (e.g. "q_and_a.verify"): latency
+quantiles over a sliding window, time to first token for streams, prompt/completion tokens,
+retries and errors. Cache lookups and gauges such as the exercise pool's are recorded alongside.
+The registry renders as Prometheus text (start_http_server serves it next to the Gradio app) or
+as JSON for CLI runs.
+"""
+
+import collections
+import json
+import logging
+import math
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Number of most recent samples quantiles are computed over, per task.
+WINDOW_SIZE = int(os.getenv("CHATTERBOT_METRICS_WINDOW", "4096"))
+QUANTILES = (0.5, 0.95, 0.99)
+# Port of the Prometheus endpoint started by the app, off by default, and the address it binds to;
+# set CHATTERBOT_METRICS_HOST=0.0.0.0 to let a scraper on another host reach it.
+METRICS_PORT = int(os.getenv("CHATTERBOT_METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("CHATTERBOT_METRICS_HOST", "127.0.0.1")
+# File the CLI scripts write their metrics to on exit, if set.
+METRICS_JSON = os.getenv("CHATTERBOT_METRICS_JSON")
+
+
+def quantile(sorted_values, q):
+    """
+    Nearest-rank quantile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(q * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class Window:
+    """
+    Count and sum of every observation plus a sliding window of recent ones for quantiles.
+    """
+
+    def __init__(self, size=WINDOW_SIZE):
+        self.count = 0
+        self.total = 0.0
+        self.samples = collections.deque(maxlen=size)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.samples.append(value)
+
+    def summary(self):
+        values = sorted(self.samples)
+        return {
+            "count": self.count,
+            "sum": self.total,
+            **{f"p{int(q * 100)}": quantile(values, q) for q in QUANTILES},
+        }
+
+
+class CallTimer:
+    """
+    Times one model call. Streams call first_token() when the first content arrives.
+    """
+
+    def __init__(self, registry, task):
+        self.registry = registry
+        self.task = task
+        self.started = time.perf_counter()
+        self.first_token_at = None
+        self.done = False
+
+    def first_token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+    def finish(self, usage=None):
+        if self.done:
+            return
+        self.done = True
+        ttft = self.first_token_at - self.started if self.first_token_at is not None else None
+        self.registry.observe_call(self.task, time.perf_counter() - self.started, ttft=ttft,
+                                   prompt_tokens=getattr(usage, "prompt_tokens", None),
+                                   completion_tokens=getattr(usage, "completion_tokens", None))
+
+    def fail(self, error):
+        if self.done:
+            return
+        self.done = True
+        self.registry.observe_error(self.task, type(error).__name__)
+
+
+class TrackedStream:
+    """
+    Wraps a chat completion stream to record time to first token, total latency and usage.
+    Works for both sync and async streams. on_finish, if given, is called with the usage (None if
+    the stream sent none) once the stream has been read.
+    """
+
+    def __init__(self, stream, timer, on_finish=None):
+        self.stream = stream
+        self.timer = timer
+        self.on_finish = on_finish
+        self.usage = None
+
+    def _observe(self, chunk):
+        if getattr(chunk, "usage", None) is not None:
+            self.usage = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            self.timer.first_token()
+
+    def _finish(self):
+        self.timer.finish(self.usage)
+        if self.on_finish is not None:
+            self.on_finish(self.usage)
+            self.on_finish = None
+
+    def __iter__(self):
+        try:
+            for chunk in self.stream:
+                self._observe(chunk)
+                yield chunk
+        except Exception as e:
+            self.timer.fail(e)
+            raise
+        finally:
+            self._finish()
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.stream:
+                self._observe(chunk)
+                yield chunk
+        except Exception as e:
+            self.timer.fail(e)
+            raise
+        finally:
+            self._finish()
+
+    def close(self):
+        """
+        Closes a sync stream without reading it, e.g. a hedged request that lost; it isn't recorded.
+        """
+        self.timer.done = True
+        self.stream.close()
+
+    async def aclose(self):
+        """
+        Asyncio variant of close.
+        """
+        self.timer.done = True
+        await self.stream.close()
+
+
+class Metrics:
+    """
+    Thread-safe registry of model call metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = collections.defaultdict(Window)
+        self._ttft = collections.defaultdict(Window)
+        self._counters = collections.Counter()
+        self._collectors = []
+        self.started = time.time()
+
+    def start_call(self, task):
+        return CallTimer(self, task or "unknown")
+
+    def observe_call(self, task, latency, ttft=None, prompt_tokens=None, completion_tokens=None):
+        with self._lock:
+            self._latency[task].observe(latency)
+            if ttft is not None:
+                self._ttft[task].observe(ttft)
+            self._counters[("calls", task, "")] += 1
+            if prompt_tokens:
+                self._counters[("prompt_tokens", task, "")] += prompt_tokens
+            if completion_tokens:
+                self._counters[("completion_tokens", task, "")] += completion_tokens
+
+    def observe_error(self, task, kind):
+        with self._lock:
+            self._counters[("errors", task, kind)] += 1
+
+    def observe_retry(self, task, kind):
+        with self._lock:
+            self._counters[("retries", task or "unknown", kind)] += 1
+
+    def observe_cache(self, task, hit):
+        with self._lock:
+            self._counters[("cache_hits" if hit else "cache_misses", task or "unknown", "")] += 1
+
+    def increment(self, name, task="", amount=1):
+        """
+        Increments a free-form counter, e.g. for other modules' events.
+        """
+        with self._lock:
+            self._counters[(name, task, "")] += amount
+
+    def register_collector(self, name, collect):
+        """
+        Registers collect() -> {gauge_name: number}, read every time the metrics are rendered.
+        """
+        self._collectors.append((name, collect))
+
+    def to_json(self):
+        """
+        Returns every metric as a JSON-serializable dict.
+        """
+        with self._lock:
+            tasks = collections.defaultdict(dict)
+            for task, window in self._latency.items():
+                tasks[task]["latency_seconds"] = window.summary()
+            for task, window in self._ttft.items():
+                tasks[task]["time_to_first_token_seconds"] = window.summary()
+            for (name, task, kind), value in self._counters.items():
+                if kind:
+                    tasks[task].setdefault(name, {})[kind] = value
+                else:
+                    tasks[task][name] = value
+        gauges = {name: collect() for name, collect in self._collectors}
+        return {"uptime_seconds": time.time() - self.started, "tasks": dict(tasks), "gauges": gauges}
+
+    def render_prometheus(self):
+        """
+        Renders the metrics in the Prometheus text exposition format.
+        """
+        data = self.to_json()
+        lines = []
+
+        def summary(metric, key):
+            lines.append(f"# TYPE {metric} summary")
+            for task, values in sorted(data["tasks"].items()):
+                if key not in values:
+                    continue
+                for q in QUANTILES:
+                    lines.append(f'{metric}{{task="{task}",quantile="{q}"}} {values[key][f"p{int(q * 100)}"]:.6f}')
+                lines.append(f'{metric}_sum{{task="{task}"}} {values[key]["sum"]:.6f}')
+                lines.append(f'{metric}_count{{task="{task}"}} {values[key]["count"]}')
+
+        summary("chatterbot_model_call_latency_seconds", "latency_seconds")
+        summary("chatterbot_model_time_to_first_token_seconds", "time_to_first_token_seconds")
+        for name in ["calls", "prompt_tokens", "completion_tokens", "cache_hits", "cache_misses", "coalesced_calls",
+                     "hedged_calls", "hedge_wins"]:
+            lines.append(f"# TYPE chatterbot_{name}_total counter")
+            for task, values in sorted(data["tasks"].items()):
+                if name in values:
+                    lines.append(f'chatterbot_{name}_total{{task="{task}"}} {values[name]}')
+        for name in ["errors", "retries"]:
+            lines.append(f"# TYPE chatterbot_{name}_total counter")
+            for task, values in sorted(data["tasks"].items()):
+                for kind, value in sorted(values.get(name, {}).items()):
+                    lines.append(f'chatterbot_{name}_total{{task="{task}",type="{kind}"}} {value}')
+        for collector, gauges in sorted(data["gauges"].items()):
+            for name, value in sorted(gauges.items()):
+                if isinstance(value, (int, float)):
+                    lines.append(f"# TYPE chatterbot_{collector}_{name} gauge")
+                    lines.append(f"chatterbot_{collector}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def dump_json(self, path):
+        with open(path, "w", encoding="utf8") as f:
+            json.dump(self.to_json(), f, indent=2)
+
+
+registry = Metrics()
+
+
+def start_http_server(port=METRICS_PORT, host=METRICS_HOST, metrics=registry):
+    """
+    Serves /metrics (Prometheus text) and /metrics.json from a background thread. Returns the
+    server, or None if the port can't be bound: metrics are never worth failing the app for.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = metrics.render_prometheus().encode("utf8"), "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body, content_type = json.dumps(metrics.to_json()).encode("utf8"), "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer((host, port), Handler)
+    except OSError as e:
+        logger.warning("Metrics endpoint not started, can't bind %s:%s: %s", host, port, e)
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+def dump_on_exit(path=METRICS_JSON, metrics=registry):
+    """
+    Writes the metrics to path as JSON, if a path is configured. Used by the CLI scripts.
+    """
+    if path:
+        metrics.dump_json(path)
+        print(f"Metrics written to {path}.")
@@ -0,0 +1,459 @@
+"""
+mock_server.py
+
+Local mock of the OpenAI API for benchmarks and offline runs, so no API money is spent.
+
+Serves /v1/chat/completions (streaming and not, JSON mode included), the legacy /v1/completions
+and /v1/models with configurable latency, token-rate and error-rate distributions. Responses are
+shaped like the real model's for each task (hidden solution lines, JSON exercise batches,
+feedback, conversation replies) so the app's parsing and grading paths run as in production.
+Fakes of the uploads and fine-tuning jobs endpoints let fine_tune.py run end to end offline.
+
+Usage:
+    python mock_server.py --port 8001 --latency-ms 400 --tokens-per-second 60
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=mock python app.py
+"""
+
+import argparse
+import email.parser
+import email.policy
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+WORDS = ("bonjour merci le la les un une de du des et est sont avec pour dans sur chat chien maison "
+         "ville pain fromage eau lait pomme école livre musique voyage marché cuisine jardin soleil").split()
+VOCABULARY = [("le chat", "the cat"), ("le chien", "the dog"), ("la maison", "the house"), ("la ville", "the city"),
+              ("le pain", "the bread"), ("le fromage", "the cheese"), ("l'eau", "the water"), ("le lait", "the milk"),
+              ("la pomme", "the apple"), ("l'école", "the school"), ("le livre", "the book"), ("le jardin", "the garden")]
+ANSWERS = ["pomme", "Paris", "chat", "rouge", "pain", "lundi", "eau", "soleil"]
+
+
+class MockConfig:
+    """
+    Latency and content distributions of the mock server.
+
+    latency_ms: median time before the first token, drawn from a log-normal with latency_sigma.
+    tokens_per_second: mean generation speed; each token's delay is jittered by token_jitter.
+    output_tokens: mean completion length when max_tokens allows it.
+    error_rate: share of requests answered with a 429 (half) or a 500 (half).
+    """
+
+    def __init__(self, latency_ms=300.0, latency_sigma=0.4, tokens_per_second=60.0, token_jitter=0.3,
+                 output_tokens=60, error_rate=0.0, seed=None):
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.token_jitter = token_jitter
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def first_token_delay(self):
+        with self.lock:
+            return self.latency_ms / 1000 * self.random.lognormvariate(0, self.latency_sigma)
+
+    def token_delay(self):
+        if self.tokens_per_second <= 0:
+            return 0.0
+        with self.lock:
+            jitter = self.random.uniform(1 - self.token_jitter, 1 + self.token_jitter)
+        return jitter / self.tokens_per_second
+
+    def completion_length(self, max_tokens):
+        with self.lock:
+            length = max(1, int(self.random.expovariate(1 / self.output_tokens)) + 1)
+        return min(length, max_tokens or length)
+
+    def error(self):
+        with self.lock:
+            if self.random.random() >= self.error_rate:
+                return None
+            return 429 if self.random.random() < 0.5 else 500
+
+
+def filler(count, rng):
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def mock_content(body, config):
+    """
+    Builds a completion shaped like the real model's answer to the request's prompt.
+    """
+    rng = config.random
+    messages = body.get("messages") or [{"role": "user", "content": body.get("prompt", "")}]
+    prompt = str(messages[-1].get("content") or "")
+    length = config.completion_length(body.get("max_tokens"))
+    with config.lock:
+        if (body.get("response_format") or {}).get("type") == "json_object":
+            count = int((re.search(r"Generate (\d+)", prompt) or [0, 1])[1])
+            if "French words with their English translations" in prompt:
+                items = [{"pairs": dict(rng.sample(VOCABULARY, 5))} for _ in range(count)]
+            elif "___" in prompt:
+                items = [{"text": f"Je ___ {filler(4, rng)}.", "answer": rng.choice(WORDS)} for _ in range(count)]
+            elif "one-word answer" in prompt:
+                items = [{"text": f"{filler(6, rng).capitalize()} ?", "answer": rng.choice(ANSWERS)}
+                         for _ in range(count)]
+            else:
+                items = [{"text": f"{filler(12, rng).capitalize()} ?"} for _ in range(count)]
+            return json.dumps({"exercises": items}, ensure_ascii=False)
+        if prompt.startswith("Solve this exercise"):
+            if "pairs" in prompt:
+                pairs = [(fr, en) for fr, en in VOCABULARY if fr in prompt] or rng.sample(VOCABULARY, 5)
+                return "SOLUTION: " + "; ".join(f"{fr}={en}" for fr, en in pairs)
+            return f"SOLUTION: {rng.choice(ANSWERS)}"
+        if "SOLUTION:" in prompt and "pairs" in prompt:
+            pairs = rng.sample(VOCABULARY, 5)
+            english = [en for _, en in pairs]
+            rng.shuffle(english)
+            return ("French words: " + ", ".join(fr for fr, _ in pairs) + "\nEnglish translations: "
+                    + ", ".join(english) + "\nSOLUTION: " + "; ".join(f"{fr}={en}" for fr, en in pairs))
+        if "SOLUTION:" in prompt:
+            return f"{filler(max(length - 2, 3), rng).capitalize()} ?\nSOLUTION: {rng.choice(ANSWERS)}"
+        if "Correct answer:" in prompt or "User's answer" in prompt or "User's matching" in prompt:
+            return "Incorrect. " + filler(length, rng)
+        return filler(length, rng).capitalize() + "."
+
+
+def usage_for(body, content):
+    prompt = json.dumps(body.get("messages") or body.get("prompt", ""), ensure_ascii=False)
+    prompt_tokens = max(1, len(prompt) // 4)
+    completion_tokens = max(1, len(content.split()))
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+class FakeFineTuning:
+    """
+    In-memory fake of the uploads and fine-tuning jobs endpoints. A job goes through
+    validating_files, queued and running to succeeded in job_seconds, logging events on the way.
+    """
+
+    UPLOAD_LIFETIME = 3600
+
+    def __init__(self, job_seconds=10.0, steps=5):
+        self.job_seconds = job_seconds
+        self.steps = steps
+        self.uploads = {}
+        self.files = {}
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def _id(self, prefix):
+        return f"{prefix}-{next(self._ids):08d}"
+
+    def create_upload(self, body):
+        with self.lock:
+            upload = {"id": self._id("upload"), "object": "upload", "bytes": body["bytes"],
+                      "filename": body["filename"], "purpose": body["purpose"], "status": "pending",
+                      "created_at": int(time.time()), "expires_at": int(time.time()) + self.UPLOAD_LIFETIME,
+                      "file": None, "_parts": {}}
+            self.uploads[upload["id"]] = upload
+            return self._public(upload)
+
+    def add_part(self, upload_id, data):
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if upload is None or upload["status"] != "pending":
+                return None
+            part = {"id": self._id("part"), "object": "upload.part", "created_at": int(time.time()),
+                    "upload_id": upload_id}
+            upload["_parts"][part["id"]] = len(data)
+            return part
+
+    def complete_upload(self, upload_id, part_ids):
+        """
+        Returns (status code, payload); the parts' sizes have to add up to the announced bytes.
+        """
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if upload is None:
+                return 404, error_payload(f"No upload with ID {upload_id}")
+            if any(part_id not in upload["_parts"] for part_id in part_ids):
+                return 400, error_payload("Unknown part ID")
+            size = sum(upload["_parts"][part_id] for part_id in part_ids)
+            if size != upload["bytes"]:
+                return 400, error_payload(f"Parts hold {size} bytes, expected {upload['bytes']}")
+            file = {"id": self._id("file"), "object": "file", "bytes": size, "created_at": int(time.time()),
+                    "filename": upload["filename"], "purpose": upload["purpose"], "status": "processed"}
+            self.files[file["id"]] = file
+            upload["status"], upload["file"] = "completed", file
+            return 200, self._public(upload)
+
+    def create_job(self, body):
+        with self.lock:
+            if body.get("training_file") not in self.files:
+                return 400, error_payload(f"Invalid training file {body.get('training_file')}")
+            job = {"id": self._id("ftjob"), "object": "fine_tuning.job", "created_at": int(time.time()),
+                   "model": body["model"], "training_file": body["training_file"], "validation_file": None,
+                   "hyperparameters": {"n_epochs": (body.get("hyperparameters") or {}).get("n_epochs", "auto"),
+                                       "batch_size": "auto", "learning_rate_multiplier": "auto"},
+                   "organization_id": "org-mock", "result_files": [], "seed": 0, "status": "validating_files",
+                   "fine_tuned_model": None, "finished_at": None, "trained_tokens": None, "error": None,
+                   "_started": time.monotonic(), "_events": [], "_milestone": -1}
+            self.jobs[job["id"]] = job
+            self._advance(job)
+            return 200, self._public(job)
+
+    def _log(self, job, message):
+        job["_events"].insert(0, {"id": self._id("ftevent"), "object": "fine_tuning.job.event",
+                                  "created_at": int(time.time()), "level": "info", "message": message,
+                                  "type": "message"})
+
+    def _advance(self, job):
+        # Milestones: 0 validating, 1 queued, 2 running, 3.. one per training step, last succeeded.
+        progress = (time.monotonic() - job["_started"]) / self.job_seconds if self.job_seconds else 1.0
+        reached = min(self.steps + 3, int(progress * (self.steps + 3)))
+        while job["_milestone"] < reached:
+            job["_milestone"] += 1
+            milestone = job["_milestone"]
+            if milestone == 0:
+                self._log(job, f"Validating training file: {job['training_file']}")
+            elif milestone == 1:
+                job["status"] = "queued"
+                self._log(job, "Files validated, moving job to queued state")
+            elif milestone == 2:
+                job["status"] = "running"
+                self._log(job, "Fine-tuning job started")
+            elif milestone < self.steps + 3:
+                self._log(job, f"Step {milestone - 2}/{self.steps}: training loss={1.0 / (milestone - 1):.2f}")
+            else:
+                job["status"], job["finished_at"] = "succeeded", int(time.time())
+                job["fine_tuned_model"] = f"ft:{job['model']}:mock::{job['id'][-8:]}"
+                job["trained_tokens"] = self.files[job["training_file"]]["bytes"] // 4
+                self._log(job, "The job has successfully completed")
+
+    def job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            self._advance(job)
+            return self._public(job)
+
+    def events(self, job_id, after=None, limit=20):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            self._advance(job)
+            events = job["_events"]
+            if after:
+                ids = [event["id"] for event in events]
+                events = events[ids.index(after) + 1:] if after in ids else []
+            return {"object": "list", "data": events[:limit], "has_more": len(events) > limit}
+
+    @staticmethod
+    def _public(record):
+        return {key: value for key, value in record.items() if not key.startswith("_")}
+
+
+def error_payload(message, kind="invalid_request_error"):
+    return {"error": {"message": message, "type": kind}}
+
+
+def multipart_field(body, content_type, name):
+    """
+    Returns the value of one field of a multipart/form-data body.
+    """
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode("latin1") + b"\r\n\r\n" + body)
+    for part in message.iter_parts():
+        if part.get_param("name", header="content-disposition") == name:
+            return part.get_payload(decode=True)
+    return None
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = MockConfig()
+    fine_tuning = FakeFineTuning()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def read_json(self):
+        return json.loads(self.read_body() or b"{}")
+
+    def send_result(self, payload, missing):
+        if payload is None:
+            self.send_json(404, error_payload(missing))
+        else:
+            self.send_json(200, payload)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = url.path.strip("/").split("/")
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if parts == ["v1", "models"]:
+            self.send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+        elif parts[:3] == ["v1", "fine_tuning", "jobs"] and len(parts) == 4:
+            self.send_result(self.fine_tuning.job(parts[3]), f"No job with ID {parts[3]}")
+        elif parts[:3] == ["v1", "fine_tuning", "jobs"] and len(parts) == 5 and parts[4] == "events":
+            events = self.fine_tuning.events(parts[3], after=query.get("after"), limit=int(query.get("limit", 20)))
+            self.send_result(events, f"No job with ID {parts[3]}")
+        else:
+            self.send_json(404, error_payload(f"Unknown path {self.path}"))
+
+    def do_POST(self):
+        parts = urlsplit(self.path).path.strip("/").split("/")
+        if parts == ["v1", "uploads"]:
+            self.send_json(200, self.fine_tuning.create_upload(self.read_json()))
+        elif parts[:2] == ["v1", "uploads"] and parts[3:] == ["parts"]:
+            data = multipart_field(self.read_body(), self.headers.get("Content-Type", ""), "data")
+            self.send_result(self.fine_tuning.add_part(parts[2], data or b""), f"No pending upload {parts[2]}")
+        elif parts[:2] == ["v1", "uploads"] and parts[3:] == ["complete"]:
+            self.send_json(*self.fine_tuning.complete_upload(parts[2], self.read_json().get("part_ids", [])))
+        elif parts == ["v1", "fine_tuning", "jobs"]:
+            self.send_json(*self.fine_tuning.create_job(self.read_json()))
+        elif parts in (["v1", "chat", "completions"], ["v1", "completions"]):
+            self.complete()
+        else:
+            self.read_body()
+            self.send_json(404, error_payload(f"Unknown path {self.path}"))
+
+    def complete(self):
+        body = self.read_json()
+        status = self.config.error()
+        if status is not None:
+            kind = "rate_limit_exceeded" if status == 429 else "server_error"
+            self.send_json(status, error_payload("Injected mock error", kind),
+                           headers={"retry-after-ms": "200"} if status == 429 else None)
+            return
+        chat = urlsplit(self.path).path.rstrip("/") == "/v1/chat/completions"
+        content = mock_content(body, self.config)
+        time.sleep(self.config.first_token_delay())
+        if body.get("stream"):
+            self.stream(body, content, chat)
+        else:
+            tokens = content.split(" ")
+            time.sleep(sum(self.config.token_delay() for _ in tokens[1:]))
+            self.send_json(200, self.completion(body, content, chat))
+
+    def completion(self, body, content, chat):
+        choice = ({"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                  if chat else {"index": 0, "text": content, "finish_reason": "stop"})
+        return {"id": f"mock-{uuid.uuid4().hex}", "object": "chat.completion" if chat else "text_completion",
+                "created": int(time.time()), "model": body.get("model", "mock"), "choices": [choice],
+                "usage": usage_for(body, content)}
+
+    def stream(self, body, content, chat):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        completion_id = f"mock-{uuid.uuid4().hex}"
+        tokens = content.split(" ")
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(self.config.token_delay())
+            text = token if i == 0 else " " + token
+            choice = ({"index": 0, "delta": {"content": text}, "finish_reason": None}
+                      if chat else {"index": 0, "text": text, "finish_reason": None})
+            self.write_event({"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                              "model": body.get("model", "mock"), "choices": [choice]})
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self.write_event({"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                              "model": body.get("model", "mock"), "choices": [], "usage": usage_for(body, content)})
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+    def write_event(self, payload):
+        self.write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf8"))
+
+    def write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 drops connections when many simulated learners start at once.
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-response, e.g. a cancelled hedged request, are expected.
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+
+class MockServer:
+    """
+    Runs the mock API in a background thread. base_url is ready to use as OPENAI_BASE_URL.
+    """
+
+    def __init__(self, config=None, host="127.0.0.1", port=0, handler=MockHandler, fine_tuning=None):
+        handler = type("ConfiguredMockHandler", (handler,), {"config": config or MockConfig(),
+                                                             "fine_tuning": fine_tuning or FakeFineTuning()})
+        self.server = MockHTTPServer((host, port), handler)
+        self.base_url = f"http://{host}:{self.server.server_address[1]}/v1"
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mock-openai", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def add_config_arguments(parser):
+    """
+    Adds the MockConfig options to an argparse parser, shared with benchmark.py.
+    """
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="Median time to first token.")
+    parser.add_argument("--latency-sigma", type=float, default=0.4, help="Log-normal spread of the latency.")
+    parser.add_argument("--tokens-per-second", type=float, default=60.0)
+    parser.add_argument("--output-tokens", type=int, default=60, help="Mean completion length.")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int)
+
+
+def config_from_args(args):
+    return MockConfig(latency_ms=args.latency_ms, latency_sigma=args.latency_sigma,
+                      tokens_per_second=args.tokens_per_second, output_tokens=args.output_tokens,
+                      error_rate=args.error_rate, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local mock of the OpenAI API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--fine-tune-seconds", type=float, default=10.0, help="Time a fake fine-tuning job takes.")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    server = MockServer(config_from_args(args), host=args.host, port=args.port,
+                        fine_tuning=FakeFineTuning(job_seconds=args.fine_tune_seconds))
+    print(f"Mock OpenAI API listening on {server.base_url}", flush=True)
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
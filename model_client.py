@@ -0,0 +1,419 @@
+"""
+model_client.py
+
+Shared OpenAI client used by app_integration.py, fine_tune.py and usage.py.
+
+Provides one tuned HTTP connection pool per process, per-call deadlines, retries with jittered
+exponential backoff and client-side rate limiting against requests-per-minute and
+tokens-per-minute budgets. Calls over budget wait their turn instead of failing with a 429; the
+first attempt of every chat or completion call is admitted by the priority scheduler, which
+hands out the budget to interactive work first and sheds calls it can't serve in time.
+Set OPENAI_BASE_URL to point every script at another OpenAI-compatible server, e.g. a local mock.
+Every call is recorded in metrics under the task it was made for.
+openai and httpx are only imported when the first client is created, which keeps importing the
+app cheap for tests and fast container start-up.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+from metrics import TrackedStream, registry as metrics
+from scheduler import Scheduler
+from tokens import count_message_tokens, count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Connection pool sizing, shared by every request made through the client.
+MAX_CONNECTIONS = int(os.getenv("CHATTERBOT_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("CHATTERBOT_MAX_KEEPALIVE_CONNECTIONS", "20"))
+KEEPALIVE_EXPIRY = 30.0
+# Timeouts in seconds. REQUEST_TIMEOUT is the default deadline of a call, retries included.
+CONNECT_TIMEOUT = float(os.getenv("CHATTERBOT_CONNECT_TIMEOUT", "5"))
+REQUEST_TIMEOUT = float(os.getenv("CHATTERBOT_REQUEST_TIMEOUT", "60"))
+# Retries with exponential backoff and full jitter.
+MAX_RETRIES = int(os.getenv("CHATTERBOT_MAX_RETRIES", "4"))
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 20.0
+# Client-side rate limits; keep them at or just below the account's limits for the model.
+REQUESTS_PER_MINUTE = float(os.getenv("CHATTERBOT_REQUESTS_PER_MINUTE", "500"))
+TOKENS_PER_MINUTE = float(os.getenv("CHATTERBOT_TOKENS_PER_MINUTE", "200000"))
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a call can't complete, or wait for rate-limit capacity, before its deadline.
+    """
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at rate_per_minute, holding at most one minute of budget.
+
+    Capacity is reserved up front, so callers that have to wait are served in arrival order:
+    a reservation returns how long the caller must wait before it may proceed.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self._available = rate_per_minute
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, amount, max_wait=None):
+        """
+        Reserves amount and returns the number of seconds to wait before using it. Returns None,
+        reserving nothing, when the wait would be longer than max_wait.
+        """
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._available = min(self.capacity, self._available + (now - self._updated) * self.rate)
+            self._updated = now
+            wait = max(self._paused_until - now, 0.0)
+            if self._available < amount:
+                wait = max(wait, (amount - self._available) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self._available -= amount
+            return wait
+
+    def wait_time(self, amount):
+        """
+        Seconds until amount could be reserved without waiting, reserving nothing.
+        """
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            available = min(self.capacity, self._available + (now - self._updated) * self.rate)
+            return max(self._paused_until - now, (amount - available) / self.rate, 0.0)
+
+    def refund(self, amount):
+        """
+        Gives back capacity reserved but not used, e.g. when fewer tokens were used than estimated.
+        """
+        with self._lock:
+            self._available = min(self.capacity, self._available + amount)
+
+    def pause(self, seconds):
+        """
+        Holds every new reservation back for the given number of seconds, e.g. after a 429.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budgets shared by every call in the process.
+    """
+
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def reserve(self, tokens, max_wait=None):
+        """
+        Reserves one request and tokens, returns the wait in seconds or None if over max_wait.
+        """
+        request_wait = self.requests.reserve(1, max_wait)
+        if request_wait is None:
+            return None
+        token_wait = self.tokens.reserve(tokens, max_wait)
+        if token_wait is None:
+            self.requests.refund(1)
+            return None
+        return max(request_wait, token_wait)
+
+    def wait_time(self, tokens):
+        """
+        Seconds until a request with the given number of tokens would fit the budgets.
+        """
+        return max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+    def acquire(self, tokens, deadline=None):
+        """
+        Blocks until a request with the given number of tokens fits the budgets.
+        """
+        wait = self.reserve(tokens, None if deadline is None else deadline - time.monotonic())
+        if wait is None:
+            raise DeadlineExceeded("Rate limit budget not available before the deadline")
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens, deadline=None):
+        """
+        Asyncio variant of acquire.
+        """
+        wait = self.reserve(tokens, None if deadline is None else deadline - time.monotonic())
+        if wait is None:
+            raise DeadlineExceeded("Rate limit budget not available before the deadline")
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def settle(self, estimated_tokens, used_tokens):
+        """
+        Refunds the difference when a call used fewer tokens than reserved.
+        """
+        if used_tokens is not None and used_tokens < estimated_tokens:
+            self.tokens.refund(estimated_tokens - used_tokens)
+
+    def pause(self, seconds):
+        self.requests.pause(seconds)
+
+
+rate_limiter = RateLimiter()
+scheduler = Scheduler(rate_limiter)
+_client = None
+_async_client = None
+_client_lock = threading.Lock()
+
+
+def retryable_errors():
+    """
+    The errors worth retrying: rate limits, connection problems, timeouts and server errors.
+    """
+    import openai
+    return openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError
+
+
+def http_limits():
+    import httpx
+    return httpx.Limits(max_connections=MAX_CONNECTIONS,
+                        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=KEEPALIVE_EXPIRY)
+
+
+def http_timeout():
+    import httpx
+    return httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+
+def get_client():
+    """
+    Returns the process-wide OpenAI client, creating it on first use.
+    Retries are handled by this module, so the SDK's own retries are disabled.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            import httpx
+            from openai import OpenAI
+            _client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"),
+                             http_client=httpx.Client(limits=http_limits(), timeout=http_timeout()),
+                             max_retries=0)
+        return _client
+
+
+def get_async_client():
+    """
+    Returns the process-wide AsyncOpenAI client, creating it on first use.
+    """
+    global _async_client
+    with _client_lock:
+        if _async_client is None:
+            import httpx
+            from openai import AsyncOpenAI
+            _async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"),
+                                        http_client=httpx.AsyncClient(limits=http_limits(), timeout=http_timeout()),
+                                        max_retries=0)
+        return _async_client
+
+
+def warm_up(timeout=10):
+    """
+    Creates both clients and opens a first pooled connection to the API, so the first learner
+    doesn't pay for the imports and the TLS handshake. Failures are logged, not raised.
+    The async client's connections belong to the event loop that opens them, so only the
+    sync client connects here.
+    """
+    get_async_client()
+    try:
+        with_retries(get_client().models.list, timeout=timeout)
+    except Exception as e:
+        logger.warning("Warming up the model client failed: %s", e)
+
+
+def retry_after(error):
+    """
+    Returns the delay in seconds the server asked for in a 429/5xx response, if any.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def backoff_delay(attempt, error=None):
+    """
+    Delay before retry number attempt: the server's Retry-After if given, otherwise exponential
+    backoff with full jitter.
+    """
+    delay = retry_after(error) if error is not None else None
+    if delay is not None:
+        return delay
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def with_retries(call, *args, timeout=None, **kwargs):
+    """
+    Calls an SDK method with retries and a deadline of timeout seconds (REQUEST_TIMEOUT by default).
+    Used for the endpoints that aren't rate limited per token, such as files and fine-tuning jobs.
+    """
+    deadline = time.monotonic() + (timeout or REQUEST_TIMEOUT)
+    attempt = 0
+    while True:
+        try:
+            return call(*args, **kwargs)
+        except retryable_errors() as e:
+            delay = backoff_delay(attempt, e)
+            if attempt >= MAX_RETRIES or time.monotonic() + delay >= deadline:
+                raise
+            logger.warning("Retrying after %s (attempt %d, waiting %.2fs)", type(e).__name__, attempt + 1, delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+def estimate_tokens(kwargs):
+    """
+    Upper bound on the tokens a request uses: the prompt plus the maximum completion length.
+    """
+    if "messages" in kwargs:
+        prompt_tokens = count_message_tokens(kwargs["messages"])
+    else:
+        prompt_tokens = count_tokens(kwargs.get("prompt", ""))
+    return prompt_tokens + (kwargs.get("max_tokens") or 0)
+
+
+def used_tokens(response):
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
+def _handle_failure(error, attempt, deadline, task):
+    # Returns the delay before the next attempt, or None if the error should be raised.
+    import openai
+    delay = backoff_delay(attempt, error)
+    if isinstance(error, openai.RateLimitError):
+        rate_limiter.pause(delay)
+    if attempt >= MAX_RETRIES or time.monotonic() + delay >= deadline:
+        return None
+    metrics.observe_retry(task, type(error).__name__)
+    logger.warning("Retrying after %s (attempt %d, waiting %.2fs)", type(error).__name__, attempt + 1, delay)
+    return delay
+
+
+def _finish(response, timer, estimated, kwargs):
+    # Records a successful call; streams are recorded and settled once they have been consumed.
+    if kwargs.get("stream"):
+        return TrackedStream(response, timer,
+                             lambda usage: rate_limiter.settle(estimated, getattr(usage, "total_tokens", None)))
+    rate_limiter.settle(estimated, used_tokens(response))
+    timer.finish(getattr(response, "usage", None))
+    return response
+
+
+def _request(create, timeout, task, kwargs):
+    # Shared retry loop of create_chat_completion and create_completion.
+    deadline = time.monotonic() + (timeout or REQUEST_TIMEOUT)
+    estimated = estimate_tokens(kwargs)
+    timer = metrics.start_call(task)
+    attempt = 0
+    try:
+        ticket = scheduler.acquire(estimated, deadline)
+        try:
+            while True:
+                if attempt:
+                    rate_limiter.acquire(estimated, deadline)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded("Deadline passed before the request could be sent")
+                try:
+                    response = create(timeout=remaining, **kwargs)
+                except retryable_errors() as e:
+                    # A failed attempt used none of the tokens reserved for it.
+                    rate_limiter.settle(estimated, 0)
+                    delay = _handle_failure(e, attempt, deadline, task)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+                except Exception:
+                    rate_limiter.settle(estimated, 0)
+                    raise
+                return _finish(response, timer, estimated, kwargs)
+        finally:
+            ticket.release()
+    except Exception as e:
+        timer.fail(e)
+        raise
+
+
+def create_chat_completion(timeout=None, task=None, **kwargs):
+    """
+    Rate-limited, retrying chat.completions.create. timeout is the deadline in seconds for the
+    whole call including waits and retries; for streams it covers establishing the stream.
+    task labels the call in the metrics, e.g. "q_and_a.verify". Raises scheduler.Overloaded
+    when the call is shed.
+    """
+    return _request(get_client().chat.completions.create, timeout, task, kwargs)
+
+
+def create_completion(timeout=None, task=None, **kwargs):
+    """
+    Rate-limited, retrying completions.create for the legacy completions endpoint.
+    """
+    return _request(get_client().completions.create, timeout, task, kwargs)
+
+
+async def create_chat_completion_async(timeout=None, task=None, **kwargs):
+    """
+    Asyncio variant of create_chat_completion. Streams are returned as async iterables.
+    """
+    create = get_async_client().chat.completions.create
+    deadline = time.monotonic() + (timeout or REQUEST_TIMEOUT)
+    estimated = estimate_tokens(kwargs)
+    timer = metrics.start_call(task)
+    attempt = 0
+    try:
+        ticket = await scheduler.acquire_async(estimated, deadline)
+        try:
+            while True:
+                if attempt:
+                    await rate_limiter.acquire_async(estimated, deadline)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded("Deadline passed before the request could be sent")
+                try:
+                    response = await create(timeout=remaining, **kwargs)
+                except retryable_errors() as e:
+                    # A failed attempt used none of the tokens reserved for it.
+                    rate_limiter.settle(estimated, 0)
+                    delay = _handle_failure(e, attempt, deadline, task)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    continue
+                except Exception:
+                    rate_limiter.settle(estimated, 0)
+                    raise
+                return _finish(response, timer, estimated, kwargs)
+        finally:
+            ticket.release()
+    except Exception as e:
+        timer.fail(e)
+        raise
@@ -0,0 +1,399 @@
+"""
+model_router.py
+
+Routes chat completions to a model tier per task, using live latency and cost statistics.
+
+A tier is a model with its price per token. Each task ("q_and_a.verify", "conversation.turn", ...)
+has a route: the tiers it may be served by, its default first. Once every tier of a route has
+enough samples, calls go to the tier with the lowest p95 latency plus COST_WEIGHT times its mean
+cost per call; until then the default tier is used and the others are tried now and then.
+
+When the chosen tier hasn't answered within its p95 latency, a hedged duplicate is sent to an
+alternate tier (the best other tier of the route, otherwise the next tier overall). The first
+response wins and the other request is cancelled. A tier that fails is failed over to the
+alternate right away. Each tier is served by a backend: the hosted API, or a small model run on
+the CPU in-process (see backends.py). A fallback tier, such as that local model, is never
+explored, ranked or hedged to: it only answers when the chosen tier and its alternate both
+failed, which keeps the app answering while the API is down. Calls shed by the scheduler are
+neither failed over nor hedged, as that would only add load. Changes of route and every hedge
+are logged, so the tiers and routes can be tuned.
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+import metrics
+from backends import LOCAL_MODEL, hosted_backend, local_backend
+from scheduler import Overloaded
+from tokens import count_message_tokens
+
+logger = logging.getLogger(__name__)
+
+# Tiers as a JSON list of {"name", "model", "input_cost", "output_cost", "backend"}, costs in dollars
+# per million tokens and backend "hosted" (the default) or "local". The "primary" model passed to
+# ModelRouter.from_env is added as tier "fine_tuned".
+MODEL_TIERS = os.getenv("CHATTERBOT_MODEL_TIERS")
+# Routes as a JSON object mapping a task ("q_and_a.verify"), a task kind ("verify") or "*" to tier names.
+MODEL_ROUTES = os.getenv("CHATTERBOT_MODEL_ROUTES")
+# Seconds of latency one dollar per call is worth when comparing tiers.
+COST_WEIGHT = float(os.getenv("CHATTERBOT_ROUTER_COST_WEIGHT", "1000"))
+# Samples a tier needs on a task before its statistics are trusted.
+MIN_SAMPLES = int(os.getenv("CHATTERBOT_ROUTER_MIN_SAMPLES", "20"))
+# Share of calls sent to a route's tiers that don't have enough samples yet.
+EXPLORE_RATE = float(os.getenv("CHATTERBOT_ROUTER_EXPLORE_RATE", "0.05"))
+# Whether slow calls are hedged, and the largest share of calls that may be.
+HEDGING = os.getenv("CHATTERBOT_HEDGING", "1") == "1"
+MAX_HEDGE_RATE = float(os.getenv("CHATTERBOT_MAX_HEDGE_RATE", "0.1"))
+# Recent calls per task and tier the statistics are computed over.
+STATS_WINDOW = 512
+
+BASE_MODEL = "gpt-4o-mini"
+DEFAULT_ROUTES = {"verify": ["fine_tuned", "base"], "solve": ["fine_tuned", "base"], "*": ["fine_tuned"]}
+
+
+class Tier:
+    """
+    A model, its price in dollars per million input and output tokens and the backend serving it.
+    A fallback tier only serves calls the other tiers failed.
+    """
+
+    def __init__(self, name, model, input_cost=0.0, output_cost=0.0, backend=None, fallback=False):
+        self.name = name
+        self.model = model
+        self.input_cost = input_cost
+        self.output_cost = output_cost
+        self.backend = backend or hosted_backend
+        self.fallback = fallback
+
+    def cost(self, prompt_tokens, completion_tokens):
+        return (prompt_tokens * self.input_cost + completion_tokens * self.output_cost) / 1e6
+
+    def __repr__(self):
+        return f"Tier({self.name!r}, {self.model!r})"
+
+
+class TierStats:
+    """
+    Latency and cost of a tier's recent calls on one task.
+    """
+
+    def __init__(self):
+        self.latency = metrics.Window(STATS_WINDOW)
+        self.cost = metrics.Window(STATS_WINDOW)
+        self.errors = 0
+
+    def p95(self):
+        return metrics.quantile(sorted(self.latency.samples), 0.95)
+
+    def mean_cost(self):
+        return sum(self.cost.samples) / len(self.cost.samples) if self.cost.samples else 0.0
+
+
+class ModelRouter:
+    """
+    Thread-safe router with the same interface as model_client.create_chat_completion(_async),
+    minus the model, which it picks.
+    """
+
+    def __init__(self, tiers, routes=None, cost_weight=COST_WEIGHT, min_samples=MIN_SAMPLES,
+                 explore_rate=EXPLORE_RATE, hedging=HEDGING, max_hedge_rate=MAX_HEDGE_RATE):
+        self.tiers = {tier.name: tier for tier in tiers}
+        self.order = [tier.name for tier in tiers]
+        self.routes = {key: [name for name in names if name in self.tiers]
+                       for key, names in (routes or DEFAULT_ROUTES).items()}
+        self.cost_weight = cost_weight
+        self.min_samples = min_samples
+        self.explore_rate = explore_rate
+        self.hedging = hedging
+        self.max_hedge_rate = max_hedge_rate
+        self._stats = {}
+        self._chosen = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    @classmethod
+    def from_env(cls, primary):
+        """
+        Builds the router from CHATTERBOT_MODEL_TIERS and CHATTERBOT_MODEL_ROUTES. By default the
+        primary model is tier "fine_tuned" and the base model it was tuned from is tier "base";
+        with CHATTERBOT_LOCAL_MODEL set, the local model is the fallback tier "local".
+        """
+        tiers = [Tier("fine_tuned", primary, 0.30, 1.20)]
+        if LOCAL_MODEL:
+            tiers.append(Tier("local", LOCAL_MODEL, backend=local_backend(), fallback=True))
+        if MODEL_TIERS:
+            for tier in json.loads(MODEL_TIERS):
+                if tier["name"] not in ("fine_tuned", "local"):
+                    backend = local_backend() if tier.pop("backend", "hosted") == "local" else None
+                    tiers.append(Tier(**tier, backend=backend))
+        else:
+            tiers.append(Tier("base", BASE_MODEL, 0.15, 0.60))
+        return cls(tiers, json.loads(MODEL_ROUTES) if MODEL_ROUTES else None)
+
+    def route(self, task):
+        task = task or ""
+        names = self.routes.get(task) or self.routes.get(task.rsplit(".", 1)[-1]) or self.routes.get("*")
+        return names or self.order[:1]
+
+    def _tier_stats(self, task, name, stream):
+        # Must be called with the lock held.
+        key = (task, name, bool(stream))
+        if key not in self._stats:
+            self._stats[key] = TierStats()
+        return self._stats[key]
+
+    def _score(self, stats):
+        return stats.p95() + self.cost_weight * stats.mean_cost()
+
+    def choose(self, task, stream=False):
+        """
+        Returns (tier, alternate tier or None, hedge delay in seconds or None) for a call.
+        """
+        # Fallback tiers only compete when a route lists nothing else.
+        names = [name for name in self.route(task) if not self.tiers[name].fallback] or self.route(task)
+        with self._lock:
+            self.calls += 1
+            stats = {name: self._tier_stats(task, name, stream) for name in names}
+            unknown = [name for name in names if stats[name].latency.count < self.min_samples]
+            if unknown and unknown != names[:1] and random.random() < self.explore_rate:
+                choice = random.choice([name for name in unknown if name != names[0]] or unknown)
+                logger.debug("Exploring tier %s for %s", choice, task)
+            elif names[0] in unknown:
+                choice = names[0]
+            else:
+                ranked = sorted((name for name in names if name not in unknown), key=lambda n: self._score(stats[n]))
+                choice = ranked[0]
+                if self._chosen.get((task, bool(stream))) != choice:
+                    logger.info("Routing %s to tier %s: %s", task, choice,
+                                ", ".join(f"{n} p95 {stats[n].p95():.2f}s cost ${stats[n].mean_cost():.6f}"
+                                          for n in ranked))
+                    self._chosen[(task, bool(stream))] = choice
+            others = sorted((n for n in names if n != choice and n not in unknown), key=lambda n: self._score(stats[n]))
+            alternate = others[0] if others else next(
+                (n for n in self.order if n != choice and not self.tiers[n].fallback), None)
+            chosen_stats = stats[choice]
+            delay = None
+            if (self.hedging and alternate is not None and chosen_stats.latency.count >= self.min_samples
+                    and self.hedged < self.max_hedge_rate * self.calls):
+                delay = chosen_stats.p95()
+        return self.tiers[choice], self.tiers[alternate] if alternate else None, delay
+
+    def _observe(self, task, tier, stream, latency, kwargs, response):
+        prompt_tokens = count_message_tokens(kwargs["messages"])
+        usage = getattr(response, "usage", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+        if completion_tokens is None:
+            # Streams report their usage only at the end; count them at their maximum length.
+            completion_tokens = kwargs.get("max_tokens") or 0
+        with self._lock:
+            stats = self._tier_stats(task, tier.name, stream)
+            stats.latency.observe(latency)
+            stats.cost.observe(tier.cost(prompt_tokens, completion_tokens))
+
+    def _failed(self, task, tier, stream, error):
+        with self._lock:
+            self._tier_stats(task, tier.name, stream).errors += 1
+        logger.warning("Tier %s failed on %s: %s", tier.name, task, error)
+
+    def _call(self, tier, task, kwargs):
+        started = time.perf_counter()
+        try:
+            response = tier.backend.create_chat_completion(model=tier.model, task=task, **kwargs)
+        except Overloaded:
+            raise
+        except Exception as e:
+            self._failed(task, tier, kwargs.get("stream"), e)
+            raise
+        self._observe(task, tier, kwargs.get("stream"), time.perf_counter() - started, kwargs, response)
+        return response
+
+    def _failing_over(self, task, tier, alternate):
+        with self._lock:
+            self.failovers += 1
+        logger.info("Failing %s over from tier %s to tier %s", task, tier.name, alternate.name)
+
+    def _hedging(self, task, tier, alternate, delay, reason):
+        with self._lock:
+            self.hedged += 1
+        metrics.registry.increment("hedged_calls", task or "unknown")
+        logger.info("Hedging %s: tier %s %s, also sending to tier %s", task, tier.name, reason, alternate.name)
+
+    def _won(self, task, tier, winner):
+        if winner is not tier:
+            with self._lock:
+                self.hedge_wins += 1
+            metrics.registry.increment("hedge_wins", task or "unknown")
+            logger.info("Hedged %s answered first by tier %s", task, winner.name)
+
+    def _fallback(self, tier, alternate):
+        """
+        The first fallback tier that wasn't tried yet, or None.
+        """
+        for name in self.order:
+            if self.tiers[name].fallback and self.tiers[name] not in (tier, alternate):
+                return self.tiers[name]
+        return None
+
+    def create_chat_completion(self, task=None, **kwargs):
+        """
+        Routed model_client.create_chat_completion. The losing request of a hedge runs to
+        completion in its thread, but its response is discarded (and its stream closed).
+        """
+        tier, alternate, delay = self.choose(task, kwargs.get("stream"))
+        try:
+            return self._complete(task, kwargs, tier, alternate, delay)
+        except Overloaded:
+            raise
+        except Exception:
+            fallback = self._fallback(tier, alternate)
+            if fallback is None:
+                raise
+            self._failing_over(task, alternate or tier, fallback)
+            return self._call(fallback, task, kwargs)
+
+    def _complete(self, task, kwargs, tier, alternate, delay):
+        if delay is None:
+            if alternate is None:
+                return self._call(tier, task, kwargs)
+            try:
+                return self._call(tier, task, kwargs)
+            except Overloaded:
+                raise
+            except Exception:
+                self._failing_over(task, tier, alternate)
+                return self._call(alternate, task, kwargs)
+        primary = _submit(self._call, tier, task, kwargs)
+        done, _ = wait([primary], timeout=delay)
+        if done and (primary.exception() is None or isinstance(primary.exception(), Overloaded)):
+            return primary.result()
+        self._hedging(task, tier, alternate, delay,
+                      "failed" if done else f"exceeded its p95 of {delay:.2f}s")
+        hedge = _submit(self._call, alternate, task, kwargs)
+        owners = {primary: tier, hedge: alternate}
+        pending = {primary, hedge} - done if done else {primary, hedge}
+        errors = [primary.exception()] if done else []
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                    continue
+                for loser in pending:
+                    loser.add_done_callback(_discard)
+                self._won(task, tier, owners[future])
+                return future.result()
+        raise errors[0]
+
+    async def _call_async(self, tier, task, kwargs):
+        started = time.perf_counter()
+        try:
+            response = await tier.backend.create_chat_completion_async(model=tier.model, task=task, **kwargs)
+        except (asyncio.CancelledError, Overloaded):
+            raise
+        except Exception as e:
+            self._failed(task, tier, kwargs.get("stream"), e)
+            raise
+        self._observe(task, tier, kwargs.get("stream"), time.perf_counter() - started, kwargs, response)
+        return response
+
+    async def create_chat_completion_async(self, task=None, **kwargs):
+        """
+        Routed model_client.create_chat_completion_async. The losing request of a hedge is cancelled.
+        """
+        tier, alternate, delay = self.choose(task, kwargs.get("stream"))
+        try:
+            return await self._complete_async(task, kwargs, tier, alternate, delay)
+        except Overloaded:
+            raise
+        except Exception:
+            fallback = self._fallback(tier, alternate)
+            if fallback is None:
+                raise
+            self._failing_over(task, alternate or tier, fallback)
+            return await self._call_async(fallback, task, kwargs)
+
+    async def _complete_async(self, task, kwargs, tier, alternate, delay):
+        if alternate is None:
+            return await self._call_async(tier, task, kwargs)
+        primary = asyncio.ensure_future(self._call_async(tier, task, kwargs))
+        try:
+            done, _ = await asyncio.wait([primary], timeout=delay)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        if done and (primary.exception() is None or isinstance(primary.exception(), Overloaded)):
+            return primary.result()
+        if delay is None:
+            self._failing_over(task, tier, alternate)
+            return await self._call_async(alternate, task, kwargs)
+        self._hedging(task, tier, alternate, delay, "failed" if done else f"exceeded its p95 of {delay:.2f}s")
+        hedge = asyncio.ensure_future(self._call_async(alternate, task, kwargs))
+        owners = {primary: tier, hedge: alternate}
+        pending = {hedge} if done else {primary, hedge}
+        errors = [primary.exception()] if done else []
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is not None:
+                        errors.append(future.exception())
+                        continue
+                    self._won(task, tier, owners[future])
+                    return future.result()
+            raise errors[0]
+        finally:
+            for loser in pending:
+                loser.cancel()
+                loser.add_done_callback(_discard_async)
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "hedged": self.hedged, "hedge_wins": self.hedge_wins,
+                    "failovers": self.failovers}
+
+    def report(self):
+        """
+        The current statistics of every task and tier, for tuning routes.
+        """
+        with self._lock:
+            return {f"{task}/{name}{' (stream)' if stream else ''}": {
+                "calls": stats.latency.count, "errors": stats.errors, "p95_seconds": stats.p95(),
+                "mean_cost": stats.mean_cost(), "chosen": self._chosen.get((task, stream)) == name}
+                for (task, name, stream), stats in sorted(self._stats.items())}
+
+
+def _submit(call, *args):
+    # Runs call in a daemon thread, so a request still in flight never holds up the interpreter's exit.
+    # The thread runs in a copy of the caller's context, which carries its scheduling priority.
+    future = Future()
+
+    def run():
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(call(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+    return future
+
+
+def _discard(future):
+    # Closes the stream of a hedged request that lost; other responses are simply dropped.
+    if not future.cancelled() and future.exception() is None and hasattr(future.result(), "close"):
+        future.result().close()
+
+
+def _discard_async(task):
+    if not task.cancelled() and task.exception() is None and hasattr(task.result(), "aclose"):
+        asyncio.ensure_future(task.result().aclose())
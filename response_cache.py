@@ -0,0 +1,183 @@
+"""
+response_cache.py
+
+Content-addressed cache for model responses.
+
+Responses are keyed on a hash of the normalized message list plus the sampling parameters, so
+prompts that only differ in case or whitespace (e.g. "Il a faim " vs "il a  faim") share an
+entry. Accents are kept: "Il à faim" is a different answer to grade than "Il a faim". Lookups go
+through an in-memory LRU tier with a TTL and, optionally, a SQLite tier that survives restarts.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+# Maximum number of entries kept in memory.
+DEFAULT_CACHE_SIZE = int(os.getenv("CHATTERBOT_CACHE_SIZE", "10000"))
+# Seconds before a cached response expires.
+DEFAULT_CACHE_TTL = float(os.getenv("CHATTERBOT_CACHE_TTL", "86400"))
+# Path of the on-disk tier; leave unset to only cache in memory.
+DEFAULT_CACHE_PATH = os.getenv("CHATTERBOT_CACHE_PATH")
+
+
+def normalize_text(text):
+    """
+    Lower-cases, strips accents and collapses whitespace so near-identical texts compare equal.
+    """
+    if text.isascii():
+        return " ".join(text.casefold().split())
+    decomposed = unicodedata.normalize("NFKD", text)
+    without_accents = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(without_accents.casefold().split())
+
+
+def normalize_case(text):
+    """
+    Lower-cases and collapses whitespace, keeping accents.
+    """
+    return " ".join(text.casefold().split())
+
+
+def cache_key(messages, **params):
+    """
+    Returns a hex digest identifying the normalized message list and the sampling parameters.
+    """
+    payload = {
+        "messages": [[message["role"], normalize_case(message["content"])] for message in messages],
+        "params": params,
+    }
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class MemoryCache:
+    """
+    Thread-safe in-memory LRU cache whose entries expire after ttl seconds.
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache:
+    """
+    On-disk cache tier stored in a single SQLite file, shared by every process that opens it.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at < time.time():
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + self.ttl),
+            )
+
+    def purge_expired(self):
+        """
+        Deletes expired rows, returns how many were removed.
+        """
+        with self._lock:
+            return self._connection.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class ResponseCache:
+    """
+    Looks responses up through a list of tiers, fastest first. Hits in a slower tier are copied
+    into the faster ones. Any object with get(key) and set(key, value) can be used as a tier.
+    """
+
+    def __init__(self, tiers):
+        self.tiers = list(tiers)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls):
+        """
+        Builds the default cache: an in-memory tier, plus a SQLite tier when CHATTERBOT_CACHE_PATH
+        is set.
+        """
+        tiers = [MemoryCache()]
+        if DEFAULT_CACHE_PATH:
+            tiers.append(SQLiteCache(DEFAULT_CACHE_PATH))
+        return cls(tiers)
+
+    def key(self, messages, **params):
+        return cache_key(messages, **params)
+
+    def get(self, key):
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                for faster in self.tiers[:i]:
+                    faster.set(key, value)
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        for tier in self.tiers:
+            tier.set(key, value)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,295 @@
+"""
+scheduler.py
+
+Priority scheduling of model calls with admission control and load shedding.
+
+Every chat or completion call takes a ticket from the scheduler before it is sent. Tickets are
+handed out in priority order (interactive before background before bulk) and, within a class,
+round-robin between users, so one learner or one bulk job can't starve the others. A ticket is
+only granted once the rate limiter has capacity for the call, so the quota goes to the most
+urgent work first instead of to whoever asked first. Lower classes may only hold a share of the
+in-flight slots, keeping headroom for learners.
+
+The queue is bounded. A call is rejected with Overloaded right away when the queue is full of
+work at least as urgent, or when its estimated wait would overrun its deadline; when the queue
+is full, the newest call of a lower class is shed to make room for a more urgent one. Calls that
+are still queued at their deadline are shed as well.
+
+The priority class and user of a call are taken from the current context, set with mark():
+e.g. by the app's handlers for the learner's session, or by a bulk job at its start. Calls made
+without one are background work.
+"""
+
+import asyncio
+import collections
+import contextvars
+import os
+import threading
+import time
+
+INTERACTIVE, BACKGROUND, BULK = 0, 1, 2
+CLASS_NAMES = ("interactive", "background", "bulk")
+
+# Calls sent to the API at once, across all classes.
+MAX_IN_FLIGHT = int(os.getenv("CHATTERBOT_MAX_IN_FLIGHT", "100"))
+# Share of the in-flight slots each class may hold.
+CLASS_SHARES = (1.0, float(os.getenv("CHATTERBOT_BACKGROUND_SHARE", "0.75")),
+                float(os.getenv("CHATTERBOT_BULK_SHARE", "0.5")))
+# Calls waiting for a ticket, across all classes.
+MAX_QUEUE = int(os.getenv("CHATTERBOT_MAX_QUEUE", "1000"))
+# Longest time a call of each class may wait for a ticket, in seconds.
+QUEUE_TIMEOUTS = (float(os.getenv("CHATTERBOT_INTERACTIVE_QUEUE_TIMEOUT", "10")),
+                  float(os.getenv("CHATTERBOT_BACKGROUND_QUEUE_TIMEOUT", "60")),
+                  float(os.getenv("CHATTERBOT_BULK_QUEUE_TIMEOUT", "600")))
+# Seconds of recent grants the service rate used to estimate waits is measured over.
+RATE_WINDOW = 10.0
+
+_current = contextvars.ContextVar("chatterbot_priority", default=(BACKGROUND, None))
+
+
+def mark(priority, user=None):
+    """
+    Sets the priority class and user of the model calls made from now on in the current asyncio
+    task or thread, and in the tasks it starts.
+    """
+    _current.set((priority, user))
+
+
+def current():
+    """
+    Returns (priority class, user) of the current context.
+    """
+    return _current.get()
+
+
+class Overloaded(Exception):
+    """
+    Raised when a call is shed: the queue is full, or it couldn't be sent before its deadline.
+    """
+
+
+class Waiter:
+    """
+    A call waiting for a ticket. Woken through an event in threads, a future in asyncio.
+    """
+
+    def __init__(self, priority, user, tokens, deadline, loop=None):
+        self.priority = priority
+        self.user = user
+        self.tokens = tokens
+        self.deadline = deadline
+        self.granted = False
+        self.error = None
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class Ticket:
+    """
+    Permission to send one call; release() it once the response (or the stream) has arrived.
+    """
+
+    def __init__(self, scheduler, priority):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler._release(self.priority)
+
+
+class Scheduler:
+    """
+    Thread-safe scheduler shared by the threaded and asyncio call paths. Waiting calls are
+    dispatched by a background thread, started on first use.
+    """
+
+    def __init__(self, rate_limiter, slots=MAX_IN_FLIGHT, max_queue=MAX_QUEUE, shares=CLASS_SHARES,
+                 queue_timeouts=QUEUE_TIMEOUTS):
+        self.rate_limiter = rate_limiter
+        self.slots = slots
+        self.max_queue = max_queue
+        self.limits = [max(1, int(slots * share)) for share in shares]
+        self.queue_timeouts = queue_timeouts
+        self._cond = threading.Condition()
+        self._queues = [collections.OrderedDict() for _ in CLASS_NAMES]
+        self._queued = [0] * len(CLASS_NAMES)
+        self._in_use = [0] * len(CLASS_NAMES)
+        self._grants = collections.deque()
+        self._dispatcher = None
+        self.granted = [0] * len(CLASS_NAMES)
+        self.shed = [0] * len(CLASS_NAMES)
+
+    def _waiter(self, tokens, deadline, loop=None):
+        priority, user = current()
+        queue_deadline = time.monotonic() + self.queue_timeouts[priority]
+        return Waiter(priority, user, tokens, min(deadline or queue_deadline, queue_deadline), loop)
+
+    def _can_run(self, priority):
+        # Must be called with the lock held.
+        return sum(self._in_use) < self.slots and self._in_use[priority] < self.limits[priority]
+
+    def _grant(self, waiter):
+        # Must be called with the lock held, after reserving the waiter's quota.
+        now = time.monotonic()
+        self._in_use[waiter.priority] += 1
+        self.granted[waiter.priority] += 1
+        self._grants.append(now)
+        while self._grants and self._grants[0] < now - RATE_WINDOW:
+            self._grants.popleft()
+        waiter.granted = True
+
+    def _estimated_wait(self, ahead):
+        # Must be called with the lock held. Calls ahead divided by the recent rate of grants.
+        if not ahead or len(self._grants) < 2:
+            return 0.0
+        return ahead / (len(self._grants) / RATE_WINDOW)
+
+    def _shed(self, waiter, reason):
+        # Must be called with the lock held.
+        self.shed[waiter.priority] += 1
+        waiter.error = Overloaded(f"{CLASS_NAMES[waiter.priority]} call shed: {reason}")
+
+    def _enqueue(self, waiter):
+        """
+        Admits the waiter, granting it at once when nothing is queued and there is capacity.
+        Returns True if it was granted; raises Overloaded if it is rejected.
+        """
+        with self._cond:
+            queued = sum(self._queued)
+            if (not queued and self._can_run(waiter.priority)
+                    and self.rate_limiter.reserve(waiter.tokens, max_wait=0) is not None):
+                self._grant(waiter)
+                return True
+            ahead = sum(self._queued[:waiter.priority + 1])
+            wait = self._estimated_wait(ahead)
+            if time.monotonic() + wait > waiter.deadline:
+                self._shed(waiter, f"estimated wait {wait:.1f}s exceeds its deadline")
+                raise waiter.error
+            if queued >= self.max_queue:
+                victim = self._lowest_below(waiter.priority)
+                if victim is None:
+                    self._shed(waiter, "queue full")
+                    raise waiter.error
+                self._remove(victim)
+                self._shed(victim, "queue full, making room for more urgent work")
+                victim.wake()
+            self._queues[waiter.priority].setdefault(waiter.user, collections.deque()).append(waiter)
+            self._queued[waiter.priority] += 1
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch, name="scheduler", daemon=True)
+                self._dispatcher.start()
+            self._cond.notify_all()
+            return False
+
+    def _lowest_below(self, priority):
+        # Must be called with the lock held. The newest waiter of the least urgent class below priority.
+        for lower in range(len(CLASS_NAMES) - 1, priority, -1):
+            if self._queued[lower]:
+                user, waiters = next(reversed(self._queues[lower].items()))
+                return waiters[-1]
+        return None
+
+    def _remove(self, waiter):
+        # Must be called with the lock held. Returns False if the waiter wasn't queued.
+        waiters = self._queues[waiter.priority].get(waiter.user)
+        if not waiters or waiter not in waiters:
+            return False
+        waiters.remove(waiter)
+        if not waiters:
+            del self._queues[waiter.priority][waiter.user]
+        self._queued[waiter.priority] -= 1
+        return True
+
+    def _next(self):
+        # Must be called with the lock held. The first waiter of the next user of the most urgent
+        # class that may run; the user goes to the back of its class's round.
+        for priority, queue in enumerate(self._queues):
+            if queue and self._can_run(priority):
+                return next(iter(queue.values()))[0]
+        return None
+
+    def _dispatch(self):
+        with self._cond:
+            while True:
+                waiter = self._next()
+                if waiter is None:
+                    self._cond.wait()
+                    continue
+                if self.rate_limiter.reserve(waiter.tokens, max_wait=0) is None:
+                    self._cond.wait(timeout=max(0.001, self.rate_limiter.wait_time(waiter.tokens)))
+                    continue
+                self._remove(waiter)
+                if waiter.user in self._queues[waiter.priority]:
+                    self._queues[waiter.priority].move_to_end(waiter.user)
+                self._grant(waiter)
+                waiter.wake()
+
+    def _release(self, priority):
+        with self._cond:
+            self._in_use[priority] -= 1
+            self._cond.notify_all()
+
+    def _withdraw(self, waiter, shed=True):
+        """
+        Removes a waiter whose deadline passed, or whose caller was cancelled if not shed.
+        Returns False if it was granted meanwhile.
+        """
+        with self._cond:
+            if waiter.granted:
+                return False
+            if self._remove(waiter) and shed:
+                self._shed(waiter, "deadline passed while queued")
+            return True
+
+    def acquire(self, tokens, deadline=None):
+        """
+        Blocks until the call may be sent and returns its Ticket. deadline is a time.monotonic()
+        value; the class's queue timeout applies too. Raises Overloaded if the call is shed.
+        """
+        waiter = self._waiter(tokens, deadline)
+        if not self._enqueue(waiter):
+            waiter.event.wait(max(0.0, waiter.deadline - time.monotonic()))
+            if self._withdraw(waiter):
+                raise waiter.error
+        return Ticket(self, waiter.priority)
+
+    async def acquire_async(self, tokens, deadline=None):
+        """
+        Asyncio variant of acquire.
+        """
+        waiter = self._waiter(tokens, deadline, asyncio.get_running_loop())
+        if not self._enqueue(waiter):
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), max(0.0, waiter.deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                if not self._withdraw(waiter, shed=False):
+                    self._release(waiter.priority)
+                raise
+            if self._withdraw(waiter):
+                raise waiter.error
+        return Ticket(self, waiter.priority)
+
+    def stats(self):
+        with self._cond:
+            stats = {"in_flight": sum(self._in_use), "queued": sum(self._queued)}
+            for priority, name in enumerate(CLASS_NAMES):
+                stats[f"{name}_queued"] = self._queued[priority]
+                stats[f"{name}_granted"] = self.granted[priority]
+                stats[f"{name}_shed"] = self.shed[priority]
+            return stats
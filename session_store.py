@@ -0,0 +1,225 @@
+"""
+session_store.py
+
+Server-side storage of learner sessions, so the UI only has to hold a session ID.
+
+A session is the state of the chat, the exercise being answered and the chat history, kept in a
+compact __slots__ record. The in-process store evicts the least recently used sessions past a
+session count or memory budget and drops sessions idle for longer than a TTL. The SQLite store
+keeps sessions in a file shared by every app process, so several workers behind a load balancer
+can serve the same learner.
+"""
+
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from enum import Enum
+
+from exercises import Exercise
+
+# Upper bounds of the in-process store.
+DEFAULT_MAX_SESSIONS = int(os.getenv("CHATTERBOT_MAX_SESSIONS", "10000"))
+DEFAULT_MAX_SESSION_BYTES = int(os.getenv("CHATTERBOT_MAX_SESSION_BYTES", str(256 * 1024 * 1024)))
+# Seconds without activity after which a session is dropped.
+DEFAULT_SESSION_TTL = float(os.getenv("CHATTERBOT_SESSION_TTL", "3600"))
+# Most recent chat messages kept per session; older ones are only needed for display.
+MAX_HISTORY_MESSAGES = int(os.getenv("CHATTERBOT_SESSION_MAX_MESSAGES", "200"))
+# Path of the shared SQLite store; leave unset to keep sessions in process memory.
+DEFAULT_SESSION_PATH = os.getenv("CHATTERBOT_SESSION_PATH")
+# Fixed per-record overhead used in the memory accounting, in bytes.
+RECORD_OVERHEAD = 200
+
+
+class State(Enum):
+    SEND_INITIAL_MESSAGE = 0
+    SEND_RESPONSE_TO_USER = 1
+    IN_CONVERSATION = 2
+    STANDBY = 3
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+class SessionRecord:
+    """
+    One learner session: its State, the Exercise being answered (if any) and the chat history.
+    """
+
+    __slots__ = ("session_id", "state", "task", "history", "last_access", "size")
+
+    def __init__(self, session_id, state=State.STANDBY, task=None, history=None, last_access=None):
+        self.session_id = session_id
+        self.state = state
+        self.task = task
+        self.history = list(history or [])[-MAX_HISTORY_MESSAGES:]
+        self.last_access = last_access or time.time()
+        self.size = self.measure()
+
+    def measure(self):
+        """
+        Approximate memory used by the record, in bytes.
+        """
+        size = RECORD_OVERHEAD + sum(len(str(message.get("content") or "")) + 64 for message in self.history)
+        if self.task is not None:
+            size += len(self.task.text) + len(json.dumps(self.task.pairs or self.task.answer or ""))
+        return size
+
+    def append(self, *messages):
+        self.history.extend(messages)
+        del self.history[:-MAX_HISTORY_MESSAGES]
+
+    def to_row(self):
+        return (self.session_id, self.state.value, json.dumps(self.task.to_dict()) if self.task else None,
+                json.dumps(self.history, ensure_ascii=False), self.last_access)
+
+    @classmethod
+    def from_row(cls, row):
+        session_id, state, task, history, last_access = row
+        return cls(session_id, State(state), Exercise.from_dict(json.loads(task)) if task else None,
+                   json.loads(history), last_access)
+
+
+class MemorySessionStore:
+    """
+    Thread-safe in-process store with LRU eviction, an idle TTL and a memory budget.
+    Records are returned by reference; call put() after changing one to account for its new size.
+    """
+
+    def __init__(self, max_sessions=DEFAULT_MAX_SESSIONS, max_bytes=DEFAULT_MAX_SESSION_BYTES,
+                 ttl=DEFAULT_SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            record = self._sessions.get(session_id)
+            if record is None:
+                return None
+            now = time.time()
+            if record.last_access + self.ttl < now:
+                self._remove(session_id)
+                self.expirations += 1
+                return None
+            record.last_access = now
+            self._sessions.move_to_end(session_id)
+            return record
+
+    def put(self, record):
+        with self._lock:
+            old = self._sessions.pop(record.session_id, None)
+            if old is not None:
+                self.bytes -= old.size
+            record.last_access = time.time()
+            record.size = record.measure()
+            self._sessions[record.session_id] = record
+            self.bytes += record.size
+            self._evict()
+
+    def delete(self, session_id):
+        with self._lock:
+            self._remove(session_id)
+
+    def _remove(self, session_id):
+        # Must be called with the lock held.
+        record = self._sessions.pop(session_id, None)
+        if record is not None:
+            self.bytes -= record.size
+
+    def _evict(self):
+        # Must be called with the lock held. Idle sessions go first, then the least recently used.
+        cutoff = time.time() - self.ttl
+        while self._sessions:
+            session_id, record = next(iter(self._sessions.items()))
+            if record.last_access < cutoff:
+                self.expirations += 1
+            elif len(self._sessions) > self.max_sessions or self.bytes > self.max_bytes:
+                self.evictions += 1
+            else:
+                return
+            self._remove(session_id)
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._sessions), "bytes": self.bytes, "evictions": self.evictions,
+                    "expirations": self.expirations}
+
+
+class SQLiteSessionStore:
+    """
+    Session store in a SQLite file shared by every process that opens it.
+    get() returns a fresh copy of the record, so changes must be saved with put().
+    """
+
+    # Expired sessions are purged once every this many writes.
+    PURGE_INTERVAL = 1000
+
+    def __init__(self, path, ttl=DEFAULT_SESSION_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, state INTEGER NOT NULL, task TEXT, "
+            "history TEXT NOT NULL, last_access REAL NOT NULL)"
+        )
+
+    def get(self, session_id):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT id, state, task, history, last_access FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[4] + self.ttl < time.time():
+                self._connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+                return None
+        return SessionRecord.from_row(row)
+
+    def put(self, record):
+        record.last_access = time.time()
+        row = record.to_row()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO sessions (id, state, task, history, last_access) VALUES (?, ?, ?, ?, ?)", row
+            )
+            self._writes += 1
+            if self._writes % self.PURGE_INTERVAL == 0:
+                self._connection.execute("DELETE FROM sessions WHERE last_access < ?", (time.time() - self.ttl,))
+
+    def delete(self, session_id):
+        with self._lock:
+            self._connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def stats(self):
+        with self._lock:
+            sessions, size = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(history) + COALESCE(LENGTH(task), 0)), 0) FROM sessions"
+            ).fetchone()
+        return {"sessions": sessions, "bytes": size}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def session_store_from_env():
+    """
+    Builds the default store: SQLite when CHATTERBOT_SESSION_PATH is set, otherwise in memory.
+    """
+    if DEFAULT_SESSION_PATH:
+        return SQLiteSessionStore(DEFAULT_SESSION_PATH)
+    return MemorySessionStore()
@@ -0,0 +1,74 @@
+import json
+
+import pytest
+
+from batch_generation import (LocalBatchBackend, load_exercises, parse_batch, parse_batch_output, run_batch,
+                              save_exercises)
+
+
+def content(*items):
+    return json.dumps({"exercises": list(items)}, ensure_ascii=False)
+
+
+def test_parse_batch_keeps_valid_items_only():
+    exercises = parse_batch("fill_in_the_blank", content(
+        {"text": "Je ___ un croissant.", "answer": "mange"},
+        {"text": "No blank here.", "answer": "x"},
+        {"text": "Il ___ froid.", "answer": ""},
+        "not an object",
+        {"text": " Nous ___ au parc. ", "answer": " allons "},
+    ), topic="food")
+    assert [(e.text, e.answer, e.topic) for e in exercises] == [
+        ("Je ___ un croissant.", "mange", "food"), ("Nous ___ au parc.", "allons", "food")]
+
+
+def test_parse_batch_renders_vocabulary_pairs():
+    pairs = {"la pomme": "the apple", "le pain": "the bread"}
+    exercises = parse_batch("vocabulary_matching", content({"pairs": pairs}, {"pairs": {"seul": "alone"}},
+                                                            {"pairs": {"le lait": 3, "l'eau": "water"}}))
+    assert len(exercises) == 1
+    assert exercises[0].pairs == pairs
+    assert "1. la pomme" in exercises[0].text and "the bread" in exercises[0].text
+
+
+def test_parse_batch_conversation_has_no_answer():
+    exercises = parse_batch("conversation", content({"text": "Tu es au marché.", "answer": "ignored"}))
+    assert exercises[0].answer is None
+
+
+@pytest.mark.parametrize("raw", ["not json", "[]", '{"exercises": "none"}', "{}"])
+def test_parse_batch_tolerates_malformed_output(raw):
+    assert parse_batch("q_and_a", raw) == []
+
+
+def test_local_batch_round_trip_keeps_job_order_and_skips_failures(tmp_path):
+    def respond(body):
+        topic = body["messages"][-1]["content"]
+        if "travel" in topic:
+            raise RuntimeError("request failed")
+        word = "food" if "food" in topic else "music"
+        return content({"text": f"Question sur {word} ?", "answer": word})
+
+    backend = LocalBatchBackend(str(tmp_path / "batches"), respond)
+    exercises = run_batch(backend, [("q_and_a", "music"), ("q_and_a", "travel"), ("q_and_a", "food")],
+                          "model", 1, str(tmp_path / "work"), poll_interval=0)
+    assert [(e.answer, e.topic) for e in exercises] == [("music", "music"), ("food", "food")]
+
+
+def test_parse_batch_output_sorts_by_job():
+    def line(index, answer):
+        return json.dumps({"custom_id": json.dumps([index, "q_and_a", "t"]), "error": None, "response": {
+            "status_code": 200, "body": {"choices": [{"message": {"content": content(
+                {"text": "Q ?", "answer": answer})}}]}}})
+    failed = json.dumps({"custom_id": json.dumps([2, "q_and_a", "t"]), "response": {"status_code": 500}})
+    assert [e.answer for e in parse_batch_output([line(1, "b"), "", failed, line(0, "a")])] == ["a", "b"]
+
+
+def test_exercise_bank_round_trip(tmp_path):
+    exercises = parse_batch("q_and_a", content({"text": "Capitale ?", "answer": "Paris"}), topic="villes")
+    path = str(tmp_path / "bank.jsonl")
+    save_exercises(path, exercises)
+    save_exercises(path, exercises)
+    loaded = load_exercises(path)
+    assert [(e.task_type, e.text, e.answer, e.topic) for e in loaded] == [
+        ("q_and_a", "Capitale ?", "Paris", "villes")] * 2
@@ -0,0 +1,137 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from coalesce import AsyncSingleFlight, SingleFlight
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def in_threads(count, target):
+    results = [None] * count
+
+    def run(i):
+        try:
+            results[i] = target()
+        except Exception as error:
+            results[i] = error
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_concurrent_identical_calls_share_one_call():
+    flights, release, calls = SingleFlight(), threading.Event(), []
+
+    def call():
+        calls.append(1)
+        release.wait()
+        return "réponse"
+
+    threads, results = in_threads(5, lambda: flights.do("key", call))
+    wait_until(lambda: flights.stats()["coalesced"] == 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == ["réponse"] * 5
+    assert calls == [1]
+    assert flights.stats() == {"in_flight": 0, "leaders": 1, "coalesced": 4}
+    # Once landed, the flight is forgotten and the next call goes to the model again.
+    assert flights.do("key", call) == "réponse" and calls == [1, 1]
+
+
+def test_error_is_raised_in_every_caller():
+    flights, release = SingleFlight(), threading.Event()
+
+    def call():
+        release.wait()
+        raise TimeoutError("model timed out")
+
+    threads, results = in_threads(3, lambda: flights.do("key", call))
+    wait_until(lambda: flights.stats()["coalesced"] == 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert [type(result) for result in results] == [TimeoutError] * 3
+
+
+def test_different_keys_are_not_coalesced():
+    flights = SingleFlight()
+    assert [flights.do(key, lambda key=key: key.upper()) for key in "ab"] == ["A", "B"]
+    assert flights.stats()["leaders"] == 2 and flights.stats()["coalesced"] == 0
+
+
+def test_late_stream_joiner_starts_from_the_text_so_far():
+    flights, step = SingleFlight(), threading.Semaphore(0)
+
+    def open_stream():
+        for text in ["Bon", "Bonjour", "Bonjour !"]:
+            step.acquire()
+            yield text
+
+    first = flights.stream("key", open_stream)
+    step.release()
+    assert next(first) == "Bon"
+    step.release()
+    wait_until(lambda: flights._flights["key"].version == 2)
+    late = flights.stream("key", open_stream)
+    assert next(late) == "Bonjour"
+    step.release()
+    assert list(late) == ["Bonjour !"]
+    assert list(first)[-1] == "Bonjour !"
+    assert flights.stats() == {"in_flight": 0, "leaders": 1, "coalesced": 1}
+
+
+def test_async_call_survives_the_leader_being_cancelled():
+    async def main():
+        flights, release, calls = AsyncSingleFlight(), asyncio.Event(), []
+
+        async def call():
+            calls.append(1)
+            await release.wait()
+            return "réponse"
+
+        leader = asyncio.ensure_future(flights.do("key", call))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.do("key", call))
+        await asyncio.sleep(0)
+        leader.cancel()
+        release.set()
+        assert await follower == "réponse"
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return calls, flights.stats()
+
+    calls, stats = asyncio.run(main())
+    assert calls == [1]
+    assert stats == {"in_flight": 0, "leaders": 1, "coalesced": 1}
+
+
+def test_async_stream_is_shared():
+    async def main():
+        flights, opened = AsyncSingleFlight(), []
+
+        async def open_stream():
+            opened.append(1)
+            for text in ["Bon", "Bonjour"]:
+                await asyncio.sleep(0.01)
+                yield text
+
+        async def read():
+            return [snapshot async for snapshot in flights.stream("key", open_stream)]
+
+        results = await asyncio.gather(read(), read(), read())
+        return results, opened
+
+    results, opened = asyncio.run(main())
+    assert results == [["Bon", "Bonjour"]] * 3
+    assert opened == [1]
@@ -0,0 +1,64 @@
+from conversation_memory import ConversationMemory, extractive_summary
+from tokens import count_message_tokens
+
+
+def history(exchanges):
+    messages = []
+    for i in range(exchanges):
+        messages.append({"role": "user", "content": f"Message {i} de l'étudiant. Une deuxième phrase."})
+        messages.append({"role": "assistant", "content": f"Réponse {i} du tuteur. Encore une phrase."})
+    messages.append({"role": "user", "content": "Dernier message."})
+    return messages
+
+
+class CountingSummarizer:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, previous_summary, messages, max_tokens):
+        self.calls.append(len(messages))
+        return extractive_summary(previous_summary, messages, max_tokens)
+
+
+def test_short_conversation_is_sent_verbatim():
+    memory = ConversationMemory(keep_turns=6)
+    messages, report = memory.build_messages("Tu es un tuteur.", history(2))
+    assert messages[0] == {"role": "system", "content": "Tu es un tuteur."}
+    assert messages[1:] == history(2)
+    assert report["summarized_messages"] == 0
+
+
+def test_older_turns_are_summarized_by_their_first_sentence():
+    memory = ConversationMemory(keep_turns=2)
+    messages, report = memory.build_messages("Tu es un tuteur.", history(5))
+    assert report == {**report, "verbatim_messages": 4, "summarized_messages": 7}
+    summary = messages[1]["content"]
+    assert summary.startswith("Summary of the earlier conversation:\n")
+    assert "Student: Message 0 de l'étudiant." in summary
+    assert "Une deuxième phrase" not in summary
+    assert messages[2:] == history(5)[7:]
+
+
+def test_prompt_stays_within_the_token_budget():
+    memory = ConversationMemory(token_budget=120, keep_turns=10, summary_tokens=30)
+    messages, report = memory.build_messages("Tu es un tuteur.", history(20))
+    assert report["prompt_tokens"] == count_message_tokens(messages) <= 120
+    assert messages[-1] == {"role": "user", "content": "Dernier message."}
+    assert report["history_tokens"] > 120
+
+
+def test_summaries_are_extended_rather_than_recomputed():
+    summarizer = CountingSummarizer()
+    memory = ConversationMemory(keep_turns=2, summarize=summarizer)
+    conversation = history(5)
+    memory.build_messages("", conversation)
+    conversation += [{"role": "assistant", "content": "Bien."}, {"role": "user", "content": "Merci."}]
+    memory.build_messages("", conversation)
+    assert summarizer.calls == [7, 2]
+
+
+def test_extractive_summary_keeps_the_newest_lines_within_its_budget():
+    messages = [{"role": "user", "content": f"Phrase numéro {i}. Suite."} for i in range(50)]
+    summary = extractive_summary("", messages, max_tokens=20)
+    assert summary.endswith("Student: Phrase numéro 49.")
+    assert "numéro 0." not in summary
@@ -0,0 +1,88 @@
+import json
+import sys
+
+import pytest
+
+import data_preparation
+from data_preparation import build_dataset, task_type_of, to_chat_example, validate_example
+
+
+def chat(user, reply, system="Tu es un tuteur."):
+    return {"messages": [{"role": "system", "content": system}, {"role": "user", "content": user},
+                         {"role": "assistant", "content": reply}]}
+
+
+def write_source(path, records):
+    path.write_text("".join((r if isinstance(r, str) else json.dumps(r, ensure_ascii=False)) + "\n"
+                            for r in records), encoding="utf8")
+    return str(path)
+
+
+def read_lines(path):
+    with open(path, encoding="utf8") as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.mark.parametrize("user, expected", [
+    ("Fill in the blank: Je __ un chat.", "fill_in_the_blank"),
+    ("Task: Fill in the blank (French)", "fill_in_the_blank"),
+    ("Q&A: Capitale ?", "q_and_a"),
+    ("Vocabulary matching: chat, chien", "vocabulary_matching"),
+    ("Bonjour !", "conversation"),
+])
+def test_task_type_of(user, expected):
+    assert task_type_of(chat(user, "ok")["messages"]) == expected
+
+
+def test_to_chat_example_converts_every_source_format():
+    assert to_chat_example(chat("Bonjour", "Salut")) == chat("Bonjour", "Salut")
+    legacy = to_chat_example({"prompt": "Q&A: Capitale ?", "completion": "Paris"})
+    assert [m["role"] for m in legacy["messages"]] == ["system", "user", "assistant"]
+    bank = to_chat_example({"task_type": "vocabulary_matching", "text": "Associez.", "pairs": {"chat": "cat"}})
+    assert bank["messages"][-1]["content"] == "chat - cat"
+    assert to_chat_example({"task_type": "conversation", "text": "Salut"}) is None
+    assert to_chat_example({"other": 1}) is None
+
+
+@pytest.mark.parametrize("example, error", [
+    ({"messages": []}, "no messages"),
+    ({"messages": [{"role": "robot", "content": "x"}]}, "invalid role"),
+    ({"messages": [{"role": "user", "content": "  "}]}, "empty content"),
+    ({"messages": [{"role": "user", "content": "Bonjour"}]}, "no assistant reply"),
+])
+def test_validate_example_rejects_invalid_examples(example, error):
+    assert validate_example(example)[1] == error
+
+
+def test_validate_example_enforces_the_token_limit():
+    tokens, error = validate_example(chat("Bonjour", "Salut"), max_tokens=5)
+    assert error == "too many tokens" and tokens > 5
+    assert validate_example(chat("Bonjour", "Salut"))[1] is None
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_build_dataset_keeps_input_order_and_counts_rejections(tmp_path, workers):
+    records = [chat(f"Q&A: Question {i} ?", f"Réponse {i}") for i in range(7)]
+    source = write_source(tmp_path / "in.jsonl", records[:3] + ["not json", {"unknown": 1}] + records[3:])
+    output = str(tmp_path / "out.jsonl")
+    stats = build_dataset([source], output, workers=workers, chunk_size=2)
+    assert read_lines(output) == records
+    assert stats.examples == 7
+    assert stats.rejected == {"invalid JSON": 1, "unknown record format": 1}
+    assert stats.errors[0]["location"].endswith("in.jsonl:4")
+    assert stats.report()["task_types"]["q_and_a"]["examples"] == 7
+
+
+def test_build_dataset_writes_shards(tmp_path):
+    source = write_source(tmp_path / "in.jsonl", [chat(f"Bonjour {i}", "Salut") for i in range(5)])
+    stats = build_dataset([source], str(tmp_path / "out" / "data.jsonl"), shard_size=2, workers=1)
+    assert [len(read_lines(path)) for path in stats.shards] == [2, 2, 1]
+    assert stats.shards[0].endswith("data-00000.jsonl")
+
+
+def test_output_is_required_with_sources(tmp_path, monkeypatch, capsys):
+    source = write_source(tmp_path / "in.jsonl", [chat("Bonjour", "Salut")])
+    monkeypatch.setattr(sys, "argv", ["data_preparation.py", source])
+    with pytest.raises(SystemExit):
+        data_preparation.main()
+    assert "--output is required" in capsys.readouterr().err
@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+import dedup
+from dedup import Deduplicator, MinHasher, deduplicate_file, example_text, lsh_params, shingles, similarity
+
+
+def chat(user, reply):
+    return {"messages": [{"role": "system", "content": "Tuteur."}, {"role": "user", "content": user},
+                         {"role": "assistant", "content": reply}]}
+
+
+BASE = "le petit chat noir dort tranquillement sur le grand canapé rouge du salon pendant que la pluie tombe"
+
+
+def test_example_text_ignores_system_messages_case_accents_and_punctuation():
+    text = example_text(chat("Où est le Château ?", "Là-bas."))
+    assert text.split() == example_text(chat("ou est le chateau", "la bas")).split() == [
+        "ou", "est", "le", "chateau", "la", "bas"]
+
+
+def test_signature_similarity_estimates_the_jaccard_similarity():
+    hasher = MinHasher()
+    words = BASE.split()
+    other = " ".join(words[:-2] + ["neige", "tombe"])
+    first, second = shingles(BASE), shingles(other)
+    jaccard = len(first & second) / len(first | second)
+    assert similarity(hasher.signature(BASE), hasher.signature(other)) == pytest.approx(jaccard, abs=0.15)
+    assert similarity(hasher.signature(BASE), hasher.signature(BASE)) == 1.0
+    assert similarity(hasher.signature(BASE), hasher.signature("bonjour tout le monde")) < 0.2
+
+
+def test_signatures_are_the_same_without_numpy(monkeypatch):
+    vectorized = MinHasher(num_perm=32).signature(BASE)
+    monkeypatch.setattr(dedup, "np", None)
+    assert MinHasher(num_perm=32).signature(BASE) == vectorized
+    assert similarity(vectorized, vectorized) == 1.0
+
+
+@pytest.mark.parametrize("threshold", [0.5, 0.8, 0.9])
+def test_lsh_params_fit_the_signature_and_cross_near_the_threshold(threshold):
+    bands, rows = lsh_params(threshold, 128)
+    assert bands * rows <= 128
+    assert (1 / bands) ** (1 / rows) == pytest.approx(threshold, abs=0.1)
+
+
+def test_deduplicator_groups_near_duplicates_around_the_first_kept_example():
+    deduplicator = Deduplicator(threshold=0.7)
+    examples = [chat(BASE, "Oui."), chat("Quelle est la capitale de la France ?", "Paris"),
+                chat(BASE + " fort", "Oui."), chat(BASE.upper(), "Oui !"), chat("Comment vas-tu ce matin ?", "Bien.")]
+    assert [deduplicator.check(example, i) for i, example in enumerate(examples)] == [None, None, 0, 0, None]
+    report = deduplicator.report()
+    assert (report["seen"], report["kept"], report["dropped"], report["clusters"]) == (5, 3, 2, 1)
+    cluster = report["largest_clusters"][0]
+    assert cluster["kept"] == 0 and cluster["dropped"] == [2, 3] and cluster["size"] == 3
+    assert cluster["preview"].startswith("le petit chat noir")
+
+
+def test_deduplicate_file(tmp_path):
+    source, output = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    lines = [json.dumps(chat(BASE, "Oui.")), "", json.dumps(chat(BASE, "Oui.")), json.dumps(chat("Salut", "Coucou"))]
+    source.write_text("\n".join(lines), encoding="utf8")
+    deduplicator = deduplicate_file(str(source), str(output))
+    assert output.read_text(encoding="utf8").splitlines() == [lines[0], lines[3]]
+    assert deduplicator.report()["largest_clusters"][0]["dropped"] == [3]
@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+from evaluate import load_done, pair_accuracy, score, summarize
+
+
+@pytest.mark.parametrize("reference, prediction, expected", [
+    ("1) cat - chat", "1) the cat - le chat", 1.0),
+    ("le chat: the cat, le chien: the dog", "dog = chien; cat = chat", 1.0),
+    ("le chat: the cat, le chien: the dog", "chat: cat, chien: bird", 0.5),
+    ("no pairs here", "chat: cat", None),
+])
+def test_pair_accuracy_ignores_articles_and_direction(reference, prediction, expected):
+    assert pair_accuracy(reference, prediction) == expected
+
+
+@pytest.mark.parametrize("task_type, reference, prediction, expected", [
+    ("q_and_a", "Paris", "paris\nC'est la capitale.", 1.0),
+    ("q_and_a", "Paris", "Lyon", 0.0),
+    ("fill_in_the_blank", "suis", "suis", 1.0),
+    ("vocabulary_matching", "chat: cat", "chat: cat", 1.0),
+    ("conversation", "Bonjour !", "Salut !", None),
+])
+def test_score(task_type, reference, prediction, expected):
+    assert score(task_type, reference, prediction) == expected
+
+
+def write_results(path, results):
+    with open(path, "w", encoding="utf8") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+
+
+def result(model, example_id, score=1.0, latency=1.0, error=None, task_type="q_and_a"):
+    if error is not None:
+        return {"model": model, "id": example_id, "task_type": task_type, "error": error}
+    return {"model": model, "id": example_id, "task_type": task_type, "score": score, "latency": latency,
+            "prompt_tokens": 10, "completion_tokens": 5, "error": None}
+
+
+def test_load_done_skips_failed_results(tmp_path):
+    path = tmp_path / "results.jsonl"
+    assert load_done(str(path)) == set()
+    write_results(path, [result("a", "x:0"), result("a", "x:1", error="Timeout"), result("b", "x:1")])
+    assert load_done(str(path)) == {("a", "x:0"), ("b", "x:1")}
+
+
+def test_summarize_counts_the_latest_result_of_each_example(tmp_path):
+    path = tmp_path / "results.jsonl"
+    write_results(path, [
+        result("a", "x:0", score=1.0, latency=1.0),
+        result("a", "x:1", error="Timeout"),
+        result("a", "x:1", score=0.0, latency=3.0),
+        result("a", "x:2", error="Timeout"),
+        result("a", "x:3", score=None, latency=2.0, task_type="conversation"),
+    ])
+    summary = summarize(str(path))["a"]
+    assert summary["q_and_a"]["examples"] == 3
+    assert summary["q_and_a"]["errors"] == 1
+    assert summary["q_and_a"]["score"] == 0.5
+    assert summary["q_and_a"]["latency_p50"] == 1.0
+    assert summary["q_and_a"]["latency_p95"] == 3.0
+    assert summary["conversation"]["score"] is None
+    assert summary["all"]["examples"] == 4
+    assert summary["all"]["prompt_tokens"] == 30
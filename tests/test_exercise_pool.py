@@ -0,0 +1,113 @@
+import collections
+import threading
+
+import pytest
+
+from exercise_pool import ExercisePool
+
+
+class Generator:
+    """
+    Stand-in for the model: counts the exercises generated per topic, and fails on request.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generated = collections.Counter()
+        self.batches = []
+        self.fail = False
+
+    def one(self, task_type, topic):
+        return self.batch(task_type, topic, 1)[0]
+
+    def batch(self, task_type, topic, count):
+        with self.lock:
+            if self.fail:
+                raise RuntimeError("model down")
+            self.generated[topic] += count
+            self.batches.append(count)
+            return [f"{task_type}/{topic}/{self.generated[topic] - i}" for i in range(count)]
+
+
+@pytest.fixture
+def generator():
+    return Generator()
+
+
+@pytest.fixture
+def pool(generator):
+    pool = ExercisePool(depth=3, workers=2, generate=generator.one, generate_batch=generator.batch).start()
+    yield pool
+    pool.stop()
+
+
+def settle(pool):
+    # Waits until no refill is in flight.
+    with pool._refilled:
+        pool._refilled.wait_for(lambda: not pool._in_flight, timeout=5)
+
+
+def test_prefill_fills_every_key_to_its_depth_in_one_batch(pool, generator):
+    pool.prefill(["q_and_a"], ["food", "travel"])
+    assert pool.wait_ready(["q_and_a"], ["food", "travel"], timeout=5)
+    settle(pool)
+    assert pool.stats()["ready"] == 6
+    assert generator.batches == [3, 3]
+
+
+def test_pop_serves_ready_exercises_and_tops_the_key_up(pool, generator):
+    pool.prefill(["q_and_a"], ["food"])
+    pool.wait_ready(["q_and_a"], ["food"], timeout=5)
+    settle(pool)
+    assert pool.pop("q_and_a", " Food ") is not None
+    settle(pool)
+    stats = pool.stats()
+    assert (stats["hits"], stats["misses"], stats["ready"]) == (1, 0, 3)
+    assert generator.generated["food"] == 4
+
+
+def test_new_key_is_refilled_by_one_exercise(pool, generator):
+    for i in range(10):
+        assert pool.pop("q_and_a", f"topic {i}") is None
+    settle(pool)
+    assert sum(generator.generated.values()) == 10
+    assert pool.stats()["misses"] == 10
+
+
+def test_key_requested_again_is_topped_up_to_its_depth(pool, generator):
+    pool.pop("q_and_a", "castles")
+    settle(pool)
+    assert pool.pop("q_and_a", "castles") is not None
+    settle(pool)
+    assert generator.generated["castles"] == 4
+    assert pool.stats()["ready"] == 3
+
+
+def test_depth_overrides_and_put(generator):
+    pool = ExercisePool(depth=3, depths={"food": 1}, workers=1, generate=generator.one,
+                        generate_batch=generator.batch)
+    pool.put("q_and_a", "food", "a")
+    pool.put("q_and_a", "food", "b")
+    pool.put("q_and_a", "travel", "c")
+    assert pool.stats()["ready"] == 2
+    assert pool.pop("q_and_a", "food") == "a"
+
+
+def test_failed_refills_are_counted_and_retried_on_the_next_pop(pool, generator):
+    generator.fail = True
+    pool.pop("q_and_a", "food")
+    settle(pool)
+    assert pool.stats()["errors"] == 1
+    generator.fail = False
+    pool.pop("q_and_a", "food")
+    settle(pool)
+    assert pool.stats()["ready"] == 3
+
+
+def test_least_recently_requested_keys_are_dropped(generator):
+    pool = ExercisePool(depth=1, workers=1, max_keys=2, generate=generator.one, generate_batch=generator.batch)
+    for topic in ("a", "b", "c"):
+        pool.put("q_and_a", topic, topic)
+    assert pool.stats()["keys"] == 2
+    assert pool.pop("q_and_a", "a") is None
+    assert pool.pop("q_and_a", "c") == "c"
@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+from fine_tune import JobManager, JobStore, create_fine_tune_job, upload_training_file
+from mock_server import FakeFineTuning, MockServer
+
+PART_SIZE = 100
+
+
+@pytest.fixture
+def fake():
+    return FakeFineTuning(job_seconds=0.3, steps=3)
+
+
+@pytest.fixture
+def client(fake):
+    server = MockServer(fine_tuning=fake).start()
+    yield openai.OpenAI(base_url=server.base_url, api_key="mock", max_retries=0)
+    server.stop()
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    path = tmp_path / "train.jsonl"
+    path.write_text("".join(f'{{"messages": [{{"role": "user", "content": "ligne {i}"}}]}}\n' for i in range(20)),
+                    encoding="utf8")
+    return str(path)
+
+
+def store(tmp_path):
+    # A new JobStore on the same file, as a restarted process would have.
+    return JobStore(str(tmp_path / "state.json"))
+
+
+def interrupted_after(client, parts):
+    # The client with uploads.parts.create failing once parts parts were sent.
+    sent = []
+
+    def create(upload_id, **kwargs):
+        if len(sent) >= parts:
+            raise ConnectionResetError("connection lost")
+        sent.append(upload_id)
+        return client.uploads.parts.create(upload_id, **kwargs)
+
+    return SimpleNamespace(uploads=SimpleNamespace(create=client.uploads.create, complete=client.uploads.complete,
+                                                   parts=SimpleNamespace(create=create)))
+
+
+def test_interrupted_upload_resumes_with_the_missing_parts(tmp_path, fake, client, dataset):
+    with pytest.raises(ConnectionResetError):
+        upload_training_file(dataset, store(tmp_path), part_size=PART_SIZE, workers=1,
+                             client=interrupted_after(client, 2))
+    record = next(iter(store(tmp_path).data["uploads"].values()))
+    assert sum(part_id is not None for part_id in record["part_ids"]) == 2
+
+    file_id = upload_training_file(dataset, store(tmp_path), part_size=PART_SIZE, workers=1, client=client)
+    upload = fake.uploads[record["upload_id"]]
+    assert len(upload["_parts"]) == len(record["part_ids"])
+    assert upload["file"]["id"] == file_id
+    assert fake.files[file_id]["bytes"] == upload["bytes"]
+
+
+def test_unchanged_file_is_not_uploaded_again(tmp_path, fake, client, dataset):
+    file_id = upload_training_file(dataset, store(tmp_path), part_size=PART_SIZE, client=client)
+    assert upload_training_file(dataset, store(tmp_path), part_size=PART_SIZE, client=client) == file_id
+    assert len(fake.uploads) == 1
+    with open(dataset, "a", encoding="utf8") as f:
+        f.write('{"messages": []}\n')
+    assert upload_training_file(dataset, store(tmp_path), part_size=PART_SIZE, client=client) != file_id
+    assert len(fake.uploads) == 2
+
+
+def test_expired_upload_starts_over(tmp_path, fake, client, dataset):
+    with pytest.raises(ConnectionResetError):
+        upload_training_file(dataset, store(tmp_path), part_size=PART_SIZE, workers=1,
+                             client=interrupted_after(client, 1))
+    state = store(tmp_path)
+    key, record = next(iter(state.data["uploads"].items()))
+    state.set_upload(key, {**record, "expires_at": 0})
+    upload_training_file(dataset, store(tmp_path), part_size=PART_SIZE, client=client)
+    assert len(fake.uploads) == 2
+
+
+def test_job_manager_follows_jobs_to_the_end_and_resumes_their_events(tmp_path, client, dataset):
+    file_id = upload_training_file(dataset, store(tmp_path), part_size=PART_SIZE, client=client)
+    job = create_fine_tune_job(file_id, store=store(tmp_path), client=client)
+    events = []
+
+    def on_event(job_id, event):
+        events.append(event.message)
+        if event.message.startswith("Step 1/"):
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        JobManager(store(tmp_path), client, on_event, min_interval=0.01, max_interval=0.05).wait()
+    assert store(tmp_path).unfinished_jobs() == [job.id]
+
+    state = JobManager(store(tmp_path), client, lambda job_id, event: events.append(event.message),
+                       min_interval=0.01, max_interval=0.05).wait()[job.id]
+    assert state["status"] == "succeeded"
+    assert state["fine_tuned_model"].startswith("ft:")
+    # The batch being delivered when the process stopped is delivered again, nothing else is.
+    assert events.count("Step 1/3: training loss=0.50") == 2
+    assert list(dict.fromkeys(events)) == [
+        f"Validating training file: {file_id}", "Files validated, moving job to queued state",
+        "Fine-tuning job started",
+        "Step 1/3: training loss=0.50", "Step 2/3: training loss=0.33", "Step 3/3: training loss=0.25",
+        "The job has successfully completed"]
+    assert store(tmp_path).unfinished_jobs() == []
@@ -0,0 +1,90 @@
+import pytest
+
+from grading import grade_fill_in_the_blank, grade_q_and_a, grade_vocabulary_matching, matches, normalize_answer
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("lapin", "lapin"),
+    ("lait", "lait"),
+    ("dessert", "dessert"),
+    ("lemon", "lemon"),
+    ("la pomme", "pomme"),
+    ("Les Pommes", "pommes"),
+    ("l'eau", "eau"),
+    ("de la farine", "farine"),
+    ("de l'huile", "huile"),
+    ("une île", "ile"),
+])
+def test_normalize_answer_strips_only_whole_articles(text, expected):
+    assert normalize_answer(text) == expected
+
+
+def test_matches_does_not_treat_word_starts_as_articles():
+    assert matches("lapin", "pin") == (False, False)
+
+
+@pytest.mark.parametrize("answer", ["Paris", "paris", "C'est Paris.", "je pense que c'est Paris"])
+def test_q_and_a_accepts_the_answer_with_filler_words(answer):
+    assert grade_q_and_a("Paris", answer).correct is True
+
+
+@pytest.mark.parametrize("expected, answer", [
+    ("pomme", "la pomme"),
+    ("eau", "c'est l'eau"),
+    ("de la farine", "de la farine"),
+])
+def test_q_and_a_accepts_articles_and_elisions(expected, answer):
+    assert grade_q_and_a(expected, answer).correct is True
+
+
+@pytest.mark.parametrize("expected, answer", [
+    ("lait", "it"),
+    ("lapin", "pin"),
+    ("Paris", "Lyon"),
+])
+def test_q_and_a_rejects_other_words(expected, answer):
+    result = grade_q_and_a(expected, answer)
+    assert result.correct is False
+    assert result.mistakes == [(expected, answer)]
+
+
+@pytest.mark.parametrize("expected, answer", [
+    ("Paris", "Non, ce n'est pas Paris"),
+    ("Paris", "Paris ou Lyon"),
+    ("poisson", "poison"),
+])
+def test_q_and_a_leaves_sentences_and_near_misses_to_the_model(expected, answer):
+    assert grade_q_and_a(expected, answer).correct is None
+
+
+def test_fill_in_the_blank_accepts_the_whole_sentence():
+    assert grade_fill_in_the_blank("suis", "Je suis content.").correct is True
+
+
+def test_fill_in_the_blank_tolerates_no_typos():
+    assert grade_fill_in_the_blank("suis", "Je sui content.").correct is False
+
+
+@pytest.mark.parametrize("expected, answer", [
+    ("ai", "J'ai un chat."),
+    ("j'ai", "J'ai un chat."),
+    ("l'", "Il boit l'eau."),
+])
+def test_fill_in_the_blank_splits_elisions(expected, answer):
+    assert grade_fill_in_the_blank(expected, answer).correct is True
+
+
+@pytest.mark.parametrize("answer", ["chat: cat, chien: dog", "le chat = the cat; le chien = a dog"])
+def test_vocabulary_matching_ignores_english_articles(answer):
+    assert grade_vocabulary_matching({"le chat": "the cat", "le chien": "the dog"}, answer).correct is True
+
+
+def test_vocabulary_matching_reports_wrong_pairs():
+    result = grade_vocabulary_matching({"le chat": "the cat", "le chien": "the dog"}, "chat: dog, chien: cat")
+    assert result.correct is False
+    assert result.mistakes == [("le chat", "the cat", "dog"), ("le chien", "the dog", "cat")]
+
+
+@pytest.mark.parametrize("answer", ["1-B, 2-A", "I don't know"])
+def test_vocabulary_matching_leaves_unparseable_answers_to_the_model(answer):
+    assert grade_vocabulary_matching({"le chat": "the cat", "le chien": "the dog"}, answer).correct is None
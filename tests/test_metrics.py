@@ -0,0 +1,17 @@
+import pytest
+
+from metrics import quantile
+
+
+@pytest.mark.parametrize("values, q, expected", [
+    ([], 0.5, 0.0),
+    ([7], 0.99, 7),
+    ([1, 2], 0.5, 1),
+    ([1, 2, 3, 4], 0.5, 2),
+    ([1, 2, 3, 4, 5, 6], 0.5, 3),
+    (list(range(1, 21)), 0.95, 19),
+    (list(range(1, 101)), 0.99, 99),
+    (list(range(1, 101)), 1.0, 100),
+])
+def test_quantile_is_nearest_rank(values, q, expected):
+    assert quantile(values, q) == expected
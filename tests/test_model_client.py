@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+import model_client
+from metrics import TrackedStream, registry
+from model_client import RateLimiter, TokenBucket
+from scheduler import Scheduler
+
+
+def test_token_bucket_reserves_up_front_and_refunds():
+    bucket = TokenBucket(60)
+    assert bucket.reserve(60) == 0.0
+    assert bucket.reserve(1, max_wait=0.5) is None
+    assert bucket.reserve(1) == pytest.approx(1.0, abs=0.05)
+    bucket.refund(61)
+    assert bucket.reserve(60, max_wait=0) == 0.0
+
+
+def test_rate_limiter_refunds_the_request_when_tokens_are_short():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=100)
+    assert limiter.reserve(100, max_wait=0) == 0.0
+    assert limiter.reserve(50, max_wait=0) is None
+    assert limiter.requests._available == pytest.approx(59, abs=0.1)
+
+
+def test_settle_refunds_unused_tokens_only():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=600)
+    limiter.reserve(500)
+    limiter.settle(500, None)
+    assert limiter.tokens.reserve(200, max_wait=0) is None
+    limiter.settle(500, 100)
+    assert limiter.tokens.reserve(450, max_wait=0) == 0.0
+
+
+def usage(total):
+    return SimpleNamespace(prompt_tokens=total - 5, completion_tokens=5, total_tokens=total)
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    # A full budget that doesn't refill, so the tokens left show what was settled.
+    limiter = RateLimiter(requests_per_minute=100, tokens_per_minute=10_000)
+    limiter.requests.rate = limiter.tokens.rate = 1e-9
+    monkeypatch.setattr(model_client, "rate_limiter", limiter)
+    monkeypatch.setattr(model_client, "scheduler", Scheduler(limiter))
+    monkeypatch.setattr(model_client, "BACKOFF_BASE", 0.001)
+    return limiter
+
+
+def tokens_held(limiter):
+    return 10_000 - limiter.tokens._available
+
+
+def connection_error():
+    return openai.APIConnectionError(request=httpx.Request("POST", "http://test/v1/chat/completions"))
+
+
+def request(create, **kwargs):
+    return model_client._request(create, 5, "test", {"messages": [{"role": "user", "content": "Bonjour"}],
+                                                      "max_tokens": 100, **kwargs})
+
+
+def test_failed_attempts_give_their_tokens_back(limiter):
+    attempts = []
+
+    def create(timeout, **kwargs):
+        attempts.append(tokens_held(limiter))
+        if len(attempts) < 3:
+            raise connection_error()
+        return SimpleNamespace(usage=usage(30))
+
+    request(create)
+    estimated = model_client.estimate_tokens({"messages": [{"role": "user", "content": "Bonjour"}],
+                                              "max_tokens": 100})
+    assert attempts == [pytest.approx(estimated)] * 3
+    assert tokens_held(limiter) == pytest.approx(30)
+
+
+def test_errors_that_are_not_retried_give_their_tokens_back(limiter):
+    def create(timeout, **kwargs):
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        request(create)
+    assert tokens_held(limiter) == pytest.approx(0)
+
+
+def test_streams_are_settled_once_read(limiter):
+    chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="Salut"))], usage=None),
+              SimpleNamespace(choices=[], usage=usage(20))]
+
+    stream = request(lambda timeout, **kwargs: iter(chunks), stream=True)
+    assert isinstance(stream, TrackedStream)
+    assert tokens_held(limiter) > 100
+    assert list(stream) == chunks
+    assert tokens_held(limiter) == pytest.approx(20)
+
+
+def test_tracked_stream_calls_on_finish_once_with_its_usage():
+    finished = []
+    stream = TrackedStream(iter([SimpleNamespace(choices=[], usage=usage(7))]), registry.start_call("test"),
+                           finished.append)
+    list(stream)
+    assert [u.total_tokens for u in finished] == [7]
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from model_router import ModelRouter, Tier
+from scheduler import Overloaded
+
+MESSAGES = [{"role": "user", "content": "Bonjour"}]
+
+
+class Backend:
+    """
+    Backend stand-in answering with its name, after release is set when blocking, or raising error.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.error = None
+        self.release = threading.Event()
+        self.release.set()
+        self.calls = 0
+        self.cancelled = False
+
+    def create_chat_completion(self, model, task=None, **kwargs):
+        self.calls += 1
+        self.release.wait(5)
+        if self.error:
+            raise self.error
+        return SimpleNamespace(text=self.name, usage=None)
+
+    async def create_chat_completion_async(self, model, task=None, **kwargs):
+        self.calls += 1
+        try:
+            while not self.release.is_set():
+                await asyncio.sleep(0.001)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error:
+            raise self.error
+        return SimpleNamespace(text=self.name, usage=None)
+
+
+def make_router(names, fallback=None, **kwargs):
+    backends = {name: Backend(name) for name in names + ([fallback] if fallback else [])}
+    tiers = [Tier(name, name, backend=backend, fallback=name == fallback) for name, backend in backends.items()]
+    kwargs = {"min_samples": 2, "explore_rate": 0.0, "hedging": True, "max_hedge_rate": 1.0, **kwargs}
+    return ModelRouter(tiers, {"*": names + ([fallback] if fallback else [])}, **kwargs), backends
+
+
+def warm_up(router, calls=2):
+    # Gives the default tier the samples its p95 is computed from.
+    for _ in range(calls):
+        router.create_chat_completion(task="q_and_a.verify", messages=MESSAGES)
+
+
+def test_fast_call_is_not_hedged():
+    router, backends = make_router(["primary", "secondary"])
+    warm_up(router, 5)
+    assert router.create_chat_completion(task="q_and_a.verify", messages=MESSAGES).text == "primary"
+    assert backends["secondary"].calls == 0
+    assert router.stats()["hedged"] == 0
+
+
+def test_slow_call_is_hedged_and_the_first_answer_wins():
+    router, backends = make_router(["primary", "secondary"])
+    warm_up(router)
+    backends["primary"].release.clear()
+    assert router.create_chat_completion(task="q_and_a.verify", messages=MESSAGES).text == "secondary"
+    backends["primary"].release.set()
+    assert router.stats() == {"calls": 3, "hedged": 1, "hedge_wins": 1, "failovers": 0}
+
+
+def test_hedges_are_capped_at_the_max_hedge_rate():
+    router, backends = make_router(["primary", "secondary"], max_hedge_rate=0.25)
+    warm_up(router)
+    delays = []
+    for _ in range(6):
+        tier, alternate, delay = router.choose("q_and_a.verify")
+        delays.append(delay is not None)
+        if delay is not None:
+            router._hedging("q_and_a.verify", tier, alternate, delay, "was slow")
+    assert delays == [True, False, True, False, False, False]
+    assert router.stats()["hedged"] == 2 == 0.25 * router.stats()["calls"]
+
+
+def test_async_hedge_cancels_the_slow_request():
+    router, backends = make_router(["primary", "secondary"])
+    warm_up(router)
+    backends["primary"].release.clear()
+
+    async def main():
+        response = await router.create_chat_completion_async(task="q_and_a.verify", messages=MESSAGES)
+        await asyncio.sleep(0.01)
+        return response
+
+    assert asyncio.run(main()).text == "secondary"
+    assert backends["primary"].cancelled
+    assert router.stats()["hedge_wins"] == 1
+
+
+
+def test_failed_call_fails_over_to_the_alternate_tier():
+    router, backends = make_router(["primary", "secondary"], fallback="local", hedging=False)
+    backends["primary"].error = ConnectionError("API down")
+    assert router.create_chat_completion(task="q_and_a.verify", messages=MESSAGES).text == "secondary"
+    assert backends["local"].calls == 0
+    assert router.stats()["failovers"] == 1
+    assert router.report()["q_and_a.verify/primary"]["errors"] == 1
+
+
+def test_fallback_tier_answers_only_when_the_others_failed():
+    router, backends = make_router(["primary", "secondary"], fallback="local")
+    assert {router.choose("q_and_a.verify")[0].name for _ in range(50)} == {"primary"}
+    backends["primary"].error = backends["secondary"].error = ConnectionError("API down")
+    assert router.create_chat_completion(task="q_and_a.verify", messages=MESSAGES).text == "local"
+    assert asyncio.run(router.create_chat_completion_async(task="q_and_a.verify", messages=MESSAGES)).text == "local"
+    assert router.stats()["failovers"] == 4
+
+
+def test_error_is_raised_when_every_tier_failed():
+    router, backends = make_router(["primary", "secondary"], fallback="local")
+    for backend in backends.values():
+        backend.error = ConnectionError("down")
+    with pytest.raises(ConnectionError):
+        router.create_chat_completion(task="q_and_a.verify", messages=MESSAGES)
+
+
+def test_shed_call_is_neither_hedged_nor_failed_over():
+    router, backends = make_router(["primary", "secondary"], fallback="local")
+    warm_up(router)
+    backends["primary"].error = Overloaded("queue full")
+    with pytest.raises(Overloaded):
+        router.create_chat_completion(task="q_and_a.verify", messages=MESSAGES)
+    assert backends["secondary"].calls == backends["local"].calls == 0
+    assert router.stats()["hedged"] == router.stats()["failovers"] == 0
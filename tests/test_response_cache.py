@@ -0,0 +1,28 @@
+import pytest
+
+from response_cache import cache_key
+
+
+def messages(answer):
+    return [{"role": "system", "content": "Grade the answer."}, {"role": "user", "content": answer}]
+
+
+@pytest.mark.parametrize("first, second", [
+    ("Il a faim", "il a faim"),
+    ("Il a faim", "  Il a\nfaim "),
+])
+def test_case_and_whitespace_share_a_key(first, second):
+    assert cache_key(messages(first)) == cache_key(messages(second))
+
+
+@pytest.mark.parametrize("first, second", [
+    ("Il a faim", "Il à faim"),
+    ("Je suis allé", "Je suis alle"),
+    ("ou", "où"),
+])
+def test_accents_change_the_key(first, second):
+    assert cache_key(messages(first)) != cache_key(messages(second))
+
+
+def test_sampling_parameters_change_the_key():
+    assert cache_key(messages("Il a faim"), temperature=0.0) != cache_key(messages("Il a faim"), temperature=0.7)
@@ -0,0 +1,161 @@
+import asyncio
+import contextvars
+import threading
+import time
+
+import pytest
+
+import scheduler
+from scheduler import BACKGROUND, BULK, INTERACTIVE, Overloaded, Scheduler, mark
+
+
+class Limiter:
+    """
+    Rate limiter stand-in granting one request per unit of capacity, added by the test.
+    """
+
+    def __init__(self, available=0):
+        self.available = available
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens, max_wait=None):
+        with self.lock:
+            if self.available <= 0:
+                return None
+            self.available -= 1
+            return 0.0
+
+    def wait_time(self, tokens):
+        return 0.005
+
+    def add(self, amount):
+        with self.lock:
+            self.available += amount
+
+
+def make_scheduler(limiter, **kwargs):
+    kwargs.setdefault("queue_timeouts", (5.0, 5.0, 5.0))
+    return Scheduler(limiter, **kwargs)
+
+
+async def acquire(sched, priority, user, log, tokens=1):
+    mark(priority, user)
+    try:
+        ticket = await sched.acquire_async(tokens)
+    except Overloaded:
+        log.append(("shed", priority, user))
+        return
+    log.append(("granted", priority, user))
+    ticket.release()
+
+
+async def start(coroutines):
+    # Starts the callers in order and lets each of them join the queue.
+    tasks = []
+    for coroutine in coroutines:
+        tasks.append(asyncio.ensure_future(coroutine))
+        await asyncio.sleep(0)
+    await asyncio.sleep(0.01)
+    return tasks
+
+
+def test_grants_at_once_when_idle():
+    sched = make_scheduler(Limiter(available=1))
+    mark(INTERACTIVE, "a")
+    ticket = sched.acquire(1)
+    assert sched.stats()["in_flight"] == 1
+    ticket.release()
+    ticket.release()
+    assert sched.stats()["in_flight"] == 0
+    assert sched.stats()["interactive_granted"] == 1
+
+
+def test_calls_without_a_mark_are_background():
+    assert contextvars.Context().run(scheduler.current) == (BACKGROUND, None)
+
+
+def test_serves_classes_by_priority_and_users_round_robin():
+    limiter = Limiter()
+    sched = make_scheduler(limiter)
+    log = []
+
+    async def main():
+        tasks = await start([acquire(sched, BULK, "job", log), acquire(sched, BACKGROUND, None, log)]
+                            + [acquire(sched, INTERACTIVE, user, log) for user in ("a", "a", "a", "b")])
+        limiter.add(6)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert [(priority, user) for _, priority, user in log] == [
+        (INTERACTIVE, "a"), (INTERACTIVE, "b"), (INTERACTIVE, "a"), (INTERACTIVE, "a"),
+        (BACKGROUND, None), (BULK, "job")]
+
+
+def test_full_queue_sheds_less_urgent_calls_first():
+    limiter = Limiter()
+    sched = make_scheduler(limiter, max_queue=2)
+    log = []
+
+    async def main():
+        tasks = await start([acquire(sched, BULK, "job", log), acquire(sched, BACKGROUND, None, log),
+                             acquire(sched, INTERACTIVE, "a", log)])
+        assert log == [("shed", BULK, "job")]
+        tasks += await start([acquire(sched, BACKGROUND, None, log)])
+        assert log[-1] == ("shed", BACKGROUND, None)
+        limiter.add(2)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert log[-2:] == [("granted", INTERACTIVE, "a"), ("granted", BACKGROUND, None)]
+    assert sched.stats()["bulk_shed"] == 1
+    assert sched.stats()["background_shed"] == 1
+
+
+def test_waiter_is_withdrawn_at_its_deadline():
+    sched = make_scheduler(Limiter(), queue_timeouts=(0.05, 5.0, 5.0))
+    mark(INTERACTIVE, "a")
+    started = time.monotonic()
+    with pytest.raises(Overloaded):
+        sched.acquire(1)
+    assert time.monotonic() - started < 1.0
+    stats = sched.stats()
+    assert stats["queued"] == 0
+    assert stats["interactive_shed"] == 1
+
+
+def test_cancelled_waiter_leaves_the_queue_without_counting_as_shed():
+    sched = make_scheduler(Limiter())
+
+    async def main():
+        mark(INTERACTIVE, "a")
+        task = asyncio.ensure_future(sched.acquire_async(1))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    stats = sched.stats()
+    assert stats["queued"] == 0
+    assert stats["interactive_shed"] == 0
+
+
+def test_rejects_calls_whose_estimated_wait_exceeds_their_deadline():
+    limiter = Limiter(available=2)
+    sched = make_scheduler(limiter, queue_timeouts=(1.0, 5.0, 5.0))
+    mark(INTERACTIVE, "a")
+    # Two grants within the rate window: about 0.2 grants per second.
+    sched.acquire(1).release()
+    sched.acquire(1).release()
+    log = []
+
+    async def main():
+        tasks = await start([acquire(sched, INTERACTIVE, "b", log)])
+        started = time.monotonic()
+        await acquire(sched, INTERACTIVE, "c", log)
+        assert time.monotonic() - started < 0.5
+        limiter.add(1)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+    assert log == [("shed", INTERACTIVE, "c"), ("granted", INTERACTIVE, "b")]
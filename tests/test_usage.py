@@ -0,0 +1,110 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import usage
+
+
+def response(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+                           usage=SimpleNamespace(prompt_tokens=3, completion_tokens=2))
+
+
+@pytest.fixture
+def model(monkeypatch):
+    """
+    Answers every prompt with its upper-cased text; prompts in fail raise a transient error.
+    """
+    calls = []
+    fail = set()
+
+    async def create(messages, **kwargs):
+        prompt = messages[-1]["content"]
+        calls.append(prompt)
+        if prompt in fail:
+            raise ConnectionError("API unreachable")
+        return response(prompt.upper())
+
+    monkeypatch.setattr(usage, "create_chat_completion_async", create)
+    return SimpleNamespace(calls=calls, fail=fail)
+
+
+def write_lines(path, lines):
+    path.write_text("".join(line + "\n" for line in lines), encoding="utf8")
+
+
+def read_results(path):
+    return [json.loads(line) for line in path.read_text(encoding="utf8").splitlines()]
+
+
+def run(source, output, workers=2):
+    return asyncio.run(usage.run(str(source), str(output), "model", workers=workers))
+
+
+def test_scan_output_cuts_off_a_partial_last_line(tmp_path):
+    path = tmp_path / "out.jsonl"
+    path.write_text('{"line": 0, "error": null}\n{"line": 1, "error": "Timeout"}\n{"line": 2, "err',
+                    encoding="utf8")
+    assert usage.scan_output(str(path)) == (2, {1})
+    assert path.read_text(encoding="utf8").endswith('"Timeout"}\n')
+
+
+def test_scan_output_skips_permanent_errors(tmp_path):
+    path = tmp_path / "out.jsonl"
+    write_lines(path, ['{"line": 0, "error": "ValueError: bad", "permanent": true}',
+                       '{"line": 1, "error": "APIConnectionError: down"}'])
+    assert usage.scan_output(str(path)) == (2, {1})
+    assert usage.scan_output(str(tmp_path / "missing.jsonl")) == (0, set())
+
+
+def test_replace_lines(tmp_path):
+    path = tmp_path / "out.jsonl"
+    write_lines(path, ['{"line": 0}', '{"line": 1}', '{"line": 2}'])
+    usage.replace_lines(str(path), {1: {"line": 1, "response": "new"}})
+    assert read_results(path) == [{"line": 0}, {"line": 1, "response": "new"}, {"line": 2}]
+
+
+def test_run_writes_results_in_input_order(tmp_path, model):
+    source, output = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    write_lines(source, [json.dumps({"id": i, "prompt": f"p{i}"}) for i in range(20)])
+    stats = run(source, output, workers=4)
+    results = read_results(output)
+    assert [r["line"] for r in results] == list(range(20))
+    assert [r["response"] for r in results] == [f"P{i}" for i in range(20)]
+    assert stats.summary()["lines"] == 20
+    assert not (tmp_path / "out.jsonl.partial").exists()
+
+
+def test_rerun_retries_only_transient_failures(tmp_path, model):
+    source, output = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    write_lines(source, [json.dumps({"prompt": "a"}), "not json", json.dumps({"prompt": "b"}), "{}",
+                         json.dumps({"prompt": "c"})])
+    model.fail.add("b")
+    run(source, output)
+    assert [r["error"] is None for r in read_results(output)] == [True, False, False, False, True]
+
+    model.fail.clear()
+    model.calls.clear()
+    stats = run(source, output)
+    results = read_results(output)
+    assert model.calls == ["b"]
+    assert stats.summary()["skipped"] == 4
+    assert [r["line"] for r in results] == [0, 1, 2, 3, 4]
+    assert results[2]["response"] == "B"
+    assert results[1]["permanent"] and results[3]["permanent"]
+
+    model.calls.clear()
+    run(source, output)
+    assert model.calls == []
+
+
+def test_rerun_takes_results_from_the_partial_file(tmp_path, model):
+    source, output = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+    write_lines(source, [json.dumps({"prompt": p}) for p in "abc"])
+    write_lines(output, ['{"line": 0, "response": "A", "error": null}', '{"line": 1, "error": "Timeout"}'])
+    write_lines(tmp_path / "out.jsonl.partial", ['{"line": 1, "response": "from partial", "error": null}'])
+    run(source, output)
+    assert model.calls == ["c"]
+    assert [r.get("response") for r in read_results(output)] == ["A", "from partial", "C"]
@@ -0,0 +1,54 @@
+"""
+tokens.py
+
+Local token counting for prompt budgeting and dataset statistics.
+
+Uses tiktoken when it is installed and otherwise falls back to a word/punctuation estimate that
+stays close to the real count for French and English text without any network access.
+"""
+
+import re
+
+# Encoding used by the gpt-4o family, which the fine-tuned model is based on.
+ENCODING_NAME = "o200k_base"
+# Per-message overhead of the chat format, plus the tokens priming the assistant's reply.
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+_WORD_PATTERN = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_encoding = None
+
+
+def _get_encoding():
+    # tiktoken is imported on first use, it is slow to import and optional.
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(ENCODING_NAME)
+        except Exception:
+            # Not installed, or offline: tiktoken downloads its encodings on first use.
+            _encoding = False
+    return _encoding
+
+
+def count_tokens(text):
+    """
+    Returns the number of tokens in text.
+    """
+    if not text:
+        return 0
+    if _get_encoding():
+        return len(_encoding.encode(text))
+    # Words are roughly one token per four characters, punctuation is one token each.
+    return sum((len(word) + 3) // 4 for word in _WORD_PATTERN.findall(text))
+
+
+def count_message_tokens(messages):
+    """
+    Returns the number of prompt tokens a list of chat messages uses.
+    """
+    total = TOKENS_PER_REPLY
+    for message in messages:
+        total += TOKENS_PER_MESSAGE + count_tokens(str(message.get("content") or ""))
+    return total
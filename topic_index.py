@@ -0,0 +1,186 @@
+"""
+topic_index.py
+
+Maps free-text topics to canonical topics, so similar topics share pre-generated exercises.
+
+Topics are embedded locally as hashed TF-IDF vectors of character n-grams, which tolerates
+typos, plurals and articles ("la cuisine", "cuisines"), and an alias table maps synonyms and
+translations ("cooking", "nourriture") to the same canonical topic. The nearest neighbour is
+found with one matrix-vector product over all known topics. Topics with no neighbour above the
+threshold become canonical topics themselves, so later variants of them are grouped too.
+"""
+
+import collections
+import os
+import threading
+import zlib
+
+import numpy as np
+
+from response_cache import normalize_text
+
+# Cosine similarity from which a topic is mapped to its nearest known topic.
+DEFAULT_THRESHOLD = float(os.getenv("CHATTERBOT_TOPIC_THRESHOLD", "0.6"))
+# Upper bound on the number of topics indexed; topics beyond it are used as they are.
+DEFAULT_MAX_TOPICS = int(os.getenv("CHATTERBOT_TOPIC_INDEX_SIZE", "50000"))
+# Dimensions of the hashed feature space.
+DIMENSIONS = 128
+NGRAM_SIZES = (3, 4)
+# Number of recent lookups answered without computing a vector.
+LOOKUP_CACHE_SIZE = 4096
+STOPWORDS = {"a", "an", "the", "of", "and", "about", "le", "la", "les", "l", "un", "une", "des", "de", "du", "d",
+             "et", "en", "au", "aux", "sur"}
+
+# Canonical topics with English and French aliases.
+SEED_TOPICS = {
+    "food": ["food", "cooking", "cuisine", "la cuisine", "nourriture", "manger", "eating", "meals", "repas",
+             "recipes", "recettes", "restaurant", "fruits", "vegetables", "legumes"],
+    "travel": ["travel", "traveling", "voyage", "voyager", "vacances", "holidays", "vacation", "tourism", "tourisme"],
+    "school": ["school", "ecole", "classe", "education", "studying", "etudes", "university", "universite"],
+    "music": ["music", "musique", "songs", "chansons", "concert", "instruments"],
+    "sports": ["sports", "sport", "football", "soccer", "exercise", "fitness", "jouer au foot"],
+    "family": ["family", "famille", "parents", "relatives", "siblings", "freres et soeurs"],
+    "weather": ["weather", "meteo", "le temps", "climate", "climat", "seasons", "saisons"],
+    "animals": ["animals", "animaux", "pets", "animaux de compagnie", "zoo", "wildlife"],
+    "shopping": ["shopping", "faire les courses", "courses", "magasins", "stores", "market", "marche"],
+    "work": ["work", "travail", "jobs", "metiers", "professions", "career", "office", "bureau"],
+    "health": ["health", "sante", "doctor", "medecin", "body", "le corps", "illness"],
+    "home": ["home", "house", "maison", "la maison", "furniture", "meubles", "rooms", "chambre"],
+    "clothes": ["clothes", "clothing", "vetements", "fashion", "mode"],
+    "city": ["city", "ville", "town", "directions", "transport", "transports"],
+    "nature": ["nature", "environment", "environnement", "plants", "plantes", "forest", "foret", "mer", "sea"],
+    "hobbies": ["hobbies", "loisirs", "free time", "temps libre", "passe-temps", "games", "jeux"],
+    "technology": ["technology", "technologie", "computers", "ordinateurs", "internet", "phones", "telephones"],
+    "culture": ["culture", "art", "movies", "cinema", "films", "books", "livres", "literature", "litterature"],
+    "time": ["time", "l'heure", "telling time", "days of the week", "jours de la semaine", "months", "mois"],
+    "greetings": ["greetings", "salutations", "introductions", "se presenter", "bonjour"],
+}
+
+
+def normalize_topic_text(topic):
+    """
+    Lower-cases and strips accents, punctuation and stopwords.
+    """
+    text = "".join(c if c.isalnum() else " " for c in normalize_text(topic or ""))
+    words = [word for word in text.split() if word not in STOPWORDS]
+    return " ".join(words) or text.strip()
+
+
+def ngram_hashes(text):
+    padded = f" {text} "
+    return [zlib.crc32(padded[i:i + n].encode("utf8"))
+            for n in NGRAM_SIZES for i in range(max(1, len(padded) - n + 1))]
+
+
+class TopicIndex:
+    """
+    Thread-safe nearest-neighbour index from topics to canonical topics.
+    """
+
+    def __init__(self, aliases=None, threshold=DEFAULT_THRESHOLD, max_topics=DEFAULT_MAX_TOPICS):
+        """
+        aliases: {canonical topic: [aliases]}, SEED_TOPICS by default. The inverse document
+        frequencies of the n-grams are fitted on these aliases.
+        """
+        aliases = SEED_TOPICS if aliases is None else aliases
+        self.threshold = threshold
+        self.max_topics = max_topics
+        self._lock = threading.Lock()
+        self._exact = {}
+        self._canonical = []
+        self._vectors = np.zeros((64, DIMENSIONS), dtype=np.float32)
+        self._size = 0
+        self._recent = collections.OrderedDict()
+        self.lookups = 0
+        self.matched = 0
+        self.added = 0
+        self._idf = self._fit_idf([normalize_topic_text(alias) for names in aliases.values() for alias in names])
+        for canonical, names in aliases.items():
+            for alias in [canonical, *names]:
+                self.add(alias, canonical)
+
+    @staticmethod
+    def _fit_idf(texts):
+        document_frequency = np.zeros(DIMENSIONS, dtype=np.float32)
+        for text in texts:
+            document_frequency[np.unique(np.array(ngram_hashes(text), dtype=np.uint32) % DIMENSIONS)] += 1
+        return np.log((1 + len(texts)) / (1 + document_frequency)).astype(np.float32) + 1
+
+    def vector(self, text):
+        """
+        L2-normalized hashed TF-IDF vector of a normalized topic. The hash's top bit picks the
+        sign of each feature, so bucket collisions cancel out instead of adding up.
+        """
+        hashes = np.array(ngram_hashes(text), dtype=np.uint32)
+        signs = np.where(hashes >> 31, -1.0, 1.0).astype(np.float32)
+        vector = np.bincount(hashes % DIMENSIONS, weights=signs, minlength=DIMENSIONS).astype(np.float32)
+        vector *= self._idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def add(self, topic, canonical=None):
+        """
+        Indexes topic as an alias of canonical, or as a canonical topic of its own.
+        """
+        text = normalize_topic_text(topic)
+        canonical = canonical or text
+        with self._lock:
+            if not text or text in self._exact or self._size >= self.max_topics:
+                return
+            if self._size == len(self._vectors):
+                self._vectors = np.concatenate([self._vectors, np.zeros_like(self._vectors)])
+            self._vectors[self._size] = self.vector(text)
+            self._canonical.append(canonical)
+            self._exact[text] = canonical
+            self._size += 1
+
+    def lookup(self, topic):
+        """
+        Returns (canonical topic, similarity) of topic's nearest neighbour, or (None, similarity)
+        when nothing is similar enough.
+        """
+        text = normalize_topic_text(topic)
+        if text in self._exact:
+            return self._exact[text], 1.0
+        size = self._size
+        if not size:
+            return None, 0.0
+        scores = self._vectors[:size] @ self.vector(text)
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None, float(scores[best])
+        return self._canonical[best], float(scores[best])
+
+    def canonical(self, topic):
+        """
+        Maps a free-text topic to its canonical topic. A blank topic stays blank ("random topic"),
+        and a topic unlike any known one becomes a canonical topic itself.
+        """
+        if not topic or not topic.strip():
+            return ""
+        with self._lock:
+            self.lookups += 1
+            recent = self._recent.get(topic)
+            if recent is not None:
+                self._recent.move_to_end(topic)
+                self.matched += 1
+                return recent
+        canonical, _ = self.lookup(topic)
+        if canonical is None:
+            canonical = normalize_topic_text(topic)
+            self.add(topic, canonical)
+            with self._lock:
+                self.added += 1
+        else:
+            with self._lock:
+                self.matched += 1
+        with self._lock:
+            self._recent[topic] = canonical
+            if len(self._recent) > LOOKUP_CACHE_SIZE:
+                self._recent.popitem(last=False)
+        return canonical
+
+    def stats(self):
+        with self._lock:
+            return {"topics": self._size, "canonical_topics": len(set(self._canonical)), "lookups": self.lookups,
+                    "matched": self.matched, "added": self.added}
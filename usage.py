@@ -1,50 +1,294 @@
 """
 usage.py
 
-Script to load and query the fine-tuned model for different language-learning tasks.
+Bulk inference with the fine-tuned model: runs every prompt of a JSONL file through the chat
+endpoint and writes the responses to an output JSONL file, in the order of the input.
+
+Each input line is {"messages": [...]} or {"prompt": "..."}, optionally with an "id" and its own
+"max_tokens" or "temperature". Prompts are streamed from the input and sent by a bounded pool of
+asyncio workers. Calls go through model_client, so they are rate limited and retried, and are
+scheduled as bulk work behind any learners sharing the budget; CHATTERBOT_REQUESTS_PER_MINUTE and
+CHATTERBOT_TOKENS_PER_MINUTE set the budgets. Results that finish early wait in a bounded window
+until the lines before them are written.
+
+Every result is also appended to <output>.partial as soon as it is known. Together with the output
+this is the checkpoint: running the same command again skips the lines already written and the
+results in the partial file, so a crashed run redoes nothing that finished. Lines that failed are
+written with their error, so later lines aren't held up. Lines that failed in the API are
+retried by the next run, which puts their new results in their place; lines that can't succeed,
+such as invalid JSON or a line without messages or prompt, are marked permanent and kept. Throughput is reported while the run goes and at its end.
+
+Usage:
+    python usage.py answers.jsonl --output feedback.jsonl --workers 32
+    python usage.py answers.jsonl --output feedback.jsonl --mock
 """
 
+import argparse
+import asyncio
+import json
 import os
-from openai import OpenAI
+import time
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+import metrics
+from data_preparation import read_records
+from model_client import create_chat_completion, create_chat_completion_async
+from scheduler import BULK, mark
+
+# Requests in flight at once.
+WORKERS = int(os.getenv("CHATTERBOT_USAGE_WORKERS", "16"))
+# Lines read ahead of the last line written, per worker; bounds the results held in memory.
+WINDOW_PER_WORKER = 8
+MAX_TOKENS = 150
+TEMPERATURE = 0.5
+OUTPUT_PATH = "usage_results.jsonl"
+# Seconds between progress reports.
+PROGRESS_INTERVAL = 10.0
 
-def load_fine_tuned_model(model_name):
-    """
-    Simple placeholder function in case you want
-    to store the model name or load custom logic.
-    """
-    return model_name
 
 def generate_response(model_name, user_prompt, max_tokens=100):
     """
     Sends the user_prompt to the fine-tuned model and returns the response.
     """
-    response = client.completions.create(model=model_name,
-    prompt=user_prompt,
-    max_tokens=max_tokens,
-    temperature=0.5,
-    top_p=1.0)
-    return response.choices[0].text.strip()
+    response = create_chat_completion(model=model_name,
+                                      messages=[{"role": "user", "content": user_prompt}],
+                                      max_tokens=max_tokens,
+                                      temperature=TEMPERATURE,
+                                      top_p=1.0,
+                                      task="usage.generate")
+    return response.choices[0].message.content.strip()
+
+
+def to_messages(record):
+    if not isinstance(record, dict):
+        raise ValueError("Line is not a JSON object")
+    if record.get("messages"):
+        return record["messages"]
+    if record.get("prompt"):
+        return [{"role": "user", "content": record["prompt"]}]
+    raise ValueError("Line has neither messages nor prompt")
+
+
+def scan_output(path):
+    """
+    Returns the number of complete lines of path and the set of line numbers whose result is an
+    error worth retrying. A partial last line, left by a crash, is cut off.
+    """
+    if not os.path.exists(path):
+        return 0, set()
+    complete, end, failed = 0, 0, set()
+    with open(path, "rb+") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            result = json.loads(line)
+            if result.get("error") is not None and not result.get("permanent"):
+                failed.add(complete)
+            complete += 1
+            end += len(line)
+        f.truncate(end)
+    return complete, failed
+
+
+def load_partial(path, start, failed):
+    """
+    Returns {line: result} of the partial file's successful results for lines from start on or
+    in failed.
+    """
+    finished = {}
+    if not os.path.exists(path):
+        return finished
+    with open(path, encoding="utf8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if result["error"] is None and (result["line"] >= start or result["line"] in failed):
+                finished[result["line"]] = result
+    return finished
+
+
+def replace_lines(path, results):
+    """
+    Rewrites path with the lines numbered in results replaced by their result.
+    """
+    temporary = path + ".tmp"
+    with open(path, encoding="utf8") as f, open(temporary, "w", encoding="utf8") as output:
+        for number, line in enumerate(f):
+            if number in results:
+                line = json.dumps(results[number], ensure_ascii=False) + "\n"
+            output.write(line)
+    os.replace(temporary, path)
+
+
+class Throughput:
+    """
+    Lines, tokens and latency of a run, printed every PROGRESS_INTERVAL seconds.
+    """
+
+    def __init__(self, skipped=0):
+        self.started = time.perf_counter()
+        self.reported = self.started
+        self.skipped = skipped
+        self.done = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency = metrics.Window()
+
+    def observe(self, result):
+        self.done += 1
+        if result["error"] is not None:
+            self.errors += 1
+        else:
+            self.latency.observe(result["latency"])
+            self.prompt_tokens += result["prompt_tokens"] or 0
+            self.completion_tokens += result["completion_tokens"] or 0
+        now = time.perf_counter()
+        if now - self.reported >= PROGRESS_INTERVAL:
+            self.reported = now
+            s = self.summary()
+            print(f"{s['lines']} lines ({s['lines_per_second']:.1f}/s, {s['tokens_per_second']:.0f} tokens/s), "
+                  f"{s['errors']} errors")
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        latency = self.latency.summary()
+        return {"lines": self.done, "skipped": self.skipped, "errors": self.errors, "elapsed_seconds": elapsed,
+                "lines_per_second": self.done / elapsed if elapsed else 0.0,
+                "tokens_per_second": (self.prompt_tokens + self.completion_tokens) / elapsed if elapsed else 0.0,
+                "prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens,
+                "latency_p50": latency["p50"], "latency_p95": latency["p95"]}
+
+
+async def infer(number, line, model, max_tokens, temperature):
+    started = time.perf_counter()
+    result = {"line": number}
+    try:
+        record = json.loads(line)
+        messages = to_messages(record)
+    except ValueError as e:
+        # The line itself is wrong, so running it again can't help.
+        return {**result, "error": f"{type(e).__name__}: {e}", "permanent": True}
+    if "id" in record:
+        result["id"] = record["id"]
+    try:
+        response = await create_chat_completion_async(model=model, messages=messages,
+                                                      max_tokens=record.get("max_tokens", max_tokens),
+                                                      temperature=record.get("temperature", temperature),
+                                                      top_p=1.0, task="usage.generate")
+    except Exception as e:
+        return {**result, "error": f"{type(e).__name__}: {e}"}
+    usage = response.usage
+    return {**result, "response": (response.choices[0].message.content or "").strip(),
+            "latency": time.perf_counter() - started,
+            "prompt_tokens": getattr(usage, "prompt_tokens", None),
+            "completion_tokens": getattr(usage, "completion_tokens", None), "error": None}
+
+
+async def run(source, output_path, model, workers=WORKERS, max_tokens=MAX_TOKENS, temperature=TEMPERATURE,
+              limit=None):
+    """
+    Runs the lines of source that aren't in output_path yet and appends their results to it, in
+    order, then retries the lines written with an error and replaces them. Returns the run's
+    Throughput.
+    """
+    mark(BULK, "usage")
+    partial_path = output_path + ".partial"
+    written, failed = scan_output(output_path)
+    ready = load_partial(partial_path, written, failed)
+    # Results of lines already written with an error; they replace them once the run is over.
+    retried = {line: ready.pop(line) for line in failed if line in ready}
+    stats = Throughput(skipped=written - len(failed) + len(retried) + len(ready))
+    window = WINDOW_PER_WORKER * workers
+    jobs = asyncio.Queue(maxsize=2 * workers)
+    progress = asyncio.Condition()
+    next_line = written
+
+    with open(output_path, "a", encoding="utf8") as output, open(partial_path, "a", encoding="utf8") as partial:
+
+        def flush():
+            nonlocal next_line
+            while next_line in ready:
+                output.write(json.dumps(ready.pop(next_line), ensure_ascii=False) + "\n")
+                next_line += 1
+            output.flush()
+
+        async def work():
+            while True:
+                job = await jobs.get()
+                if job is None:
+                    return
+                result = await infer(*job, model, max_tokens, temperature)
+                stats.observe(result)
+                partial.write(json.dumps(result, ensure_ascii=False) + "\n")
+                partial.flush()
+                if result["line"] < written:
+                    retried[result["line"]] = result
+                    continue
+                async with progress:
+                    ready[result["line"]] = result
+                    flush()
+                    progress.notify_all()
+
+        workers_done = [asyncio.ensure_future(work()) for _ in range(workers)]
+        async with progress:
+            flush()
+        for number, (_, _, line) in enumerate(read_records([source])):
+            if limit is not None and number >= limit:
+                break
+            if number < written and number not in failed or number in ready or number in retried:
+                continue
+            async with progress:
+                await progress.wait_for(lambda: number - next_line < window)
+            await jobs.put((number, line))
+        for _ in workers_done:
+            await jobs.put(None)
+        await asyncio.gather(*workers_done)
+        flush()
+    if retried:
+        replace_lines(output_path, retried)
+    if not ready:
+        os.remove(partial_path)
+    return stats
+
 
 def main():
-    # Example usage
-    # Suppose your fine-tuned model name is "davinci:ft-your-org--lingua-activities-2023-xx-xx"
-    fine_tuned_model = "davinci:ft-your-org--lingua-activities-2023-xx-xx"
-    loaded_model = load_fine_tuned_model(fine_tuned_model)
-
-    # A sample user prompt: fill in the blank
-    user_prompt = (
-        "Task: Fill in the blank (French)\n"
-        "Sentence: Je __ un chat.\n"
-        "Possible words: [ai, suis, vas]\n"
-        "Question: Which word correctly fills in the blank?\n"
-        "Answer with explanation in French.\n"
-        "Answer:"
-    )
-
-    response_text = generate_response(loaded_model, user_prompt)
-    print("Model Response:\n", response_text)
+    parser = argparse.ArgumentParser(description="Run every prompt of a JSONL file through the chat endpoint.")
+    parser.add_argument("source", help="JSONL file of {\"messages\": [...]} or {\"prompt\": ...} lines.")
+    parser.add_argument("--output", default=OUTPUT_PATH,
+                        help="Output JSONL, one result per input line; a run resumes where it stopped.")
+    parser.add_argument("--model", help="Model to run; defaults to FINE_TUNED_MODEL.")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--max-tokens", type=int, default=MAX_TOKENS)
+    parser.add_argument("--temperature", type=float, default=TEMPERATURE)
+    parser.add_argument("--limit", type=int, help="Run at most this many lines of the input.")
+    parser.add_argument("--report", help="Path of the JSON throughput report.")
+    parser.add_argument("--mock", action="store_true", help="Run against an in-process mock_server.")
+    args = parser.parse_args()
+
+    if args.mock:
+        from mock_server import MockServer
+        server = MockServer()
+        server.start()
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        os.environ.setdefault("OPENAI_API_KEY", "mock")
+    if not args.model:
+        from app_integration import FINE_TUNED_MODEL
+        args.model = FINE_TUNED_MODEL
+
+    stats = asyncio.run(run(args.source, args.output, args.model, args.workers, args.max_tokens,
+                            args.temperature, args.limit))
+    summary = stats.summary()
+    print(f"{summary['lines']} lines in {summary['elapsed_seconds']:.1f}s ({summary['lines_per_second']:.1f}/s, "
+          f"{summary['tokens_per_second']:.0f} tokens/s), {summary['skipped']} already done, "
+          f"{summary['errors']} errors; latency p50 {summary['latency_p50']:.2f}s p95 {summary['latency_p95']:.2f}s. "
+          f"Results in {args.output}.")
+    if args.report:
+        with open(args.report, "w", encoding="utf8") as f:
+            json.dump(summary, f, indent=2)
+    metrics.dump_on_exit()
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()